@@ -0,0 +1,547 @@
+import os
+import re
+import json
+import time
+import zlib
+import zipfile
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# ----------------------------
+# mock xnat
+# ----------------------------
+# local XNAT REST server for benchmarking, serves synthetic series with
+# configurable latency (per request) and bandwidth (per response stream)
+# ----------------------------
+
+# minimal xnat schema, only the types the preprocessor touches
+MOCK_XNAT_SCHEMA = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema targetNamespace="http://nrg.wustl.edu/xnat" xmlns:xnat="http://nrg.wustl.edu/xnat"
+           xmlns:xs="http://www.w3.org/2001/XMLSchema" elementFormDefault="qualified">
+  <xs:element name="Project" type="xnat:projectData"/>
+  <xs:element name="Subject" type="xnat:subjectData"/>
+  <xs:element name="CTSession" type="xnat:ctSessionData"/>
+  <xs:element name="MRSession" type="xnat:mrSessionData"/>
+  <xs:element name="MGSession" type="xnat:mgSessionData"/>
+  <xs:element name="CTScan" type="xnat:ctScanData"/>
+  <xs:element name="MRScan" type="xnat:mrScanData"/>
+  <xs:element name="MGScan" type="xnat:mgScanData"/>
+  <xs:element name="ResourceCatalog" type="xnat:resourceCatalog"/>
+  <xs:complexType name="projectData">
+    <xs:sequence>
+      <xs:element name="name" type="xs:string" minOccurs="0"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+  </xs:complexType>
+  <xs:complexType name="subjectData">
+    <xs:sequence>
+      <xs:element name="experiments" minOccurs="0">
+        <xs:complexType>
+          <xs:sequence>
+            <xs:element name="experiment" type="xnat:subjectAssessorData" minOccurs="0" maxOccurs="unbounded"/>
+          </xs:sequence>
+        </xs:complexType>
+      </xs:element>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+    <xs:attribute name="label" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="experimentData">
+    <xs:sequence>
+      <xs:element name="date" type="xs:date" minOccurs="0"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+    <xs:attribute name="project" type="xs:string" use="required"/>
+    <xs:attribute name="label" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="subjectAssessorData">
+    <xs:complexContent>
+      <xs:extension base="xnat:experimentData">
+        <xs:sequence>
+          <xs:element name="subject_ID" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="imageSessionData">
+    <xs:complexContent>
+      <xs:extension base="xnat:subjectAssessorData">
+        <xs:sequence>
+          <xs:element name="modality" type="xs:string" minOccurs="0"/>
+          <xs:element name="scans" minOccurs="0">
+            <xs:complexType>
+              <xs:sequence>
+                <xs:element name="scan" type="xnat:imageScanData" minOccurs="0" maxOccurs="unbounded"/>
+              </xs:sequence>
+            </xs:complexType>
+          </xs:element>
+        </xs:sequence>
+      </xs:extension>
+    </xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="ctSessionData">
+    <xs:complexContent><xs:extension base="xnat:imageSessionData"/></xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="mrSessionData">
+    <xs:complexContent><xs:extension base="xnat:imageSessionData"/></xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="mgSessionData">
+    <xs:complexContent><xs:extension base="xnat:imageSessionData"/></xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="imageScanData">
+    <xs:sequence>
+      <xs:element name="modality" type="xs:string" minOccurs="0"/>
+      <xs:element name="series_description" type="xs:string" minOccurs="0"/>
+    </xs:sequence>
+    <xs:attribute name="ID" type="xs:string" use="required"/>
+    <xs:attribute name="type" type="xs:string"/>
+    <xs:attribute name="project" type="xs:string"/>
+  </xs:complexType>
+  <xs:complexType name="ctScanData">
+    <xs:complexContent><xs:extension base="xnat:imageScanData"/></xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="mrScanData">
+    <xs:complexContent><xs:extension base="xnat:imageScanData"/></xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="mgScanData">
+    <xs:complexContent><xs:extension base="xnat:imageScanData"/></xs:complexContent>
+  </xs:complexType>
+  <xs:complexType name="abstractResource">
+    <xs:attribute name="label" type="xs:string"/>
+    <xs:attribute name="file_count" type="xs:integer"/>
+    <xs:attribute name="file_size" type="xs:integer"/>
+  </xs:complexType>
+  <xs:complexType name="resourceCatalog">
+    <xs:complexContent><xs:extension base="xnat:abstractResource"/></xs:complexContent>
+  </xs:complexType>
+</xs:schema>
+"""
+
+SESSION_TYPES = {'CT': 'xnat:ctSessionData', 'MR': 'xnat:mrSessionData', 'MG': 'xnat:mgSessionData'}
+SCAN_TYPES = {'CT': 'xnat:ctScanData', 'MR': 'xnat:mrScanData', 'MG': 'xnat:mgScanData'}
+
+
+class mock_xnat(object):
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, user='bench', password='bench'):
+
+        # latency in seconds per request, bandwidth in bytes per second per stream (None is unlimited)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.user = user
+        self.password = password
+
+        # catalog: project -> subject -> experiment -> scan -> resource -> files
+        self.projects = {}
+
+        # counters
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.bytes_sent = 0
+        self.scan_bytes_sent = {}
+
+        self.server = ThreadingHTTPServer((host, port), self.create_handler())
+        self.server.daemon_threads = True
+        self.server.handle_error = self.handle_error
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    # ----------------------------
+    # server control
+    # ----------------------------
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        return None
+
+    def handle_error(self, request, client_address):
+        # clients drop connections mid-stream (header-only reads), not worth a traceback
+        return None
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_count = 0
+            self.bytes_sent = 0
+            self.scan_bytes_sent = {}
+        return None
+
+    # ----------------------------
+    # catalog
+    # ----------------------------
+
+    def add_scan(self, project_id, subject_id, experiment_id, scan_id, modality, scan_type, file_paths):
+
+        project = self.projects.setdefault(project_id, {'name': project_id, 'subjects': {}})
+        subject = project['subjects'].setdefault(subject_id, {'label': subject_id, 'experiments': {}})
+        experiment = subject['experiments'].setdefault(experiment_id, {
+            'label': experiment_id,
+            'modality': modality,
+            'xsi_type': SESSION_TYPES.get(modality, 'xnat:mrSessionData'),
+            'scans': {}})
+        experiment['last_modified'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        experiment['scans'][scan_id] = {
+            'type': scan_type,
+            'modality': modality,
+            'xsi_type': SCAN_TYPES.get(modality, 'xnat:mrScanData'),
+            'resources': {'DICOM': {os.path.basename(path): path for path in file_paths}}}
+
+        return None
+
+    # ----------------------------
+    # request handler
+    # ----------------------------
+
+    def create_handler(self):
+
+        mock = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                return None
+
+            def do_GET(self):
+                mock.handle(self, 'GET')
+
+            def do_HEAD(self):
+                mock.handle(self, 'HEAD')
+
+            def do_PUT(self):
+                mock.handle(self, 'PUT')
+
+            def do_POST(self):
+                mock.handle(self, 'POST')
+
+            def do_DELETE(self):
+                mock.handle(self, 'DELETE')
+
+        return handler
+
+    def handle(self, request, method):
+
+        with self.lock:
+            self.request_count += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        # consume request body (uploads)
+        length = int(request.headers.get('Content-Length', 0) or 0)
+        if length:
+            request.rfile.read(length)
+
+        parsed = urlparse(request.path)
+        path = re.sub(r'^/(REST|data/archive)/', '/data/', parsed.path).rstrip('/')
+        query = parse_qs(parsed.query)
+
+        try:
+            if method in ('PUT', 'POST', 'DELETE'):
+                return self.handle_write(request, method, path, query)
+            return self.handle_read(request, method, path, query)
+        except KeyError:
+            return self.send(request, 404, f'Not found: {path}')
+
+    def handle_write(self, request, method, path, query):
+
+        if path == '/data/services/auth':
+            return self.send(request, 200, 'MOCKJSESSIONID')
+
+        # resource creation and file upload (QC json files)
+        match = re.match(r'^(/data/projects/[^/]+/subjects/[^/]+/experiments/[^/]+/scans/[^/]+)/resources/([^/]+)(/files/(.+))?$', path)
+        if match:
+            scan = self.get_scan(match.group(1))
+            resource = scan['resources'].setdefault(get_resource_label(match.group(1), match.group(2)), {})
+            if match.group(4):
+                resource[match.group(4)] = None
+            return self.send(request, 200, '')
+
+        return self.send(request, 200, '')
+
+    def handle_read(self, request, method, path, query):
+
+        # session
+        if path == '':
+            return self.send(request, 200, '<html>mock xnat</html>', 'text/html')
+        if path == '/data/JSESSION':
+            return self.send(request, 200, 'MOCKJSESSIONID')
+        if path == '/data/auth':
+            return self.send(request, 200, f"User '{self.user}' is logged in")
+        if path == '/data/version':
+            return self.send(request, 200, '1.8.5')
+        if path == '/xapi/siteConfig/buildInfo':
+            return self.send_json(request, {'version': '1.8.5'})
+        if path == '/xapi/schemas':
+            return self.send_json(request, ['xnat'])
+        if path == '/xapi/schemas/xnat':
+            return self.send(request, 200, MOCK_XNAT_SCHEMA, 'text/xml')
+        if path == '/data/search/elements':
+            return self.send_result_set(request, [])
+
+        parts = path.split('/')[2:]
+
+        # /data/projects
+        if parts == ['projects']:
+            return self.send_result_set(request, [
+                {'ID': project_id, 'name': project['name'], 'secondary_ID': project_id, 'URI': f'/data/projects/{project_id}'}
+                for project_id, project in self.projects.items()])
+
+        project_id = parts[1]
+        project = self.projects[project_id]
+
+        # /data/projects/{project}
+        if len(parts) == 2:
+            return self.send_items(request, 'xnat:projectData', {'ID': project_id, 'name': project['name'], 'secondary_ID': project_id})
+
+        # /data/projects/{project}/experiments (with last_modified, polled by the daemon)
+        if len(parts) == 3 and parts[2] == 'experiments':
+            return self.send_result_set(request, [
+                {'ID': experiment_id, 'label': experiment['label'], 'project': project_id, 'subject_ID': subject_id,
+                 'xsiType': experiment['xsi_type'], 'last_modified': experiment['last_modified'],
+                 'URI': f'/data/experiments/{experiment_id}'}
+                for subject_id, subject in project['subjects'].items()
+                for experiment_id, experiment in subject['experiments'].items()])
+
+        # /data/projects/{project}/subjects
+        if len(parts) == 3 and parts[2] == 'subjects':
+            return self.send_result_set(request, [
+                {'ID': subject_id, 'label': subject['label'], 'project': project_id,
+                 'URI': f'/data/subjects/{subject_id}'}
+                for subject_id, subject in project['subjects'].items()])
+
+        subject_id = parts[3]
+        subject = project['subjects'][subject_id]
+
+        # /data/projects/{project}/subjects/{subject}
+        if len(parts) == 4:
+            children = [{
+                'field': 'experiments/experiment',
+                'items': [self.create_item(experiment['xsi_type'], {
+                    'ID': experiment_id, 'label': experiment['label'], 'project': project_id, 'subject_ID': subject_id})
+                    for experiment_id, experiment in subject['experiments'].items()]}]
+            return self.send_items(request, 'xnat:subjectData', {'ID': subject_id, 'label': subject['label'], 'project': project_id}, children)
+
+        # /data/projects/{project}/subjects/{subject}/experiments
+        if len(parts) == 5 and parts[4] == 'experiments':
+            return self.send_result_set(request, [
+                {'ID': experiment_id, 'label': experiment['label'], 'project': project_id, 'xsiType': experiment['xsi_type'],
+                 'URI': f'/data/experiments/{experiment_id}'}
+                for experiment_id, experiment in subject['experiments'].items()])
+
+        experiment_id = parts[5]
+        experiment = subject['experiments'][experiment_id]
+
+        # /data/projects/{project}/subjects/{subject}/experiments/{experiment}
+        if len(parts) == 6:
+            children = [{
+                'field': 'scans/scan',
+                'items': [self.create_item(scan['xsi_type'], {
+                    'ID': scan_id, 'type': scan['type'], 'modality': scan['modality'], 'project': project_id})
+                    for scan_id, scan in experiment['scans'].items()]}]
+            return self.send_items(request, experiment['xsi_type'], {
+                'ID': experiment_id, 'label': experiment['label'], 'project': project_id,
+                'subject_ID': subject_id, 'modality': experiment['modality']}, children)
+
+        # /data/projects/{project}/subjects/{subject}/experiments/{experiment}/scans
+        if len(parts) == 7 and parts[6] == 'scans':
+            return self.send_result_set(request, [
+                {'ID': scan_id, 'type': scan['type'], 'xsiType': scan['xsi_type'],
+                 'URI': f'/data/experiments/{experiment_id}/scans/{scan_id}'}
+                for scan_id, scan in experiment['scans'].items()])
+
+        # .../scans/{scan},{scan}/resources/{resource}/files?format=zip (experiment archive)
+        if len(parts) == 11 and parts[10] == 'files' and query.get('format') == ['zip']:
+            return self.send_archive(request, method, project_id, subject_id, experiment_id, parts[7].split(','), parts[9])
+
+        scan_id = parts[7]
+        scan = experiment['scans'][scan_id]
+        scan_uri = f'/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}/scans/{scan_id}'
+
+        # /data/projects/{project}/subjects/{subject}/experiments/{experiment}/scans/{scan}
+        if len(parts) == 8:
+            return self.send_items(request, scan['xsi_type'], {
+                'ID': scan_id, 'type': scan['type'], 'modality': scan['modality'], 'project': project_id})
+
+        # .../scans/{scan}/resources
+        if len(parts) == 9 and parts[8] == 'resources':
+            return self.send_result_set(request, [
+                {'xnat_abstractresource_id': get_resource_id(scan_uri, label), 'label': label, 'element_name': 'xnat:resourceCatalog',
+                 'format': 'DICOM' if label == 'DICOM' else 'JSON', 'content': label,
+                 'file_count': str(len(files)), 'file_size': str(sum(os.path.getsize(x) for x in files.values() if x))}
+                for label, files in scan['resources'].items()])
+
+        # resources are addressed by label or by id
+        label = get_resource_label(scan_uri, parts[9])
+        files = scan['resources'][label]
+
+        # .../scans/{scan}/resources/{resource}
+        if len(parts) == 10:
+            return self.send_items(request, 'xnat:resourceCatalog', {
+                'xnat_abstractresource_id': get_resource_id(scan_uri, label), 'label': label, 'file_count': len(files)})
+
+        # .../scans/{scan}/resources/{resource}/files
+        if len(parts) == 11 and parts[10] == 'files':
+            return self.send_result_set(request, [
+                {'Name': name, 'Size': str(os.path.getsize(file_path)) if file_path else '0',
+                 'URI': f'{scan_uri}/resources/{parts[9]}/files/{name}',
+                 'collection': parts[9], 'file_format': 'DICOM' if parts[9] == 'DICOM' else '',
+                 'file_content': '', 'digest': ''}
+                for name, file_path in files.items()])
+
+        # .../scans/{scan}/resources/{resource}/files/{name}
+        if len(parts) == 12 and parts[10] == 'files':
+            file_path = files[parts[11]]
+            if file_path is None:
+                return self.send(request, 200, '{}')
+            return self.send_file(request, method, file_path, scan_uri)
+
+        return self.send(request, 404, f'Not found: {path}')
+
+    def get_scan(self, scan_uri):
+        parts = scan_uri.split('/')[2:]
+        return self.projects[parts[1]]['subjects'][parts[3]]['experiments'][parts[5]]['scans'][parts[7]]
+
+    # ----------------------------
+    # responses
+    # ----------------------------
+
+    def create_item(self, xsi_type, data_fields, children=None):
+        return {
+            'data_fields': data_fields,
+            'meta': {'xsi:type': xsi_type, 'isHistory': False, 'start_date': datetime.now().strftime('%a %b %d %H:%M:%S UTC %Y')},
+            'children': children if children else [],
+        }
+
+    def send_items(self, request, xsi_type, data_fields, children=None):
+        return self.send_json(request, {'items': [self.create_item(xsi_type, data_fields, children)]})
+
+    def send_result_set(self, request, results):
+        return self.send_json(request, {'ResultSet': {'Result': results, 'totalRecords': str(len(results))}})
+
+    def send_json(self, request, data):
+        return self.send(request, 200, json.dumps(data), 'application/json')
+
+    def send(self, request, status, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
+        return None
+
+    def send_file(self, request, method, file_path, scan_uri):
+        size = os.path.getsize(file_path)
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/dicom')
+        request.send_header('Content-Length', str(size))
+        request.end_headers()
+        if method == 'HEAD':
+            return None
+
+        # stream in chunks, throttled to the configured bandwidth
+        # (header-only reads close the stream early, so count what was actually sent)
+        chunk_size = 64 * 1024
+        sent = 0
+        try:
+            with open(file_path, 'rb') as file:
+                while True:
+                    chunk = file.read(chunk_size)
+                    if not chunk:
+                        break
+                    request.wfile.write(chunk)
+                    sent += len(chunk)
+                    if self.bandwidth:
+                        time.sleep(len(chunk) / self.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            request.close_connection = True
+        finally:
+            with self.lock:
+                self.bytes_sent += sent
+                self.scan_bytes_sent[scan_uri] = self.scan_bytes_sent.get(scan_uri, 0) + sent
+
+        return None
+
+    def send_archive(self, request, method, project_id, subject_id, experiment_id, scan_ids, resource):
+        experiment = self.projects[project_id]['subjects'][subject_id]['experiments'][experiment_id]
+        scans = {scan_id: experiment['scans'][scan_id] for scan_id in scan_ids}
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/zip')
+        request.send_header('Transfer-Encoding', 'chunked')
+        request.end_headers()
+        if method == 'HEAD':
+            return None
+
+        # <experiment label>/scans/<scan id>-<scan type>/resources/<resource>/files/<name>, like XNAT
+        stream = chunked_stream(self, request, f'/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}')
+        try:
+            with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+                for scan_id, scan in scans.items():
+                    for name, file_path in scan['resources'].get(resource, {}).items():
+                        if file_path is None:
+                            continue
+                        with open(file_path, 'rb') as source, archive.open(f'{experiment["label"]}/scans/{scan_id}-{scan["type"]}/resources/{resource}/files/{name}', 'w') as target:
+                            while True:
+                                chunk = source.read(64 * 1024)
+                                if not chunk:
+                                    break
+                                target.write(chunk)
+            request.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            request.close_connection = True
+
+        return None
+
+# ----------------------------
+# archive stream (chunked, written by zipfile to a non-seekable stream like a
+# server building the zip on the fly, so entries carry data descriptors)
+# ----------------------------
+
+class chunked_stream(object):
+
+    def __init__(self, mock, request, scan_uri):
+        self.mock = mock
+        self.request = request
+        self.scan_uri = scan_uri
+
+    def write(self, data):
+        if data:
+            self.request.wfile.write(f'{len(data):X}\r\n'.encode() + bytes(data) + b'\r\n')
+            if self.mock.bandwidth:
+                time.sleep(len(data) / self.mock.bandwidth)
+            with self.mock.lock:
+                self.mock.bytes_sent += len(data)
+                self.mock.scan_bytes_sent[self.scan_uri] = self.mock.scan_bytes_sent.get(self.scan_uri, 0) + len(data)
+        return len(data)
+
+    def flush(self):
+        return None
+
+# ----------------------------
+# resource ids
+# ----------------------------
+# unique per scan like on a real server (xnat-py caches resource objects by id)
+# ----------------------------
+
+def get_resource_id(scan_uri, label):
+    return f'{zlib.crc32(scan_uri.encode())}_{label}'
+
+def get_resource_label(scan_uri, resource):
+    prefix = f'{zlib.crc32(scan_uri.encode())}_'
+    return resource[len(prefix):] if resource.startswith(prefix) else resource
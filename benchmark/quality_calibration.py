@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import argparse
+import pandas as pd
+import pydicom as dicom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.metric_helper import METRICS, score_frame
+
+# ----------------------------
+# quality calibration
+# ----------------------------
+# scores a sample of DICOM instances per modality at full resolution and at each
+# downsample size, and reports how far the downsampled scores are from the full
+# resolution ones (mean and max absolute difference, pearson and rank correlation)
+# and the speedup; the recommended size of a modality is the smallest one from
+# which every larger size keeps the rank correlation with the full resolution
+# scores at -min_correlation or above for every metric (set it as
+# quality_downsample in the config file)
+#
+# python -m benchmark.quality_calibration -dicom_path /data/mg_sample -sizes 512 1024 2048
+# python -m benchmark.quality_calibration -dicom_path /data/sample -metric piqe -metric sharpness -output calibration.json
+# ----------------------------
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description=("Quality metric downsample calibration"))
+    parser.add_argument("-dicom_path", "--dicom_path", required=True)
+    parser.add_argument("-sizes", "--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("-metric", "--metric", action="append", choices=sorted(METRICS))
+    parser.add_argument("-modality", "--modality", action="append")
+    parser.add_argument("-samples", "--samples", type=int, default=20)
+    parser.add_argument("-min_correlation", "--min_correlation", type=float, default=0.95)
+    parser.add_argument("-output", "--output")
+
+    return parser.parse_args(argv)
+
+
+# ----------------------------
+# sample (up to -samples instances per modality, the middle frame of multi-frame instances)
+# ----------------------------
+
+def get_sample_frames(dicom_path, modalities, samples):
+
+    sample = {}
+    for root, _, files in os.walk(dicom_path):
+        for file_name in sorted(files):
+            try:
+                dataset = dicom.dcmread(os.path.join(root, file_name))
+                modality = dataset.get('Modality')
+                if (modalities and modality not in modalities) or len(sample.get(modality, [])) >= samples or 'PixelData' not in dataset:
+                    continue
+                pixel_array = dataset.pixel_array
+            except Exception:
+                continue
+            frame = pixel_array[len(pixel_array) // 2] if int(dataset.get('NumberOfFrames', 1) or 1) > 1 else pixel_array
+            if frame.ndim != 2:
+                continue
+            sample.setdefault(modality, []).append(frame)
+
+    return sample
+
+
+# ----------------------------
+# calibrate one modality
+# ----------------------------
+
+def calibrate_modality(frames, sizes, metric_names, min_correlation):
+
+    full_times = {}
+    full_start = time.perf_counter()
+    full_scores = [score_frame(frame, {'metrics': metric_names}, full_times) for frame in frames]
+    full_time = time.perf_counter() - full_start
+
+    report = {
+        'instances': len(frames),
+        'shape': list(max((frame.shape for frame in frames), key=lambda shape: shape[0] * shape[1])),
+        'full_ms_per_frame': 1000 * full_time / len(frames),
+        'sizes': {},
+        'recommended_size': None,
+    }
+
+    largest_side = max(report['shape'])
+    for size in sorted(sizes, reverse=True):
+        size_times = {}
+        size_start = time.perf_counter()
+        size_scores = [score_frame(frame, {'metrics': metric_names, 'downsample_size': size}, size_times) for frame in frames]
+        size_time = time.perf_counter() - size_start
+
+        size_report = {'ms_per_frame': 1000 * size_time / len(frames), 'speedup': full_time / size_time if size_time else None, 'metrics': {}}
+        for name in metric_names:
+            key = f'{name}_score'
+            scores = pd.DataFrame({'full': [score[key] for score in full_scores], 'downsampled': [score[key] for score in size_scores]}).dropna()
+            differences = (scores['downsampled'] - scores['full']).abs()
+            size_report['metrics'][name] = {
+                'instances': len(scores),
+                'full_mean': scores['full'].mean() if len(scores) else None,
+                'downsampled_mean': scores['downsampled'].mean() if len(scores) else None,
+                'mean_abs_difference': differences.mean() if len(scores) else None,
+                'max_abs_difference': differences.max() if len(scores) else None,
+                'pearson': get_correlation(scores, 'pearson'),
+                'spearman': get_correlation(scores, 'spearman'),
+            }
+        report['sizes'][size] = size_report
+
+    # sizes at or above the largest side score at full resolution and are not recommended
+    for size, size_report in report['sizes'].items():
+        if not all((metric['spearman'] or 0) >= min_correlation for metric in size_report['metrics'].values()):
+            break
+        if size < largest_side:
+            report['recommended_size'] = size
+
+    return report
+
+
+# correlation with the full resolution scores (None for fewer than 3 instances or constant scores)
+def get_correlation(scores, method):
+    if len(scores) < 3 or scores['full'].nunique() < 2 or scores['downsampled'].nunique() < 2:
+        return None
+    # rank correlation as the pearson correlation of the ranks (spearman in pandas needs scipy)
+    if method == 'spearman':
+        scores = scores.rank()
+    return float(scores['full'].corr(scores['downsampled']))
+
+
+def print_report(modality, report):
+
+    print(f'\n{modality} - instances: {report["instances"]} | largest: {report["shape"][0]}x{report["shape"][1]} | full resolution: {report["full_ms_per_frame"]:.1f} ms/frame')
+    print(f'  {"size":>6} {"metric":<10} {"ms/frame":>9} {"speedup":>8} {"full":>9} {"down":>9} {"mean_abs":>9} {"max_abs":>9} {"pearson":>8} {"spearman":>8}')
+    for size, size_report in sorted(report['sizes'].items()):
+        for name, metric in size_report['metrics'].items():
+            values = [metric['full_mean'], metric['downsampled_mean'], metric['mean_abs_difference'], metric['max_abs_difference']]
+            print(f'  {size:>6} {name:<10} {size_report["ms_per_frame"]:>9.1f} {size_report["speedup"] or 0:>7.1f}x '
+                  + ' '.join(f'{value:>9.3f}' if value is not None else f'{"-":>9}' for value in values)
+                  + ' ' + ' '.join(f'{metric[method]:>8.3f}' if metric[method] is not None else f'{"-":>8}' for method in ['pearson', 'spearman']))
+    print(f'  recommended size: {report["recommended_size"] or "full resolution"}')
+
+    return None
+
+
+def main(argv):
+
+    options = parse_args(argv)
+    metric_names = options.metric or ['piqe']
+
+    sample = get_sample_frames(options.dicom_path, options.modality, options.samples)
+    if not sample:
+        print(f'No DICOM instances with pixel data found in {options.dicom_path}')
+        return None
+
+    reports = {}
+    for modality, frames in sorted(sample.items()):
+        reports[modality] = calibrate_modality(frames, options.sizes, metric_names, options.min_correlation)
+        print_report(modality, reports[modality])
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(reports, file, indent=2)
+        print(f'\nReport: {options.output}')
+
+    return None
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
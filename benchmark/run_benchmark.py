@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import resource
+import argparse
+import multiprocessing
+import concurrent.futures as futures
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.synthetic_dicom import synthetic_dicom
+from benchmark.mock_xnat import mock_xnat
+
+# ----------------------------
+# benchmark
+# ----------------------------
+# runs scripted scenarios against a local mock XNAT server and reports
+# scans/min, bytes/scan, peak RSS and per-stage times against a stored baseline
+#
+# python -m benchmark.run_benchmark -work_path /tmp/bench
+# python -m benchmark.run_benchmark -work_path /tmp/bench -scenario ct_uncompressed -update_baseline
+# ----------------------------
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# metrics where a higher value is better (all others are lower-is-better)
+HIGHER_IS_BETTER = ['scans_per_min']
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description=("Preprocessing benchmark"))
+    parser.add_argument("-work_path", "--work_path", default=os.path.join(BENCHMARK_PATH, "work"))
+    parser.add_argument("-scenarios_path", "--scenarios_path", default=os.path.join(BENCHMARK_PATH, "scenarios.json"))
+    parser.add_argument("-baseline_path", "--baseline_path", default=os.path.join(BENCHMARK_PATH, "baseline.json"))
+    parser.add_argument("-scenario", "--scenario", action="append")
+    parser.add_argument("-tolerance", "--tolerance", type=float, default=0.2)
+    parser.add_argument("-log_level", "--log_level", default="warning")
+    parser.add_argument("-update_baseline", "--update_baseline", action="store_true")
+
+    return parser.parse_args(argv)
+
+# ----------------------------
+# synthetic data
+# ----------------------------
+
+def generate_series(work_path, scenario):
+
+    generator = synthetic_dicom(scenario['seed'])
+    series_list = []
+
+    for series_index, series in enumerate(scenario['series']):
+        # cache generated series by specification
+        series_key = hashlib.md5(json.dumps([series, scenario['seed']], sort_keys=True).encode()).hexdigest()[:12]
+        for scan_index in range(series['scans']):
+            series_path = os.path.join(work_path, "series", f"{series['modality']}_{series_key}", f"{scan_index:03d}")
+            if os.path.exists(series_path):
+                file_paths = sorted(os.path.join(series_path, x) for x in os.listdir(series_path))
+            else:
+                file_paths = generator.create_series(
+                    f'{series_path}.tmp',
+                    series['modality'],
+                    series['instances'],
+                    num_frames=series.get('frames', 1),
+                    image_size=series.get('image_size'),
+                    transfer_syntax=series.get('transfer_syntax', 'explicit'),
+                    num_scouts=series.get('scouts', 0),
+                    patient_id=f'SUBJ{series_index:03d}')
+                os.rename(f'{series_path}.tmp', series_path)
+                file_paths = sorted(os.path.join(series_path, os.path.basename(x)) for x in file_paths)
+
+            series_list.append({
+                'subject_id': f'SUBJ{series_index:03d}',
+                # session - the scans of the series are series of one experiment
+                'experiment_id': f'EXP{series_index:03d}' if series.get('session') else f'EXP{series_index:03d}_{scan_index:03d}',
+                'scan_id': str(scan_index + 1),
+                'modality': series['modality'],
+                'scan_type': series.get('transfer_syntax', 'explicit'),
+                'file_paths': file_paths,
+            })
+
+    return series_list
+
+# ----------------------------
+# scenario
+# ----------------------------
+
+def run_scenario(work_path, scenario, log_level):
+
+    scenario_path = os.path.join(work_path, "scenarios", scenario['name'])
+    if os.path.exists(scenario_path):
+        shutil.rmtree(scenario_path)
+    os.makedirs(scenario_path)
+
+    series_list = generate_series(work_path, scenario)
+
+    server = mock_xnat(latency=scenario['latency'], bandwidth=scenario['bandwidth'])
+    for series in series_list:
+        server.add_scan('BENCH', series['subject_id'], series['experiment_id'], series['scan_id'],
+                        series['modality'], series['scan_type'], series['file_paths'])
+    server.start()
+
+    # same configuration format as run.py
+    config = {
+        "xnat_server": server.url,
+        "xnat_user": server.user,
+        "xnat_password": server.password,
+        "xnat_projects": ["BENCH"],
+        "preprocess_functions": ["quality_functions"],
+        "data_path": scenario_path,
+        "log_level": log_level,
+        "index": True,
+        "reset": True,
+        "multi_proc": scenario['multi_proc'],
+        "multi_proc_cpu": scenario['multi_proc_cpu'],
+        "multi_thread": scenario['multi_thread'],
+        "multi_thread_workers": scenario['multi_thread_workers'],
+    }
+    config.update(scenario.get('config', {}))
+    config_path = os.path.join(scenario_path, "config.json")
+    with open(config_path, 'w') as file:
+        json.dump(config, file, indent=2)
+
+    # run the pipeline in a fresh process so peak RSS only covers the pipeline (started from
+    # the fork server, a process started by the benchmark keeps the RSS of its generated series)
+    try:
+        with futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('forkserver')) as executor:
+            result = executor.submit(run_pipeline, config_path).result()
+    finally:
+        server.stop()
+
+    scans = max(len(result['scans']), 1)
+    file_bytes = sum(server.scan_bytes_sent.values())
+
+    stage_times = {}
+    for scan in result['scans']:
+        for stage, stage_time in scan['stage_times'].items():
+            stage_times[stage] = stage_times.get(stage, 0.0) + stage_time
+
+    metrics = {
+        'scans': len(result['scans']),
+        'files': sum(scan['counters'].get('files', 0) for scan in result['scans']),
+        'index_time': result['index_time'],
+        'quality_time': result['quality_time'],
+        'scans_per_min': len(result['scans']) / (result['quality_time'] / 60) if result['quality_time'] else 0.0,
+        'bytes_per_scan': file_bytes / scans,
+        'requests_per_scan': server.request_count / scans,
+        'peak_rss_mb': result['peak_rss_mb'],
+        'peak_worker_rss_mb': result['peak_worker_rss_mb'],
+    }
+    for stage, stage_time in sorted(stage_times.items()):
+        metrics[f'stage_{stage}_time'] = stage_time / scans
+
+    # decode time per frame for each transfer syntax
+    decode = {}
+    for scan in result['scans']:
+        for name, statistics in (scan.get('decode') or {}).items():
+            seconds, frames = decode.get(name, (0.0, 0))
+            decode[name] = (seconds + statistics['seconds'], frames + statistics['frames'])
+    for name, (seconds, frames) in sorted(decode.items()):
+        metrics[f'decode_{name}_ms_per_frame'] = 1000 * seconds / max(frames, 1)
+
+    # download latency (per DICOM file read)
+    download_requests = sum((scan.get('downloads') or {}).get('requests', 0) for scan in result['scans'])
+    if download_requests:
+        metrics['download_ms_per_request'] = 1000 * sum((scan.get('downloads') or {}).get('seconds', 0.0) for scan in result['scans']) / download_requests
+
+    # scoring time per frame for each quality metric (shared intermediates under metric_shared)
+    scored_frames = sum(scan['counters'].get('scored_frames', 0) for scan in result['scans'])
+    metric_times = {}
+    for scan in result['scans']:
+        for name, seconds in (scan.get('quality_metrics') or {}).items():
+            metric_times[name] = metric_times.get(name, 0.0) + seconds
+    for name, seconds in sorted(metric_times.items()):
+        metrics[f'metric_{name}_ms_per_frame'] = 1000 * seconds / max(scored_frames, 1)
+
+    return metrics
+
+
+def run_pipeline(config_path):
+
+    import run
+    from modules.arg_helper import arg_helper
+    from modules.log_helper import log_helper
+    from modules.xnat_tools import xnat_tools
+    from modules.db_tools import db_tools
+    from modules.quality_tools import quality_tools
+
+    args = arg_helper(['-config_path', config_path])
+    run.load_config(args)
+
+    log = log_helper(datetime.now(), "eucanimage_xnat_benchmark", args.log_path, args.log_level)
+    xtools = xnat_tools(args.xnat_server, args.xnat_user, args.xnat_password)
+    dbtools = db_tools(args.db_connect_string)
+
+    start_time = time.perf_counter()
+    xtools.index_scans(args, log, dbtools)
+    index_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    scans = quality_tools().run_quality_functions(args, log, xtools, dbtools)
+    quality_time = time.perf_counter() - start_time
+
+    # ru_maxrss is in KB on linux
+    return {
+        'index_time': index_time,
+        'quality_time': quality_time,
+        'scans': [scan for scan in scans if scan],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+# ----------------------------
+# report
+# ----------------------------
+
+def compare_baseline(results, baseline, tolerance):
+
+    regressions = []
+
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in list(metrics.items()):
+            baseline_value = baseline[name].get(metric)
+            if not baseline_value or metric in ['scans', 'files']:
+                continue
+            change = (value - baseline_value) / baseline_value
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            metrics[f'{metric}_change'] = change
+            if worse > tolerance:
+                regressions.append(f'{name}: {metric} {baseline_value:.3f} -> {value:.3f} ({change:+.1%})')
+
+    return regressions
+
+
+def print_report(results):
+
+    for name, metrics in results.items():
+        print(f'\n{name}')
+        for metric, value in metrics.items():
+            if metric.endswith('_change'):
+                continue
+            change = metrics.get(f'{metric}_change')
+            change_text = f'  ({change:+.1%} vs baseline)' if change is not None else ''
+            print(f'  {metric:<28} {value:>14.3f}{change_text}')
+
+    return None
+
+
+def main(argv):
+
+    options = parse_args(argv)
+
+    with open(options.scenarios_path) as json_file:
+        scenario_data = json.load(json_file)
+
+    baseline = {}
+    if os.path.exists(options.baseline_path):
+        with open(options.baseline_path) as json_file:
+            baseline = json.load(json_file)
+
+    os.makedirs(options.work_path, exist_ok=True)
+
+    results = {}
+    for scenario in scenario_data['scenarios']:
+        if options.scenario and scenario['name'] not in options.scenario:
+            continue
+        scenario = {**scenario_data['defaults'], **scenario}
+        print(f'Running scenario {scenario["name"]}')
+        results[scenario['name']] = run_scenario(options.work_path, scenario, options.log_level)
+
+    if options.update_baseline:
+        baseline.update(results)
+        with open(options.baseline_path, 'w') as json_file:
+            json.dump(baseline, json_file, indent=2)
+        regressions = []
+    else:
+        regressions = compare_baseline(results, baseline, options.tolerance)
+
+    print_report(results)
+
+    report_path = os.path.join(options.work_path, f'{datetime.now().strftime("%Y%m%d%H%M%S")}-benchmark-report.json')
+    with open(report_path, 'w') as json_file:
+        json.dump({'results': results, 'regressions': regressions}, json_file, indent=2)
+    print(f'\nReport: {report_path}')
+
+    if regressions:
+        print('\nRegressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn", True)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,229 @@
+import os
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, RLELossless
+
+# ----------------------------
+# synthetic dicom
+# ----------------------------
+# generates synthetic CT, MR and MG series for benchmarking
+# (single-frame and multi-frame, compressed and uncompressed, with scouts mixed in)
+# ----------------------------
+
+class synthetic_dicom(object):
+
+    # SOP classes
+    sop_classes = {
+        'CT': '1.2.840.10008.5.1.4.1.1.2',              # CT Image Storage
+        'MR': '1.2.840.10008.5.1.4.1.1.4',              # MR Image Storage
+        'MG': '1.2.840.10008.5.1.4.1.1.1.2',            # Digital Mammography X-Ray Image Storage - For Presentation
+        'MG_MULTI': '1.2.840.10008.5.1.4.1.1.13.1.3',   # Breast Tomosynthesis Image Storage
+    }
+
+    # default image sizes (rows, columns)
+    image_sizes = {
+        'CT': (512, 512),
+        'MR': (256, 256),
+        'MG': (3328, 2560),
+    }
+
+    # transfer syntaxes (encoded with gdcm, except rle which pydicom can encode natively)
+    transfer_syntaxes = {
+        'explicit': ExplicitVRLittleEndian,
+        'rle': RLELossless,
+        'jpeg_lossless': '1.2.840.10008.1.2.4.70',
+        'jpegls': '1.2.840.10008.1.2.4.80',
+        'jpeg2000': '1.2.840.10008.1.2.4.90',
+    }
+
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+
+    # ----------------------------
+    # create series
+    # ----------------------------
+    # writes a series to series_path and returns the list of written files
+    # ----------------------------
+    def create_series(self, series_path, modality, num_instances, num_frames=1, image_size=None,
+                      transfer_syntax='explicit', num_scouts=0, study_uid=None, patient_id='BENCH'):
+
+        os.makedirs(series_path, exist_ok=True)
+
+        rows, columns = image_size if image_size else self.image_sizes[modality]
+        study_uid = study_uid if study_uid else generate_uid()
+        series_uid = generate_uid()
+        frame_of_reference_uid = generate_uid()
+
+        # mix scouts in at the start and at random positions within the series
+        scout_positions = set(range(min(num_scouts, 1)))
+        if num_scouts > 1:
+            scout_positions.update(self.rng.choice(range(1, num_instances + num_scouts), num_scouts - 1, replace=False).tolist())
+
+        written_files = []
+        slice_index = 0
+        for instance_number in range(1, num_instances + num_scouts + 1):
+            is_scout = (instance_number - 1) in scout_positions
+            dataset = self.create_dataset(modality, rows, columns, num_frames, is_scout, slice_index,
+                                          study_uid, series_uid, frame_of_reference_uid, patient_id)
+            dataset.InstanceNumber = instance_number
+            if not is_scout:
+                slice_index += 1
+
+            file_path = os.path.join(series_path, f'{instance_number:05d}.dcm')
+            self.write_dataset(dataset, file_path, transfer_syntax)
+            written_files.append(file_path)
+
+        return written_files
+
+    # ----------------------------
+    # create dataset
+    # ----------------------------
+    def create_dataset(self, modality, rows, columns, num_frames, is_scout, slice_index,
+                       study_uid, series_uid, frame_of_reference_uid, patient_id):
+
+        sop_class = self.sop_classes['MG_MULTI'] if modality == 'MG' and num_frames > 1 else self.sop_classes[modality]
+        sop_instance_uid = generate_uid()
+
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = sop_class
+        file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        dataset = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+
+        dataset.SOPClassUID = sop_class
+        dataset.SOPInstanceUID = sop_instance_uid
+        dataset.StudyInstanceUID = study_uid
+        dataset.SeriesInstanceUID = series_uid
+        dataset.FrameOfReferenceUID = frame_of_reference_uid
+        dataset.PatientID = patient_id
+        dataset.PatientName = patient_id
+        dataset.Modality = modality
+        dataset.Manufacturer = 'SYNTHETIC'
+        dataset.ManufacturerModelName = 'BENCHMARK'
+        dataset.AcquisitionTime = f'{120000 + slice_index:06d}'
+
+        if is_scout:
+            dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'LOCALIZER']
+            dataset.SeriesDescription = 'Scout'
+        else:
+            dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'AXIAL']
+            dataset.SeriesDescription = f'Synthetic {modality}'
+
+        dataset.SliceThickness = '1.0'
+        dataset.PixelSpacing = ['0.7', '0.7']
+        dataset.ImagePositionPatient = ['0', '0', str(float(slice_index))]
+        dataset.ImageOrientationPatient = ['1', '0', '0', '0', '1', '0']
+        dataset.SliceLocation = str(float(slice_index))
+
+        # modality specific acquisition tags
+        if modality == 'CT':
+            dataset.KVP = '120'
+            dataset.XRayTubeCurrentInmA = 200.0
+            dataset.ExposureTime = '500'
+            dataset.ConvolutionKernel = 'STANDARD'
+            dataset.RescaleIntercept = '-1024'
+            dataset.RescaleSlope = '1'
+        elif modality == 'MR':
+            dataset.ScanningSequence = 'SE'
+            dataset.SequenceVariant = 'NONE'
+            dataset.SequenceName = 'se2d1'
+            dataset.RepetitionTime = '500'
+            dataset.EchoTime = '15'
+            dataset.MagneticFieldStrength = '1.5'
+            dataset.FlipAngle = '90'
+        elif modality == 'MG':
+            dataset.KVP = '29'
+            dataset.BodyPartThickness = '50'
+            dataset.CompressionForce = '100'
+            dataset.ViewPosition = 'CC'
+            dataset.ImageLaterality = 'L'
+
+        # pixel data
+        pixel_array = np.stack([self.create_image(rows, columns, modality) for i in range(num_frames)])
+        if num_frames == 1:
+            pixel_array = pixel_array[0]
+        else:
+            dataset.NumberOfFrames = num_frames
+
+        dataset.Rows = rows
+        dataset.Columns = columns
+        dataset.SamplesPerPixel = 1
+        dataset.PhotometricInterpretation = 'MONOCHROME2'
+        dataset.BitsAllocated = 16
+        dataset.BitsStored = 12 if modality != 'CT' else 16
+        dataset.HighBit = dataset.BitsStored - 1
+        dataset.PixelRepresentation = 1 if modality == 'CT' else 0
+        dataset.PixelData = pixel_array.astype(np.int16 if modality == 'CT' else np.uint16).tobytes()
+
+        return dataset
+
+    # ----------------------------
+    # create image
+    # ----------------------------
+    # smooth phantom (ellipse with gradient) plus gaussian noise, so PIQE has structure to score
+    # ----------------------------
+    def create_image(self, rows, columns, modality):
+
+        y, x = np.ogrid[-1:1:rows * 1j, -1:1:columns * 1j]
+        radius = (x / 0.8) ** 2 + (y / 0.65) ** 2
+        phantom = np.where(radius < 1, 1.0 - 0.5 * radius, 0.0)
+
+        if modality == 'CT':
+            image = phantom * 1200 + self.rng.normal(0, 20, (rows, columns))
+        else:
+            image = phantom * 3000 + self.rng.normal(0, 40, (rows, columns))
+            image = np.clip(image, 0, 4095)
+
+        return image
+
+    # ----------------------------
+    # write dataset
+    # ----------------------------
+    def write_dataset(self, dataset, file_path, transfer_syntax):
+
+        if transfer_syntax == 'explicit':
+            dataset.save_as(file_path, write_like_original=False)
+        elif transfer_syntax == 'rle':
+            dataset.compress(RLELossless)
+            dataset.save_as(file_path, write_like_original=False)
+        else:
+            # encode with gdcm (not available in pydicom 2.x)
+            temp_path = f'{file_path}.tmp'
+            dataset.save_as(temp_path, write_like_original=False)
+            self.gdcm_compress(temp_path, file_path, transfer_syntax)
+            os.remove(temp_path)
+
+        return None
+
+    def gdcm_compress(self, in_path, out_path, transfer_syntax):
+
+        import gdcm
+
+        gdcm_syntaxes = {
+            'jpeg_lossless': gdcm.TransferSyntax.JPEGLosslessProcess14_1,
+            'jpegls': gdcm.TransferSyntax.JPEGLSLossless,
+            'jpeg2000': gdcm.TransferSyntax.JPEG2000Lossless,
+        }
+
+        reader = gdcm.ImageReader()
+        reader.SetFileName(in_path)
+        if not reader.Read():
+            raise Exception(f'gdcm could not read {in_path}')
+
+        change = gdcm.ImageChangeTransferSyntax()
+        change.SetTransferSyntax(gdcm.TransferSyntax(gdcm_syntaxes[transfer_syntax]))
+        change.SetInput(reader.GetImage())
+        if not change.Change():
+            raise Exception(f'gdcm could not compress {in_path} to {transfer_syntax}')
+
+        writer = gdcm.ImageWriter()
+        writer.SetFileName(out_path)
+        writer.SetFile(reader.GetFile())
+        writer.SetImage(change.GetOutput())
+        if not writer.Write():
+            raise Exception(f'gdcm could not write {out_path}')
+
+        return None
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+import concurrent.futures as futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.worker_helper import WORKER_STAGES, START_METHODS, get_stage_tools, get_worker_context
+
+# ----------------------------
+# worker startup benchmark
+# ----------------------------
+# starts a scan worker pool per stage and start method and reports the pool
+# spin-up time and, per worker, the stage import time and RSS
+#
+# python -m benchmark.worker_startup -workers 8
+# python -m benchmark.worker_startup -workers 8 -stage quality_functions -start_method forkserver
+# ----------------------------
+
+# keeps each probe busy long enough for the pool to start a process per probe
+PROBE_HOLD = 0.5
+
+
+def parse_args(argv):
+
+    parser = argparse.ArgumentParser(description=("Worker startup benchmark"))
+    parser.add_argument("-workers", "--workers", type=int, default=4)
+    parser.add_argument("-stage", "--stage", action="append", choices=list(WORKER_STAGES))
+    parser.add_argument("-start_method", "--start_method", action="append", choices=START_METHODS)
+
+    return parser.parse_args(argv)
+
+
+def get_rss_mb():
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def probe_worker(stage):
+
+    bootstrap_rss = get_rss_mb()
+    bootstrap_modules = len(sys.modules)
+
+    start_time = time.perf_counter()
+    get_stage_tools(stage)
+    import_time = time.perf_counter() - start_time
+
+    time.sleep(PROBE_HOLD)
+
+    return {
+        'pid': os.getpid(),
+        'import_time': import_time,
+        'bootstrap_rss_mb': bootstrap_rss,
+        'rss_mb': get_rss_mb(),
+        'bootstrap_modules': bootstrap_modules,
+        'modules': len(sys.modules),
+    }
+
+
+def run_startup(stage, start_method, workers):
+
+    args = {'multi_proc_start_method': start_method, 'preprocess_functions': [stage]}
+
+    start_time = time.perf_counter()
+    with futures.ProcessPoolExecutor(max_workers=workers, mp_context=get_worker_context(args)) as executor:
+        probes = list(executor.map(probe_worker, [stage] * workers))
+        spin_up_time = time.perf_counter() - start_time
+
+    # one probe per worker process
+    probes = list({probe['pid']: probe for probe in probes}.values())
+
+    return {
+        'workers': len(probes),
+        'spin_up_time': spin_up_time - PROBE_HOLD,
+        'import_time_mean': sum(probe['import_time'] for probe in probes) / len(probes),
+        'import_time_max': max(probe['import_time'] for probe in probes),
+        'bootstrap_rss_mb': sum(probe['bootstrap_rss_mb'] for probe in probes) / len(probes),
+        'rss_mb_mean': sum(probe['rss_mb'] for probe in probes) / len(probes),
+        'rss_mb_total': sum(probe['rss_mb'] for probe in probes),
+        'bootstrap_modules': max(probe['bootstrap_modules'] for probe in probes),
+        'modules': max(probe['modules'] for probe in probes),
+    }
+
+
+def main(argv):
+
+    options = parse_args(argv)
+
+    for stage in options.stage or list(WORKER_STAGES):
+        for start_method in options.start_method or START_METHODS:
+            print(f'\n{stage} ({start_method})')
+            for metric, value in run_startup(stage, start_method, options.workers).items():
+                print(f'  {metric:<20} {value:>10.3f}')
+
+    return None
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn", True)
+    main(sys.argv[1:])
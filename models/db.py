@@ -10,24 +10,64 @@ from sqlalchemy import MetaData, Table, Column, ForeignKey, Index
 from sqlalchemy import select, insert, update, delete, text
 from sqlalchemy import TEXT, NUMERIC, INTEGER, REAL, BOOLEAN, DATETIME, DATE, TIME, JSON, BLOB
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.types import Integer
 from sqlalchemy.orm import sessionmaker
 
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
+import os
+import io
+import math
+import threading
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
 Base = declarative_base()
 
+# -------------------
+# connection (db_connect_string in the config file)
+# -------------------
+# SQLite by default; with PostgreSQL (postgresql+psycopg2://...) several hosts
+# share one index and results store: row inserts (insert_dicts, insert_dataframe,
+# insert_rows) of COPY_MIN_ROWS rows or more are loaded with COPY, while ORM
+# objects (insert_list) are always added to the session; large listings are
+# read through server-side cursors STREAM_ROWS rows at a time, and the engine
+# (connection pool) and the schema check are kept per process instead of per scan
+# -------------------
+
+COPY_MIN_ROWS = 100
+STREAM_ROWS = 10000
+
+# (process, connect string) -> engine, schema checked
+_engines = {}
+_prepared = set()
+_engines_lock = threading.Lock()
+
+def get_engine(db_connect_string):
+
+    # a forked process does not share the connections of its parent
+    key = (os.getpid(), db_connect_string)
+    with _engines_lock:
+        if key not in _engines:
+            options = {'pool_pre_ping': True} if db_connect_string.startswith('postgresql') else {}
+            _engines[key] = create_engine(db_connect_string, echo=False, **options)
+
+        return _engines[key]
+
 class db(object):
 
     # Initialize
     def __init__(self, db_connect_string):
 
-        self.engine = create_engine(db_connect_string, echo=False)
+        self.engine = get_engine(db_connect_string)
         self.session_maker = sessionmaker(bind = self.engine)
+        # COPY needs the psycopg2 cursor (copy_expert)
+        self.copy = self.engine.dialect.name == 'postgresql' and self.engine.dialect.driver == 'psycopg2'
+        # reflected tables not declared in Base
+        self.tables = {}
 
         return None
 
@@ -46,6 +86,36 @@ class db(object):
 
         return None
     
+    # Prepare Database (create and upgrade once per process)
+    def prepare_database(self):
+
+        key = (os.getpid(), str(self.engine.url))
+        with _engines_lock:
+            if key in _prepared:
+                return None
+            self.create_database(True)
+            self.upgrade_database()
+            _prepared.add(key)
+
+        return None
+
+    # Upgrade Database (adds columns missing from tables created by an earlier version)
+    def upgrade_database(self):
+
+        inspector = inspect(self.engine)
+
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                if not inspector.has_table(table.name):
+                    continue
+                existing_columns = [column['name'] for column in inspector.get_columns(table.name)]
+                for column in table.columns:
+                    if column.name not in existing_columns:
+                        column_type = column.type.compile(dialect=self.engine.dialect)
+                        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+        return None
+
     # Drop Database
     def drop_database(self, check):
 
@@ -98,15 +168,19 @@ class db(object):
         return self.session_maker()
 
     # Query
-    def query(self, session=None, table=None, query_text=None, return_df=False):
+    def query(self, session=None, table=None, query_text=None, return_df=False, params=None):
+        # the :name parameters of query_text take the values of params
+        statement = text(query_text).bindparams(**(params or {})) if query_text is not None else None
         if return_df:
             #query = session.query(text(query_text))
-            result_df = pd.read_sql(query_text, session.bind)
+            # server-side cursor (PostgreSQL), read in chunks
+            with self.engine.connect().execution_options(stream_results=True) as connection:
+                result_df = pd.concat(pd.read_sql(statement, connection, chunksize=STREAM_ROWS), ignore_index=True)
             return result_df
         else:
             if session:
                 if not query_text == None:
-                    result = session.query(table).from_statement(text(query_text)).all()
+                    result = session.query(table).from_statement(statement).all()
                 else:
                     result = session.query(table).all()
                 return result
@@ -115,12 +189,10 @@ class db(object):
     def insert_dataframe(self, session, table_name, data_df):
 
         data_dict = data_df.to_dict(orient='records')
-        metadata = MetaData(bind=self.engine)
-        metadata.reflect()
-        table = Table(table_name, metadata, autoload_with=self.engine)
+        table = self.get_table(table_name)
 
         try:
-            session.execute(table.insert(), data_dict)
+            self.insert_rows(session, table, data_dict)
         except:
             session.rollback()
             raise
@@ -138,14 +210,11 @@ class db(object):
         elif isinstance(data_dict, list):
             data_dicts = data_dict
 
-        # Load the metadata and reflect to get table details
-        metadata = MetaData(bind=self.engine)
-        metadata.reflect()
-        table = Table(table_name, metadata, autoload=True)
+        table = self.get_table(table_name)
 
         try:
             # Insert data
-            session.execute(table.insert(), data_dicts)
+            self.insert_rows(session, table, data_dicts)
         except Exception as e:
             session.rollback()
             raise e
@@ -157,6 +226,7 @@ class db(object):
     # Insert List
     def insert_list(self, session, insert_list):
 
+        # added to the session (keys assigned, in the identity map); rows for COPY go through insert_dicts
         try:
             session.add_all(insert_list)
         except:
@@ -167,6 +237,56 @@ class db(object):
 
         return None
 
+    # Table (declared in Base, reflected once otherwise)
+    def get_table(self, table_name):
+
+        if table_name in Base.metadata.tables:
+            return Base.metadata.tables[table_name]
+        if table_name not in self.tables:
+            self.tables[table_name] = Table(table_name, MetaData(), autoload_with=self.engine)
+
+        return self.tables[table_name]
+
+    # Insert Rows (in the transaction of the session, COPY for many rows on PostgreSQL)
+    def insert_rows(self, session, table, rows):
+
+        if not rows:
+            return None
+        if not self.copy or len(rows) < COPY_MIN_ROWS:
+            session.execute(table.insert(), rows)
+            return None
+
+        # columns given by the rows (an autoincrement key left out takes its default)
+        columns = [column for column in table.columns if any(row.get(column.name) is not None for row in rows)]
+        integer_columns = [isinstance(column.type, Integer) for column in columns]
+
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(','.join(get_copy_value(row.get(column.name), integer) for column, integer in zip(columns, integer_columns)))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY {table.name} ({", ".join(column.name for column in columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+
+        return None
+
+# csv field of COPY (unquoted empty is NULL, everything else quoted); integer columns
+# take booleans as 1 and 0 and whole floats as integers (DataFrame columns with NaN)
+def get_copy_value(value, integer=False):
+
+    if value is None or (isinstance(value, (float, np.floating)) and math.isnan(value)):
+        return ''
+    if integer and isinstance(value, (bool, np.bool_)):
+        value = int(value)
+    elif integer and isinstance(value, (float, np.floating)) and float(value).is_integer():
+        value = int(value)
+
+    return '"' + str(value).replace('"', '""') + '"'
+
 # -------------------
 # XNAT Data
 # -------------------
@@ -184,7 +304,103 @@ class XnatScan(Base):
     scan_modality = Column(TEXT)
     scan_type = Column(TEXT)
 
+    # size of the DICOM resource (index) and image dimensions (header pass), used for memory estimates
+    scan_file_count = Column(INTEGER)
+    scan_file_size = Column(INTEGER)
+    scan_rows = Column(INTEGER)
+    scan_columns = Column(INTEGER)
+    scan_frames = Column(INTEGER)
+
     # JSON files to be pushed back to XNAT
     scan_quality = Column(TEXT)
     scan_acquisition = Column(TEXT)
-    scan_normalization = Column(TEXT)
\ No newline at end of file
+    scan_normalization = Column(TEXT)
+class XnatFile(Base):
+    __tablename__ = 'xnat_file'
+
+    xnat_file_id = Column(INTEGER, primary_key=True, autoincrement=True)
+    xnat_scan_id = Column(INTEGER, ForeignKey('xnat_scan.xnat_scan_id'), index=True)
+    resource_label = Column(TEXT)
+    file_name = Column(TEXT)
+    file_path = Column(TEXT)
+    file_uri = Column(TEXT)
+    file_size = Column(INTEGER)
+    file_digest = Column(TEXT)
+    file_format = Column(TEXT)
+    file_content = Column(TEXT)
+
+# -------------------
+# QC Results (normalized scan_quality / scan_acquisition)
+# -------------------
+class XnatInstanceQuality(Base):
+    __tablename__ = 'xnat_instance_quality'
+
+    xnat_instance_quality_id = Column(INTEGER, primary_key=True, autoincrement=True)
+    xnat_scan_id = Column(INTEGER, ForeignKey('xnat_scan.xnat_scan_id'), index=True)
+    sop_instance_uid = Column(TEXT)
+    frame = Column(INTEGER)
+    # one column per registered quality metric (<metric>_score, see metric_helper)
+    piqe_score = Column(REAL)
+    snr_score = Column(REAL)
+    entropy_score = Column(REAL)
+    sharpness_score = Column(REAL)
+    contrast_score = Column(REAL)
+
+class XnatScanAcquisition(Base):
+    __tablename__ = 'xnat_scan_acquisition'
+
+    xnat_scan_acquisition_id = Column(INTEGER, primary_key=True, autoincrement=True)
+    xnat_scan_id = Column(INTEGER, ForeignKey('xnat_scan.xnat_scan_id'), index=True)
+
+    # all
+    study_instance_uid = Column(TEXT)
+    series_instance_uid = Column(TEXT)
+    manufacturer = Column(TEXT)
+    modality = Column(TEXT)
+    image_type = Column(TEXT)
+    slice_thickness = Column(REAL)
+    spacing_between_slices = Column(REAL)
+    image_position_patient = Column(TEXT)
+    image_orientation_patient = Column(TEXT)
+    pixel_spacing = Column(TEXT)
+
+    # mr
+    contrast_bolus_agent = Column(TEXT)
+    scanning_sequence = Column(TEXT)
+    sequence_variant = Column(TEXT)
+    scan_options = Column(TEXT)
+    mr_acquisition_type = Column(TEXT)
+    sequence_name = Column(TEXT)
+    repetition_time = Column(REAL)
+    echo_time = Column(REAL)
+    magnetic_field_strength = Column(REAL)
+    echo_train_length = Column(INTEGER)
+    flip_angle = Column(REAL)
+    contrast_bolus_usage_sequence = Column(TEXT)
+    contrast_bolus_agent_phase = Column(TEXT)
+
+    # ct & mg
+    kvp = Column(REAL)
+    focal_spots = Column(TEXT)
+    distance_source_to_detector = Column(REAL)
+    distance_source_to_patient = Column(REAL)
+    exposure_time = Column(REAL)
+    x_ray_tube_current_in_ma = Column(REAL)
+    exposure = Column(REAL)
+    filter_type = Column(TEXT)
+
+    # ct
+    gantry_detector_tilt = Column(REAL)
+    table_height = Column(REAL)
+    convolution_kernel = Column(TEXT)
+    spiral_pitch_factor = Column(REAL)
+
+    # mg
+    body_part_thickness = Column(REAL)
+    compression_force = Column(REAL)
+    view_position = Column(TEXT)
+    image_laterality = Column(TEXT)
+
+    # consistency across the filtered instances (tags with more than one value joined with \)
+    instance_count = Column(INTEGER)
+    varying_tags = Column(TEXT)
@@ -0,0 +1,154 @@
+from pydicom.multival import MultiValue
+
+# series description, protocol, sequence or image type terms of scouts, localizers and b0s
+FILTER_TERMS = ['scout', 'localizer', 'b0']
+
+# sort fields in order of preference (a scan is sorted on the first one all its instances have)
+SORT_FIELDS = ['InstanceNumber', 'ImagePositionPatient', 'SliceLocation', 'AcquisitionTime', 'SOPInstanceUID']
+
+# -------------------
+# DICOM Header
+# -------------------
+# compact per-instance record kept after the header pass instead of the full
+# pydicom Dataset (file reference, sort values, filter fields, acquisition tags)
+# -------------------
+class DicomHeader(object):
+
+    __slots__ = (
+        'scan_file',
+        'sop_instance_uid',
+        'modality',
+        'sort_values',
+        'image_type',
+        'series_description',
+        'protocol_name',
+        'sequence_name',
+        'number_of_frames',
+        'rows',
+        'columns',
+        'pixel_type',
+        'acquisition',
+    )
+
+    def __init__(self, scan_file, dataset, acquisition_tags):
+
+        self.scan_file = scan_file
+        self.sop_instance_uid = str(dataset.SOPInstanceUID) if 'SOPInstanceUID' in dataset else None
+        self.modality = dataset.get('Modality', None)
+        self.sort_values = get_sort_values(dataset)
+
+        # filter fields
+        image_type = dataset.get('ImageType', [])
+        self.image_type = tuple(str(x) for x in image_type) if isinstance(image_type, MultiValue) else (str(image_type),)
+        self.series_description = get_text(dataset, 'SeriesDescription')
+        self.protocol_name = get_text(dataset, 'ProtocolName')
+        self.sequence_name = get_text(dataset, 'SequenceName')
+
+        # pixel dimensions
+        self.number_of_frames = int(dataset.get('NumberOfFrames', 1) or 1)
+        self.rows = int(dataset.get('Rows', 0) or 0)
+        self.columns = int(dataset.get('Columns', 0) or 0)
+        self.pixel_type = get_pixel_type(dataset)
+
+        # acquisition tags (MultiValue copied to lists, so nothing references the dataset)
+        self.acquisition = {}
+        for tag in acquisition_tags:
+            value = dataset.get(tag, None)
+            self.acquisition[tag] = list(value) if isinstance(value, MultiValue) else value
+
+    # ----------------------------
+    # serialize (json compatible, without the file reference)
+    # ----------------------------
+    def to_dict(self):
+
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot != 'scan_file'}
+
+    @classmethod
+    def from_dict(cls, data, scan_file=None):
+
+        header = cls.__new__(cls)
+        for slot in cls.__slots__:
+            setattr(header, slot, data.get(slot, None))
+        header.scan_file = scan_file
+        header.image_type = tuple(header.image_type or ())
+        header.sort_values = {field: tuple(value) if isinstance(value, list) else value for field, value in (header.sort_values or {}).items()}
+
+        return header
+
+    # ----------------------------
+    # sort key (None if the instance does not have the sort field)
+    # ----------------------------
+    def get_sort_key(self, sort_field):
+        return self.sort_values.get(sort_field, None)
+
+    # ----------------------------
+    # filter
+    # ----------------------------
+    # returns the tag that marks this instance as a scout/localizer/b0, or None
+    # ----------------------------
+    def get_filter_reason(self, disallowed_terms):
+
+        if any(x.lower() in disallowed_terms for x in self.image_type):
+            return 'ImageType'
+        if self.series_description is not None and any(term in self.series_description.lower() for term in disallowed_terms):
+            return 'SeriesDescription'
+        if self.protocol_name is not None and any(term in self.protocol_name.lower() for term in disallowed_terms):
+            return 'ProtocolName'
+        if self.sequence_name is not None and any(term in self.sequence_name.lower() for term in disallowed_terms):
+            return 'SequenceName'
+
+        return None
+
+# ----------------------------
+# sort values: the SORT_FIELDS the dataset has, as comparable values of one type per field
+# ----------------------------
+def get_sort_values(dataset):
+
+    sort_values = {}
+    for field in SORT_FIELDS:
+        value = dataset.get(field, None)
+        if value is None or value == '':
+            continue
+        try:
+            if field == 'InstanceNumber':
+                sort_values[field] = int(value)
+            elif field == 'ImagePositionPatient':
+                sort_values[field] = tuple(float(x) for x in value)
+            elif field == 'SliceLocation':
+                sort_values[field] = float(value)
+            else:
+                sort_values[field] = str(value)
+        except (TypeError, ValueError):
+            continue
+
+    return sort_values
+
+# ----------------------------
+# sort field of a scan: the first of SORT_FIELDS all headers have (None if there is none)
+# ----------------------------
+def get_sort_field(headers):
+
+    for field in SORT_FIELDS:
+        if all(field in header.sort_values for header in headers):
+            return field
+
+    return None
+
+# ----------------------------
+# numpy type of the stored pixel values (as decoded by pydicom, None if unknown)
+# ----------------------------
+def get_pixel_type(dataset):
+
+    bits_allocated = dataset.get('BitsAllocated', None)
+    pixel_representation = dataset.get('PixelRepresentation', None)
+    if bits_allocated is None or pixel_representation is None:
+        return None
+    if bits_allocated == 1:
+        return 'uint8'
+    if bits_allocated % 8 != 0 or bits_allocated > 64:
+        return None
+
+    return f'{"u" if pixel_representation == 0 else ""}int{bits_allocated}'
+
+def get_text(dataset, tag):
+    return str(dataset.get(tag)) if tag in dataset else None
@@ -0,0 +1,24 @@
+from collections import namedtuple
+
+# -------------------
+# Scan Key
+# -------------------
+# lightweight scan record dispatched to the workers instead of the XnatScan ORM
+# object (identifiers, plus the size and dimensions used by the memory estimates);
+# the worker loads the XnatScan by xnat_scan_id
+# -------------------
+SCAN_KEY_FIELDS = (
+    'xnat_scan_id',
+    'project_id',
+    'subject_id',
+    'experiment_id',
+    'scan_id',
+    'scan_modality',
+    'scan_file_count',
+    'scan_file_size',
+    'scan_rows',
+    'scan_columns',
+    'scan_frames',
+)
+
+ScanKey = namedtuple('ScanKey', SCAN_KEY_FIELDS)
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+
+from models.dicom_header import DicomHeader
+
+# -------------------
+# Staged Volume
+# -------------------
+# sorted, filtered slices of a scan as a memory-mapped .npy volume (frames, rows, columns)
+# in stored pixel values, with the header records, rescale and geometry per instance
+# -------------------
+class StagedVolume(object):
+
+    def __init__(self, volume_path, metadata):
+
+        self.volume_path = volume_path
+        self.metadata = metadata
+
+        # read-only memory map, slices are views into the page cache
+        self.array = np.load(os.path.join(volume_path, 'volume.npy'), mmap_mode='r')
+
+        self.instances = metadata['instances']
+        self.headers = [DicomHeader.from_dict(instance['header']) for instance in self.instances]
+        self.frame_index = {instance['header']['sop_instance_uid']: (instance['frame_start'], instance['frame_count']) for instance in self.instances}
+
+    @property
+    def modality(self):
+        return self.metadata['modality']
+
+    # spacing [slice, row, column] in mm
+    @property
+    def spacing(self):
+        return self.metadata['spacing']
+
+    @property
+    def orientation(self):
+        return self.metadata['orientation']
+
+    @property
+    def origin(self):
+        return self.metadata['origin']
+
+    # ----------------------------
+    # instance pixels (same shape as pixel_array of the instance)
+    # ----------------------------
+    def get_instance(self, sop_instance_uid):
+
+        frame_start, frame_count = self.frame_index[sop_instance_uid]
+        if frame_count == 1:
+            return self.array[frame_start]
+        return self.array[frame_start:frame_start + frame_count]
+
+    # ----------------------------
+    # rescale slope and intercept per frame (modality values = stored * slope + intercept)
+    # ----------------------------
+    def get_rescale(self):
+
+        slopes = np.ones(self.array.shape[0], dtype=np.float32)
+        intercepts = np.zeros(self.array.shape[0], dtype=np.float32)
+        for instance in self.instances:
+            frames = slice(instance['frame_start'], instance['frame_start'] + instance['frame_count'])
+            slopes[frames] = instance['rescale_slope']
+            intercepts[frames] = instance['rescale_intercept']
+
+        return slopes, intercepts
@@ -0,0 +1,378 @@
+import os
+import re
+import json
+import zlib
+import time
+import shutil
+import struct
+import zipfile
+import tempfile
+import threading
+
+from modules.stage_tools import stage_tools
+from modules.queue_helper import STAGE_RESULTS
+
+import concurrent.futures as futures
+
+# ----------------------------
+# archive helper
+# ----------------------------
+# experiment archives (experiment_archive in the config file): the DICOM of the
+# selected scans of an experiment is fetched as one zip stream
+# (.../scans/<id>,<id>/resources/DICOM/files?format=zip) and unpacked as it
+# arrives into <archive_path>/<project>/<subject>/<experiment>/<scan>, so the
+# per-file requests of the scans become one request per experiment; the scans are
+# queued for the scan workers once the archive of their experiment has landed and
+# the workers read the unpacked files (removed when the scan has been processed)
+#
+# experiments with fewer than experiment_archive_min_scans scans to process, and
+# the scans of an archive that fails, are read file by file
+# ----------------------------
+
+# written last, its presence marks the unpacked files of a scan as complete
+ARCHIVE_INDEX = 'archive.json'
+
+CHUNK_SIZE = 1024 * 1024
+# archive data kept in memory before the rest of an archive read with zipfile goes to a file
+SPOOL_SIZE = 64 * 1024 * 1024
+# bytes fed to the decompressor at a time (the data past the end of an entry is copied back)
+READ_SIZE = 64 * 1024
+
+LOCAL_HEADER = 0x04034b50
+DATA_DESCRIPTOR = 0x08074b50
+CENTRAL_DIRECTORY = 0x02014b50
+END_OF_CENTRAL_DIRECTORY = 0x06054b50
+ZIP64_EXTRA = 0x0001
+
+# <scan id>[-<scan type>]/resources/<resource>/files/<file path> within the archive
+ARCHIVE_ENTRY = re.compile(r'(?:^|/)scans/([^/]+)/resources/([^/]+)/files/(.+)$')
+
+# ----------------------------
+# queue scans (archives downloaded in the background, the other scans queued now)
+# ----------------------------
+
+def queue_archive_scans(args, log, queue, scan_keys, stages, xtools, dbtools, close=False):
+
+    groups, scans = get_archive_groups(args, dbtools, [scan for scan in scan_keys if scan.xnat_scan_id not in queue.queued], stages)
+
+    queued = sum(1 for scan in scans if queue.put(scan, stages))
+
+    if not groups:
+        if close:
+            queue.close()
+        return queued
+
+    log.info(f'Experiment archives - experiments: {len(groups)} | scans: {sum(len(group) for group in groups)}')
+
+    def download_archives():
+        # as many archives in flight as scan workers, the rest wait
+        workers = args['multi_proc_cpu'] if args['multi_proc'] == True else 1
+        try:
+            with futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(groups)))) as executor:
+                group_futures = {executor.submit(download_archive, args, log, xtools, group): group for group in groups}
+                for future in futures.as_completed(group_futures):
+                    group = group_futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        log.warning(f'Experiment archive failed, reading the scans file by file - experiment: {group[0].experiment_id} | error: {str(e)}')
+                    for scan in group:
+                        queue.put(scan, stages)
+        finally:
+            if close:
+                queue.close()
+
+    threading.Thread(target=download_archives, name='experiment_archives', daemon=True).start()
+
+    return queued + sum(len(group) for group in groups)
+
+# ----------------------------
+# archive groups (scans of an experiment that still need their DICOM files)
+# ----------------------------
+
+def get_archive_groups(args, dbtools, scan_keys, stages):
+
+    stage = stage_tools()
+
+    # scans with all results of the stages are skipped by the workers (unless reset)
+    pending = None
+    if args['reset'] != True and scan_keys:
+        missing = [column for name in stages for column in STAGE_RESULTS[name]]
+        projects = sorted({scan.project_id for scan in scan_keys})
+        pending = {scan.xnat_scan_id for scan in dbtools.get_db_scan_keys(projects, missing=missing)}
+
+    experiments = {}
+    for scan in scan_keys:
+        if scan.scan_modality not in ['MR', 'CT', 'MG']:
+            continue
+        if pending is not None and scan.xnat_scan_id not in pending:
+            continue
+        # a staged volume is read instead of the DICOM files, files unpacked for an earlier stage are read again
+        if (stages[0] != 'quality_functions' or args['stage_volumes'] == True) and os.path.exists(os.path.join(stage.get_volume_path(args, scan), 'volume.json')):
+            continue
+        if os.path.exists(os.path.join(get_archive_path(args, scan), ARCHIVE_INDEX)):
+            continue
+        experiments.setdefault((scan.project_id, scan.subject_id, scan.experiment_id), []).append(scan)
+
+    groups = [group for group in experiments.values() if len(group) >= args['experiment_archive_min_scans']]
+    grouped = {scan.xnat_scan_id for group in groups for scan in group}
+
+    return groups, [scan for scan in scan_keys if scan.xnat_scan_id not in grouped]
+
+# ----------------------------
+# download archive (unpacked while it streams)
+# ----------------------------
+
+def download_archive(args, log, xtools, group):
+
+    start_time = time.perf_counter()
+
+    scan_paths = {str(scan.scan_id): get_archive_path(args, scan) for scan in group}
+    for scan_path in scan_paths.values():
+        remove_archive_folder(scan_path)
+        os.makedirs(scan_path)
+
+    scan_files = {scan_id: {} for scan_id in scan_paths}
+
+    def get_target(name):
+        match = ARCHIVE_ENTRY.search(name)
+        if match is None or match.group(2) != 'DICOM':
+            return None
+        # the scan folder is named <scan id>-<scan type> (longest matching id first)
+        folder = match.group(1)
+        for scan_id in sorted(scan_paths, key=len, reverse=True):
+            if folder == scan_id or folder.startswith(f'{scan_id}-'):
+                file_name = os.path.basename(match.group(3))
+                local_name = f'{len(scan_files[scan_id]):06d}_{re.sub(r"[^A-Za-z0-9_.-]", "_", file_name)}'
+                scan_files[scan_id][file_name] = local_name
+                return os.path.join(scan_paths[scan_id], local_name)
+        return None
+
+    scan = group[0]
+    try:
+        chunks = xtools.get_xnat_scan_archive(scan.project_id, scan.subject_id, scan.experiment_id, list(scan_paths), chunk_size=CHUNK_SIZE)
+        try:
+            entries, size = unpack_zip_stream(chunks, get_target, spool_path=args['archive_path'])
+        finally:
+            chunks.close()
+    except Exception:
+        for scan_path in scan_paths.values():
+            remove_archive_folder(scan_path)
+        raise
+
+    for scan_id, scan_path in scan_paths.items():
+        if scan_files[scan_id]:
+            with open(os.path.join(scan_path, ARCHIVE_INDEX), 'w') as json_file:
+                json.dump(scan_files[scan_id], json_file)
+        else:
+            remove_archive_folder(scan_path)
+
+    log.info(f'Experiment archive {scan.experiment_id} - scans: {sum(1 for files in scan_files.values() if files)} of {len(group)} | '
+             f'files: {entries} | {size / 1048576:.1f} MB | {time.perf_counter() - start_time:.2f} s')
+
+    return None
+
+# ----------------------------
+# unpacked files of a scan (read by the scan workers)
+# ----------------------------
+
+class archive_file(object):
+
+    # read from the stage area, not counted as a download
+    local = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        return open(self.path, 'rb')
+
+# scan files keyed by file name like the XNAT listing (None if the scan was not unpacked)
+def get_archive_files(args, scan):
+
+    scan_path = get_archive_path(args, scan)
+    index_path = os.path.join(scan_path, ARCHIVE_INDEX)
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path) as json_file:
+        scan_files = json.load(json_file)
+
+    return {file_name: archive_file(os.path.join(scan_path, local_name)) for file_name, local_name in scan_files.items()}
+
+# once no later stage reads them (normalization reads the volume staged by quality with stage_volumes)
+def release_archive_files(args, scan, stage):
+
+    if stage == 'quality_functions' and 'normalization_functions' in args['preprocess_functions'] and args['stage_volumes'] != True:
+        return None
+    remove_archive_folder(get_archive_path(args, scan))
+
+    return None
+
+def get_archive_path(args, scan):
+    keys = [scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id]
+    return os.path.join(args['archive_path'], *[re.sub(r'[^A-Za-z0-9_.-]', '_', str(key)) for key in keys])
+
+def remove_archive_folder(scan_path):
+
+    # the index first, so a folder left half removed is not read
+    if os.path.exists(os.path.join(scan_path, ARCHIVE_INDEX)):
+        os.remove(os.path.join(scan_path, ARCHIVE_INDEX))
+    shutil.rmtree(scan_path, ignore_errors=True)
+
+    return None
+
+# ----------------------------
+# streaming zip reader
+# ----------------------------
+# reads the local file headers in order (the central directory at the end is not
+# needed), so entries are written out as the chunks arrive
+#
+# deflated entries, and stored entries with their size in the local header, are
+# read from the stream; from the first other entry (a stored entry with its size
+# in a data descriptor after the data, or another compression method) the rest of
+# the archive is spooled (SPOOL_SIZE in memory, then a file in spool_path) and read
+# with zipfile; its central directory offsets count from the start of the
+# archive, so zipfile places the spooled entries at their offset less the bytes
+# already read, and the entries before them (negative offsets) are skipped
+# ----------------------------
+
+class stream_reader(object):
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.buffer, self.offset = self.buffer[self.offset:] + chunk, 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    # up to size bytes of buffered data, or of the next chunk (data not used is unread)
+    def read_chunk(self, size=READ_SIZE):
+        if self.offset >= len(self.buffer):
+            self.buffer, self.offset = next(self.chunks, b''), 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def unread(self, data):
+        self.buffer, self.offset = data + self.buffer[self.offset:], 0
+        return None
+
+# writes each entry to get_target(name) (skipped if None); returns the entries and bytes written
+def unpack_zip_stream(chunks, get_target, spool_path=None):
+
+    reader = stream_reader(chunks)
+    entries, size = 0, 0
+
+    while True:
+
+        header = reader.read(30)
+        signature = struct.unpack('<I', header[:4])[0] if len(header) >= 4 else None
+        if signature in (CENTRAL_DIRECTORY, END_OF_CENTRAL_DIRECTORY):
+            break
+        if signature != LOCAL_HEADER or len(header) < 30:
+            raise EOFError('Truncated archive (no central directory)')
+
+        _, _, flags, method, _, _, crc, compressed_size, _, name_length, extra_length = struct.unpack('<IHHHHHIIIHH', header)
+        raw_name = reader.read(name_length)
+        extra = reader.read(extra_length)
+        descriptor = flags & 0x08
+
+        if method != 8 and (method != 0 or descriptor):
+            reader.unread(header + raw_name + extra)
+            spooled_entries, spooled_size = unpack_zip_file(reader, get_target, spool_path)
+            return entries + spooled_entries, size + spooled_size
+
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        zip64 = False
+        while len(extra) >= 4:
+            extra_id, length = struct.unpack('<HH', extra[:4])
+            if extra_id == ZIP64_EXTRA:
+                zip64 = True
+                if compressed_size == 0xFFFFFFFF and length >= 16:
+                    compressed_size = struct.unpack('<Q', extra[12:20])[0]
+            extra = extra[4 + length:]
+
+        target = get_target(name) if not name.endswith('/') else None
+
+        output = open(f'{target}.part', 'wb') if target else None
+        checksum = 0
+        try:
+            if method == 8:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                while not decompressor.eof:
+                    data = reader.read_chunk()
+                    if not data:
+                        raise EOFError(f'Truncated archive entry {name}')
+                    data = decompressor.decompress(data)
+                    checksum = zlib.crc32(data, checksum)
+                    if output:
+                        output.write(data)
+                        size += len(data)
+                reader.unread(decompressor.unused_data)
+            else:
+                remaining = compressed_size
+                while remaining:
+                    data = reader.read(min(remaining, CHUNK_SIZE))
+                    if not data:
+                        raise EOFError(f'Truncated archive entry {name}')
+                    remaining -= len(data)
+                    checksum = zlib.crc32(data, checksum)
+                    if output:
+                        output.write(data)
+                        size += len(data)
+        finally:
+            if output:
+                output.close()
+
+        if descriptor:
+            # the signature of the data descriptor is optional
+            signature = reader.read(4)
+            if struct.unpack('<I', signature)[0] != DATA_DESCRIPTOR:
+                reader.unread(signature)
+            crc = struct.unpack('<I', reader.read(20 if zip64 else 12)[:4])[0]
+
+        if checksum != crc:
+            raise ValueError(f'CRC mismatch in archive entry {name}')
+
+        if target:
+            os.replace(f'{target}.part', target)
+            entries += 1
+
+    return entries, size
+
+# the rest of the archive from the current entry, read with zipfile
+def unpack_zip_file(reader, get_target, spool_path=None):
+
+    entries, size = 0, 0
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=spool_path) as spool:
+        data = reader.read_chunk(CHUNK_SIZE)
+        while data:
+            spool.write(data)
+            data = reader.read_chunk(CHUNK_SIZE)
+        spool.seek(0)
+
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                # unpacked from the stream
+                if info.header_offset < 0 or info.is_dir():
+                    continue
+                target = get_target(info.filename)
+                if target is None:
+                    continue
+                with archive.open(info) as source, open(f'{target}.part', 'wb') as output:
+                    shutil.copyfileobj(source, output, CHUNK_SIZE)
+                os.replace(f'{target}.part', target)
+                entries += 1
+                size += info.file_size
+
+    return entries, size
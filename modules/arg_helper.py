@@ -5,6 +5,7 @@ class arg_helper(object):
 
     def __init__(self, argv):
 
+        self.__argv = argv
         self.__parser = argparse.ArgumentParser(description=(""))
 
         self.parseArgs()
@@ -15,7 +16,7 @@ class arg_helper(object):
         self.__parser.add_argument("-data_path", "--data_path")
         self.__parser.add_argument("-log_level", "--log_level")
         
-        self._args = vars(self.__parser.parse_args())
+        self._args = vars(self.__parser.parse_args(self.__argv))
 
     def setArgs(self, args):
 
@@ -58,6 +59,18 @@ class arg_helper(object):
         #return stage_path
         return self._args['stage_path']
 
+    @property
+    def archive_path(self):
+        return self._args['archive_path']
+
+    @property
+    def header_path(self):
+        return self._args['header_path']
+
+    @property
+    def export_path(self):
+        return self._args['export_path']
+
     @property    
     def log_path(self):
         #log_path = os.path.join(self._args['data_path'], "logs")
@@ -96,6 +109,10 @@ class arg_helper(object):
     def xnat_scans(self):
         return self._args['xnat_scans']
 
+    @property    
+    def xnat_request_timeout(self):
+        return self._args['xnat_request_timeout']
+
     @property    
     def preprocess_functions(self):
         return self._args['preprocess_functions']
@@ -108,6 +125,38 @@ class arg_helper(object):
     def reset(self):
         return self._args['reset']
 
+    @property
+    def file_catalog(self):
+        return self._args['file_catalog']
+
+    @property    
+    def header_index(self):
+        return self._args['header_index']
+
+    @property    
+    def experiment_archive(self):
+        return self._args['experiment_archive']
+
+    @property    
+    def experiment_archive_min_scans(self):
+        return self._args['experiment_archive_min_scans']
+
+    @property
+    def daemon(self):
+        return self._args['daemon']
+
+    @property
+    def daemon_interval(self):
+        return self._args['daemon_interval']
+
+    @property
+    def daemon_host(self):
+        return self._args['daemon_host']
+
+    @property
+    def daemon_port(self):
+        return self._args['daemon_port']
+
     @property    
     def multi_proc(self):
         return self._args['multi_proc']
@@ -116,10 +165,138 @@ class arg_helper(object):
     def multi_proc_cpu(self):
         return self._args['multi_proc_cpu']
 
+    @property
+    def multi_proc_start_method(self):
+        return self._args['multi_proc_start_method']
+
     @property    
     def multi_thread(self):
         return self._args['multi_thread']
 
     @property    
     def multi_thread_workers(self):
-        return self._args['multi_thread_workers']
\ No newline at end of file
+        return self._args['multi_thread_workers']
+
+    @property
+    def adaptive_concurrency(self):
+        return self._args['adaptive_concurrency']
+
+    @property
+    def adaptive_download_bounds(self):
+        return self._args['adaptive_download_bounds']
+
+    @property
+    def adaptive_worker_bounds(self):
+        return self._args['adaptive_worker_bounds']
+
+    @property
+    def adaptive_interval(self):
+        return self._args['adaptive_interval']
+
+    @property    
+    def piqe_processes(self):
+        return self._args['piqe_processes']
+
+    @property
+    def quality_metrics(self):
+        return self._args['quality_metrics']
+
+    @property
+    def quality_downsample(self):
+        return self._args['quality_downsample']
+
+    @property
+    def piqe_tile_processes(self):
+        return self._args['piqe_tile_processes']
+
+    @property
+    def decoder_handlers(self):
+        return self._args['decoder_handlers']
+
+    @property
+    def decode_processes(self):
+        return self._args['decode_processes']
+
+    @property    
+    def stage_volumes(self):
+        return self._args['stage_volumes']
+
+    @property    
+    def normalization_method(self):
+        return self._args['normalization_method']
+
+    @property    
+    def normalization_percentiles(self):
+        return self._args['normalization_percentiles']
+
+    @property    
+    def normalization_ct_window(self):
+        return self._args['normalization_ct_window']
+
+    @property    
+    def normalization_spacing(self):
+        return self._args['normalization_spacing']
+
+    @property    
+    def normalization_chunk_slices(self):
+        return self._args['normalization_chunk_slices']
+
+    @property    
+    def scan_timeouts(self):
+        return self._args['scan_timeouts']
+
+    @property    
+    def stage_timeouts(self):
+        return self._args['stage_timeouts']
+
+    @property    
+    def straggler_factor(self):
+        return self._args['straggler_factor']
+
+    @property    
+    def scan_retries(self):
+        return self._args['scan_retries']
+
+    @property    
+    def speculative_execution(self):
+        return self._args['speculative_execution']
+
+    @property    
+    def memory_budget_mb(self):
+        return self._args['memory_budget_mb']
+
+    @property    
+    def memory_worker_base_mb(self):
+        return self._args['memory_worker_base_mb']
+
+    @property
+    def export_format(self):
+        return self._args['export_format']
+
+    @property
+    def export_chunk_rows(self):
+        return self._args['export_chunk_rows']
+
+    @property    
+    def profile(self):
+        return self._args['profile']
+
+    @property    
+    def profile_mode(self):
+        return self._args['profile_mode']
+
+    @property    
+    def profile_sample_rate(self):
+        return self._args['profile_sample_rate']
+
+    @property    
+    def profile_interval(self):
+        return self._args['profile_interval']
+
+    @property    
+    def profile_merge(self):
+        return self._args['profile_merge']
+
+    @property    
+    def profile_memory(self):
+        return self._args['profile_memory']
\ No newline at end of file
@@ -0,0 +1,261 @@
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+# ----------------------------
+# concurrency helper
+# ----------------------------
+# adaptive concurrency (adaptive_concurrency in the config file): AIMD control of
+#   downloads    - DICOM file downloads in flight per scan worker process, between
+#                  adaptive_download_bounds (the thread pools are sized to the upper bound)
+#   scan workers - scans processed at once by the scan worker pool, between
+#                  adaptive_worker_bounds (the process pool is sized to the upper bound)
+#
+# every adaptive_interval seconds the controller looks at the last window:
+#   decrease (x DECREASE_FACTOR) - error or timeout rate above MAX_ERROR_RATE, mean
+#                                  latency above LATENCY_FACTOR x the best window (XNAT
+#                                  or the network is saturated), or CPU utilization above
+#                                  MAX_CPU_UTILIZATION (scan workers)
+#   increase (+1)                - otherwise, when work waited for a slot and all slots
+#                                  were in use
+#
+# download statistics are counted per process (reset per scan) whether or not
+# the concurrency is adaptive
+# ----------------------------
+
+DECREASE_FACTOR = 0.7
+LATENCY_FACTOR = 2.0
+MAX_ERROR_RATE = 0.05
+MAX_CPU_UTILIZATION = 0.9
+# fewer requests in a window leave the latency and error rate out of the decision
+MIN_WINDOW_REQUESTS = 5
+
+_download_controller = None
+_download_lock = threading.Lock()
+_download_statistics = {}
+
+class aimd_controller(object):
+
+    def __init__(self, name, bounds, initial, interval, log=None, cpu=False):
+
+        self.name = name
+        self.minimum = max(1, int(bounds[0]))
+        self.maximum = max(self.minimum, int(bounds[1]))
+        self.limit = min(max(int(initial), self.minimum), self.maximum)
+        self.interval = interval
+        self.log = log
+        self.cpu = cpu_monitor() if cpu else None
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.base_latency = None
+        self.changes = []
+        self.reset_window()
+
+    def reset_window(self):
+
+        self.window_start = time.monotonic()
+        self.window = {'requests': 0, 'seconds': 0.0, 'errors': 0, 'timeouts': 0, 'queue_depth': self.waiting, 'in_use': self.active}
+
+        return None
+
+    # ----------------------------
+    # slots (threads wait while the limit is in use)
+    # ----------------------------
+
+    def acquire(self):
+
+        with self.condition:
+            self.waiting += 1
+            self.window['queue_depth'] = max(self.window['queue_depth'], self.waiting)
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.waiting -= 1
+            self.active += 1
+            self.window['in_use'] = max(self.window['in_use'], self.active)
+
+        return None
+
+    def release(self):
+
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+        return None
+
+    # ----------------------------
+    # observations
+    # ----------------------------
+
+    def observe(self, requests, seconds=0.0, errors=0, timeouts=0):
+
+        with self.condition:
+            self.window['requests'] += requests
+            self.window['seconds'] += seconds
+            self.window['errors'] += errors
+            self.window['timeouts'] += timeouts
+
+        return None
+
+    # a finished scan of the scan worker pool (its download statistics; result None if it failed)
+    def observe_scan(self, result=None):
+
+        if result is None:
+            return self.observe(1, errors=1)
+
+        downloads = result.get('downloads') or {}
+        return self.observe(downloads.get('requests', 0), downloads.get('seconds', 0.0), downloads.get('errors', 0), downloads.get('timeouts', 0))
+
+    # slots left for callers that do not use acquire
+    def get_slots(self, in_use):
+        return max(0, self.limit - in_use)
+
+    # ----------------------------
+    # adjust (once per interval; queue depth and slots in use given by callers that do not use acquire)
+    # ----------------------------
+
+    def adjust(self, queue_depth=None, in_use=None):
+
+        with self.condition:
+
+            if queue_depth is not None:
+                self.window['queue_depth'] = max(self.window['queue_depth'], queue_depth)
+            if in_use is not None:
+                self.window['in_use'] = max(self.window['in_use'], in_use)
+
+            if time.monotonic() - self.window_start < self.interval:
+                return self.limit
+
+            window = self.window
+            reason = None
+            if window['requests'] >= MIN_WINDOW_REQUESTS:
+                latency = window['seconds'] / window['requests']
+                # errors include the timeouts
+                error_rate = window['errors'] / window['requests']
+                if error_rate > MAX_ERROR_RATE:
+                    reason = f'error rate {error_rate:.0%} ({window["timeouts"]} timeouts)'
+                elif self.base_latency is not None and latency > LATENCY_FACTOR * self.base_latency:
+                    reason = f'latency {1000 * latency:.0f} ms (best {1000 * self.base_latency:.0f} ms)'
+                    # a lasting latency step (slower network) only decreases the limit once
+                    self.base_latency = latency / LATENCY_FACTOR
+                if window['errors'] == 0:
+                    self.base_latency = latency if self.base_latency is None else min(self.base_latency, latency)
+            cpu_utilization = self.cpu.sample() if self.cpu else None
+            if reason is None and cpu_utilization is not None and cpu_utilization > MAX_CPU_UTILIZATION:
+                reason = f'cpu {cpu_utilization:.0%}'
+
+            limit = self.limit
+            if reason is not None:
+                limit = max(self.minimum, int(self.limit * DECREASE_FACTOR))
+            elif window['queue_depth'] > 0 and window['in_use'] >= self.limit:
+                limit = min(self.maximum, self.limit + 1)
+                reason = f'queue depth {window["queue_depth"]}'
+
+            if limit != self.limit:
+                if self.log:
+                    self.log.info(f'Adaptive concurrency {self.name}: {self.limit} -> {limit} ({reason})')
+                self.changes.append([time.time(), self.limit, limit, reason])
+                self.limit = limit
+                self.condition.notify_all()
+
+            self.reset_window()
+
+            return self.limit
+
+# ----------------------------
+# cpu utilization (busy share of all cpus between samples, from /proc/stat)
+# ----------------------------
+
+class cpu_monitor(object):
+
+    def __init__(self):
+        self.last = read_cpu_times()
+
+    def sample(self):
+
+        current = read_cpu_times()
+        if current is None or self.last is None:
+            self.last = current
+            return None
+
+        busy = current[0] - self.last[0]
+        total = current[1] - self.last[1]
+        self.last = current
+
+        return busy / total if total > 0 else None
+
+def read_cpu_times():
+    try:
+        with open('/proc/stat') as stat_file:
+            values = [int(value) for value in stat_file.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # idle and iowait
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return sum(values) - idle, sum(values)
+
+def is_timeout(e):
+    return isinstance(e, (socket.timeout, TimeoutError)) or 'timeout' in type(e).__name__.lower()
+
+# ----------------------------
+# downloads (per scan worker process)
+# ----------------------------
+
+def configure_downloads(args, log):
+
+    global _download_controller
+
+    with _download_lock:
+        if args['adaptive_concurrency'] and _download_controller is None:
+            initial = args['multi_thread_workers'] if args['multi_thread'] == True else 1
+            _download_controller = aimd_controller('downloads', args['adaptive_download_bounds'], initial, args['adaptive_interval'], log)
+
+    return None
+
+# threads of the download thread pools (the upper bound when adaptive)
+def get_download_threads(args):
+    if args['adaptive_concurrency']:
+        return max(1, int(args['adaptive_download_bounds'][1]))
+    return args['multi_thread_workers']
+
+# one download (waits for a slot when adaptive; the latency excludes the wait)
+@contextmanager
+def download_request():
+
+    controller = _download_controller
+    if controller is not None:
+        controller.acquire()
+
+    start_time = time.perf_counter()
+    errors, timeouts = 0, 0
+    try:
+        yield
+    except Exception as e:
+        errors, timeouts = 1, 1 if is_timeout(e) else 0
+        raise
+    finally:
+        seconds = time.perf_counter() - start_time
+        if controller is not None:
+            controller.observe(1, seconds, errors, timeouts)
+            controller.release()
+            controller.adjust()
+        with _download_lock:
+            _download_statistics['requests'] = _download_statistics.get('requests', 0) + 1
+            _download_statistics['seconds'] = _download_statistics.get('seconds', 0.0) + seconds
+            _download_statistics['errors'] = _download_statistics.get('errors', 0) + errors
+            _download_statistics['timeouts'] = _download_statistics.get('timeouts', 0) + timeouts
+
+def reset_download_statistics():
+    with _download_lock:
+        _download_statistics.clear()
+    return None
+
+def get_download_statistics():
+    with _download_lock:
+        statistics = {'requests': 0, 'seconds': 0.0, 'errors': 0, 'timeouts': 0, **_download_statistics}
+    if _download_controller is not None:
+        statistics['limit'] = _download_controller.limit
+    return statistics
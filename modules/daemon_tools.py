@@ -0,0 +1,370 @@
+import re
+import json
+import time
+import signal
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from modules.xnat_tools import xnat_tools
+from modules.db_tools import db_tools
+from modules.queue_helper import scan_queue, PRIORITY_JOB, STAGE_RESULTS
+from modules.pool_helper import run_scan_pool
+from modules.archive_helper import queue_archive_scans
+from modules.worker_helper import WORKER_STAGES
+
+# ----------------------------
+# daemon tools
+# ----------------------------
+# long-running service (daemon in the config file) instead of one batch run: the
+# XNAT session, the database session and the scan worker pool are kept for the
+# life of the service
+#
+# at the start the scans of the configured projects without results are queued
+# (after a full index when index is set); then every daemon_interval seconds the
+# experiments of the projects are listed with their last modified time, and new
+# and changed experiments are indexed and their scans queued for the worker
+# stages of preprocess_functions; export_functions run when the queue has
+# drained after new results
+#
+# the status (queue depth, throughput, recent errors) is served as JSON on
+# http://daemon_host:daemon_port/status
+#
+# job API on the same port, for on-demand processing of specific scans ahead of
+# the bulk work:
+#   POST /jobs        project / subject / experiment / scans keys, or an XNAT
+#                     event payload; returns the job id (202)
+#   GET  /jobs/<id>   state of the job and of each of its scans, with results
+#   GET  /jobs        recent jobs
+# jobs are resolved to scans right away by the main loop (an experiment not
+# indexed yet is indexed first) and queued at PRIORITY_JOB
+# ----------------------------
+
+# keys of a job request, at the top level or in the payload of an XNAT event (first name found)
+JOB_KEYS = {
+    'project': ['project', 'project_id', 'projectId', 'project-id'],
+    'subject': ['subject', 'subject_id', 'subjectId', 'subject-id', 'subject_ID'],
+    'experiment': ['experiment', 'experiment_id', 'experimentId', 'experiment-id', 'session', 'session_id', 'sessionId', 'session-id'],
+    'scans': ['scans', 'scan', 'scan_id', 'scanId', 'scan-id'],
+}
+JOB_PAYLOADS = ['payload', 'eventData', 'event_data', 'data', 'event']
+
+# REST URI of a project, subject, experiment or scan (keys missing from an event payload)
+JOB_URI = re.compile(r'/(?:data|REST)/(?:archive/)?(?:projects/(?P<project>[^/]+))?/?(?:subjects/(?P<subject>[^/]+))?/?(?:experiments/(?P<experiment>[^/]+))?/?(?:scans/(?P<scan>[^/?]+))?')
+
+class daemon_tools(object):
+
+    def __init__(self):
+
+        self.queue = scan_queue()
+        self.stop_event = threading.Event()
+        # wakes the main loop for submitted jobs (and to stop)
+        self.wakeup = threading.Event()
+        # project -> experiment id -> last modified (as of the last poll)
+        self.experiments = {}
+        self.exported = 0
+
+        self.status_lock = threading.Lock()
+        self.status = {
+            'state': 'starting',
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'polls': 0,
+            'last_poll': None,
+            'last_poll_seconds': None,
+            'next_poll': None,
+            'changed_experiments': 0,
+            'queued_scans': 0,
+        }
+        self.start_time = time.monotonic()
+
+    def run_daemon(self, args, log):
+
+        log.info(f'Initializing XNAT')
+        xtools = xnat_tools(args.xnat_server, args.xnat_user, args.xnat_password, request_timeout=args.xnat_request_timeout)
+        log.info(f'Initializing Database')
+        dbtools = db_tools(args.db_connect_string)
+
+        stages = [stage for stage in args.preprocess_functions if stage in WORKER_STAGES]
+
+        server = self.start_status_server(args, log)
+
+        dispatcher = threading.Thread(target=self.run_dispatcher, args=(args, log), name='daemon dispatcher', daemon=True)
+        dispatcher.start()
+
+        # docker stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        try:
+            # experiments as of the start (changed from here on are picked up by the polls)
+            for project in args.xnat_projects:
+                self.experiments[project] = {experiment['experiment_id']: experiment['last_modified'] for experiment in xtools.get_xnat_experiment_list(project)}
+
+            if args.index == True:
+                self.set_status(state='indexing')
+                log.info(f'Indexing')
+                xtools.index_scans(args, log, dbtools)
+
+            scan_keys = dbtools.get_db_scan_keys(args.xnat_projects, args.xnat_subjects, args.xnat_experiments, args.xnat_scans, missing=self.get_missing(args, stages))
+            self.set_status(state='idle', queued_scans=self.queue_scans(args, log, xtools, dbtools, scan_keys, stages))
+            log.info(f'Queued {len(scan_keys)} scans without results')
+
+            next_poll = time.monotonic() + args.daemon_interval
+            while not self.stop_event.is_set():
+                self.set_status(next_poll=(datetime.now() + timedelta(seconds=next_poll - time.monotonic())).isoformat(timespec='seconds'))
+                self.wakeup.wait(max(0.0, next_poll - time.monotonic()))
+                self.wakeup.clear()
+                if self.stop_event.is_set():
+                    break
+                self.run_jobs(args, log, xtools, dbtools, stages)
+                if time.monotonic() >= next_poll:
+                    self.poll(args, log, xtools, dbtools, stages)
+                    next_poll = time.monotonic() + args.daemon_interval
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            # scans running finish, waiting scans are left to the next start
+            log.info(f'Stopping Daemon')
+            self.set_status(state='stopping')
+            self.queue.close(cancel=True)
+            dispatcher.join()
+            server.shutdown()
+
+        return None
+
+    # ----------------------------
+    # poll (new and changed experiments of the configured projects)
+    # ----------------------------
+
+    def poll(self, args, log, xtools, dbtools, stages):
+
+        start_time = time.perf_counter()
+        self.set_status(state='polling')
+
+        changed_experiments = 0
+        queued_scans = 0
+        for project in args.xnat_projects:
+            try:
+                experiments = xtools.get_xnat_experiment_list(project)
+                known = self.experiments.get(project, {})
+                changed = [(experiment['subject_id'], experiment['experiment_id']) for experiment in experiments
+                           if (experiment['experiment_id'] not in known or known[experiment['experiment_id']] != experiment['last_modified'])
+                           and (not args.xnat_subjects or experiment['subject_id'] in args.xnat_subjects)
+                           and (not args.xnat_experiments or experiment['experiment_id'] in args.xnat_experiments)]
+
+                if changed:
+                    log.info(f'Polled {project} - new or changed experiments: {len(changed)}')
+                    xtools.index_experiments(log, dbtools, project, changed)
+                    scan_keys = dbtools.get_db_scan_keys([project], sorted({subject_id for subject_id, _ in changed}), sorted({experiment_id for _, experiment_id in changed}),
+                                                         args.xnat_scans, missing=self.get_missing(args, stages))
+                    queued_scans += self.queue_scans(args, log, xtools, dbtools, scan_keys, stages)
+                    changed_experiments += len(changed)
+
+                self.experiments[project] = {experiment['experiment_id']: experiment['last_modified'] for experiment in experiments}
+
+            except Exception as e:
+                log.error(f'Daemon Poll Error - project: {project} | error: {str(e)}')
+                self.queue.record_error(f'poll - project: {project} | error: {str(e)}')
+
+        # exports once the results of the polls so far are in
+        if 'export_functions' in args.preprocess_functions and self.queue.idle() and self.queue.processed != self.exported:
+            try:
+                from modules.export_tools import export_tools
+                export_tools().run_export_functions(args, log, xtools, dbtools)
+                self.exported = self.queue.processed
+            except Exception as e:
+                log.error(f'Daemon Export Error - error: {str(e)}')
+                self.queue.record_error(f'export - error: {str(e)}')
+
+        with self.status_lock:
+            self.status['polls'] += 1
+            self.status['queued_scans'] += queued_scans
+        self.set_status(state='idle', last_poll=datetime.now().isoformat(timespec='seconds'),
+                        last_poll_seconds=round(time.perf_counter() - start_time, 3), changed_experiments=changed_experiments)
+
+        return None
+
+    # result columns that select the scans to queue (none with reset, all scans are queued)
+    def get_missing(self, args, stages):
+        if args.reset == True:
+            return None
+        return [column for stage in stages for column in STAGE_RESULTS[stage]]
+
+    # with experiment_archive, the scans of an archive are queued once it has been unpacked
+    def queue_scans(self, args, log, xtools, dbtools, scan_keys, stages):
+        if args.experiment_archive == True:
+            return queue_archive_scans(args.getArgs(), log, self.queue, scan_keys, stages, xtools, dbtools)
+        return sum(1 for scan in scan_keys if self.queue.put(scan, stages))
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+        return None
+
+    # ----------------------------
+    # jobs (submitted jobs resolved to scans and queued ahead of the bulk work)
+    # ----------------------------
+
+    def run_jobs(self, args, log, xtools, dbtools, stages):
+
+        for job_id, request in self.queue.get_submitted_jobs():
+            try:
+                scan_keys = self.get_job_scan_keys(args, log, xtools, dbtools, request)
+                if not scan_keys:
+                    self.queue.fail_job(job_id, 'No scans found for the job keys')
+                    log.warning(f'Job {job_id} - no scans found: {request}')
+                    continue
+                options = {'reset': True} if request['reset'] else None
+                for scan in scan_keys:
+                    self.queue.put(scan, request['stages'] or stages, PRIORITY_JOB, job_id, options)
+                log.info(f'Job {job_id} - queued {len(scan_keys)} scans')
+            except Exception as e:
+                log.error(f'Daemon Job Error - job: {job_id} | error: {str(e)}')
+                self.queue.fail_job(job_id, str(e))
+
+        return None
+
+    def get_job_scan_keys(self, args, log, xtools, dbtools, request):
+
+        scan_keys = dbtools.get_db_job_scan_keys(request['project'], request['subject'], request['experiment'], request['scans'])
+        if not request['experiment'] or (scan_keys and len(scan_keys) >= len(request['scans'] or [])):
+            return scan_keys
+
+        # experiment (or scans) uploaded since the last poll, indexed first
+        for project in [request['project']] if request['project'] else args.xnat_projects:
+            for experiment in xtools.get_xnat_experiment_list(project):
+                if request['experiment'] in (experiment['experiment_id'], experiment['label']):
+                    log.info(f'Indexing experiment {experiment["experiment_id"]} of {project} for a job')
+                    xtools.index_experiments(log, dbtools, project, [(experiment['subject_id'], experiment['experiment_id'])])
+                    return dbtools.get_db_job_scan_keys(request['project'], request['subject'], request['experiment'], request['scans'])
+
+        return scan_keys
+
+    # ----------------------------
+    # dispatcher (scans of the queue through the warm scan worker pool)
+    # ----------------------------
+
+    def run_dispatcher(self, args, log):
+
+        # single-processing runs the scans in this thread, with sessions of its own
+        xtools, dbtools = None, None
+        if args.multi_proc != True:
+            xtools = xnat_tools(args.xnat_server, args.xnat_user, args.xnat_password, request_timeout=args.xnat_request_timeout)
+            dbtools = db_tools(args.db_connect_string)
+
+        try:
+            run_scan_pool(args.getArgs(), log, None, None, xtools, dbtools, queue=self.queue)
+        except Exception as e:
+            log.error(f'Daemon Dispatcher Error - error: {str(e)}')
+            self.queue.record_error(f'dispatcher - error: {str(e)}')
+            self.stop()
+        finally:
+            # sqlite connections are closed by the thread that opened them
+            if dbtools:
+                dbtools.db_session.close()
+
+        return None
+
+    # ----------------------------
+    # status endpoint
+    # ----------------------------
+
+    def set_status(self, **values):
+        with self.status_lock:
+            self.status.update(values)
+        return None
+
+    def get_status(self):
+        with self.status_lock:
+            status = dict(self.status)
+        status['uptime_seconds'] = round(time.monotonic() - self.start_time)
+        status.update(self.queue.get_status())
+        return status
+
+    def start_status_server(self, args, log):
+
+        daemon = self
+
+        class handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                return None
+
+            def do_GET(self):
+                path = urlparse(self.path).path.rstrip('/')
+                if path in ('', '/status'):
+                    return self.send_json(200, daemon.get_status())
+                if path == '/jobs':
+                    return self.send_json(200, daemon.queue.get_jobs())
+                if path.startswith('/jobs/'):
+                    job = daemon.queue.get_job(path[len('/jobs/'):])
+                    return self.send_json(200, job) if job else self.send_json(404, {'error': 'Unknown job'})
+                return self.send_json(404, {'error': f'Not found: {path}'})
+
+            def do_POST(self):
+                path = urlparse(self.path).path.rstrip('/')
+                if path != '/jobs':
+                    return self.send_json(404, {'error': f'Not found: {path}'})
+                try:
+                    length = int(self.headers.get('Content-Length', 0) or 0)
+                    request = get_job_request(json.loads(self.rfile.read(length) or b'{}'))
+                except ValueError as e:
+                    return self.send_json(400, {'error': str(e)})
+                job_id = daemon.queue.create_job(request)
+                daemon.wakeup.set()
+                return self.send_json(202, {'job_id': job_id, 'state': 'submitted', 'url': f'/jobs/{job_id}'})
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((args.daemon_host, args.daemon_port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='daemon status', daemon=True).start()
+        log.info(f'Daemon status on http://{args.daemon_host}:{server.server_port}/status')
+
+        return server
+
+# ----------------------------
+# job request (keys of the request body or of an XNAT event payload)
+# ----------------------------
+
+def get_job_request(body):
+
+    if not isinstance(body, dict):
+        raise ValueError('Job request must be a JSON object')
+
+    sources = [body] + [body[name] for name in JOB_PAYLOADS if isinstance(body.get(name), dict)]
+    request = {}
+    for key, names in JOB_KEYS.items():
+        request[key] = next((source[name] for source in sources for name in names if source.get(name) not in (None, '', [])), None)
+
+    # keys in the REST URI of the event (uri, URI, resource_uri)
+    for source in sources:
+        for name in ['uri', 'URI', 'resource_uri']:
+            match = JOB_URI.match(str(source.get(name) or ''))
+            if match:
+                for key, value in match.groupdict().items():
+                    if value and not request.get('scans' if key == 'scan' else key):
+                        request['scans' if key == 'scan' else key] = value
+
+    if not request['experiment'] and not request['subject']:
+        raise ValueError('Job request needs an experiment or a subject (project, subject, experiment, scans or an XNAT event payload)')
+
+    # scans of an event payload are objects with their ID
+    if request['scans'] is not None:
+        scans = request['scans'] if isinstance(request['scans'], list) else [request['scans']]
+        request['scans'] = [str(scan.get('ID') or scan.get('id') or scan.get('scan_id')) if isinstance(scan, dict) else str(scan) for scan in scans]
+
+    request['stages'] = body.get('stages')
+    if request['stages'] is not None and (not isinstance(request['stages'], list) or any(stage not in WORKER_STAGES for stage in request['stages'])):
+        raise ValueError(f'Job stages must be a list of {list(WORKER_STAGES)}')
+    request['reset'] = body.get('reset') == True
+
+    return request
@@ -1,12 +1,22 @@
-from models.db import db
+import threading
+
+from models.db import db, STREAM_ROWS
 from models.db import XnatScan
+from models.db import XnatFile
+from models.db import XnatInstanceQuality, XnatScanAcquisition
+from models.scan_key import ScanKey, SCAN_KEY_FIELDS
+from sqlalchemy import or_
+
+# session of each scan worker process, kept across its scans
+_worker_db_tools = {}
+_worker_db_tools_lock = threading.Lock()
 
 class db_tools(object):
 
     def __init__(self, db_connect_string):
         
         self.db = db(db_connect_string)
-        self.db.create_database(True)
+        self.db.prepare_database()
         self.db_session = self.db.get_session()
 
     # ----------------------------
@@ -14,6 +24,9 @@ class db_tools(object):
     # ----------------------------
 
     def reset_database(self):
+        self.drop_table('xnat_instance_quality')
+        self.drop_table('xnat_scan_acquisition')
+        self.drop_table('xnat_file')
         self.drop_table('xnat_scan')
         self.create_database(True)
         return None
@@ -52,6 +65,10 @@ class db_tools(object):
         self.db.insert_dataframe(self.db_session, table, insert_df)
         return None
 
+    def insert_dicts(self, table, insert_dicts):
+        self.db.insert_dicts(self.db_session, table, insert_dicts)
+        return None
+
     # Get scan list (from database)
     def get_db_scan_list(self, df, project=None, subject=None, experiment=None, scan=None):
         clause = 'where'
@@ -69,4 +86,123 @@ class db_tools(object):
         query = f"select * from xnat_scan {project_string} {subject_string} {experiment_string} {scan_string}"
         scans = self.db.query(session=self.db_session, table=XnatScan, query_text=query, return_df=df)
 
-        return scans
\ No newline at end of file
+        return scans
+
+    # Get scan keys (from database, one query for all filters)
+    # ----------------------------
+    # subjects narrow the projects, experiments narrow the subjects and scans the
+    # experiments (experiments are only applied with subjects, scans only with experiments);
+    # missing keeps the scans with any of the given result columns blank;
+    # projects None selects all projects, an empty list none
+    # ----------------------------
+    def get_db_scan_keys(self, projects=None, subjects=None, experiments=None, scans=None, missing=None):
+        if projects is not None and not projects:
+            return []
+
+        columns = [getattr(XnatScan, field) for field in SCAN_KEY_FIELDS]
+        query = self.db_session.query(*columns)
+
+        if missing:
+            query = query.filter(or_(*[or_(getattr(XnatScan, column).is_(None), getattr(XnatScan, column) == '') for column in missing]))
+
+        if projects is not None:
+            query = query.filter(XnatScan.project_id.in_(projects))
+        if subjects:
+            query = query.filter(XnatScan.subject_id.in_(subjects))
+            if experiments:
+                query = query.filter(XnatScan.experiment_id.in_(experiments))
+                if scans:
+                    query = query.filter(XnatScan.scan_id.in_([str(scan) for scan in scans]))
+
+        # server-side cursor (PostgreSQL), fetched in chunks
+        scan_keys = [ScanKey(*row) for row in query.order_by(XnatScan.xnat_scan_id).yield_per(STREAM_ROWS)]
+
+        return scan_keys
+
+    # Get scan keys of a job (each key applied on its own; subjects and experiments by id or label)
+    def get_db_job_scan_keys(self, project=None, subject=None, experiment=None, scans=None):
+        columns = [getattr(XnatScan, field) for field in SCAN_KEY_FIELDS]
+        query = self.db_session.query(*columns)
+
+        if project:
+            query = query.filter(XnatScan.project_id == project)
+        if subject:
+            query = query.filter(or_(XnatScan.subject_id == subject, XnatScan.subject_label == subject))
+        if experiment:
+            query = query.filter(or_(XnatScan.experiment_id == experiment, XnatScan.experiment_label == experiment))
+        if scans:
+            query = query.filter(XnatScan.scan_id.in_([str(scan) for scan in scans]))
+
+        scan_keys = [ScanKey(*row) for row in query.order_by(XnatScan.xnat_scan_id)]
+
+        return scan_keys
+
+    # Get scan (from database, by key)
+    def get_db_scan(self, xnat_scan_id):
+        return self.db_session.get(XnatScan, xnat_scan_id)
+
+    # Get file list of a scan (from the file catalog)
+    def get_db_file_list(self, xnat_scan_id, resource='DICOM'):
+        query = self.db_session.query(XnatFile).filter(XnatFile.xnat_scan_id == xnat_scan_id, XnatFile.resource_label == resource)
+        files = query.order_by(XnatFile.file_name).all()
+
+        return files
+
+    # Remove the file catalog of a scan (cataloged again by the next index)
+    def delete_db_file_list(self, xnat_scan_id):
+        self.db_session.query(XnatFile).filter(XnatFile.xnat_scan_id == xnat_scan_id).delete()
+        return None
+
+    # Get scans without file catalog (indexed by an earlier version, skips scans known to have no files)
+    def get_db_uncataloged_scan_list(self, df, project=None):
+        project_string = "and project_id = :project" if project else ""
+
+        query = f"select * from xnat_scan where xnat_scan_id not in (select xnat_scan_id from xnat_file) and (scan_file_count is null or scan_file_count > 0) {project_string}"
+        scans = self.db.query(session=self.db_session, table=XnatScan, query_text=query, return_df=df, params={'project': project} if project else None)
+
+        return scans
+
+    # ----------------------------
+    # qc results (rows replace those of an earlier run of the scan, committed with the next flush)
+    # ----------------------------
+
+    def set_db_scan_quality(self, xnat_scan_id, quality_rows):
+        self.db_session.query(XnatInstanceQuality).filter(XnatInstanceQuality.xnat_scan_id == xnat_scan_id).delete()
+        if quality_rows:
+            self.db.insert_rows(self.db_session, XnatInstanceQuality.__table__, quality_rows)
+        return None
+
+    def set_db_scan_acquisition(self, xnat_scan_id, acquisition_row):
+        self.db_session.query(XnatScanAcquisition).filter(XnatScanAcquisition.xnat_scan_id == xnat_scan_id).delete()
+        if acquisition_row:
+            self.db.insert_rows(self.db_session, XnatScanAcquisition.__table__, [acquisition_row])
+        return None
+
+    # Get scans with quality or acquisition JSON but without result rows (processed by an earlier version)
+    def get_db_unindexed_result_scans(self):
+        query = ("select * from xnat_scan where "
+                 "(scan_quality is not null and xnat_scan_id not in (select xnat_scan_id from xnat_instance_quality)) or "
+                 "(scan_acquisition is not null and xnat_scan_id not in (select xnat_scan_id from xnat_scan_acquisition))")
+        scans = self.db.query(session=self.db_session, table=XnatScan, query_text=query)
+
+        return scans
+
+# ----------------------------
+# session of a scan worker process
+# ----------------------------
+# kept across the scans of the process, so a worker holds one connection
+# instead of one per scan; changes a failed scan left uncommitted are rolled
+# back before the next scan
+# ----------------------------
+
+def get_worker_db_tools(args):
+
+    key = args['db_connect_string']
+    with _worker_db_tools_lock:
+        dbtools = _worker_db_tools.get(key)
+        if dbtools is None:
+            dbtools = _worker_db_tools[key] = db_tools(key)
+        else:
+            dbtools.db_session.rollback()
+
+    return dbtools
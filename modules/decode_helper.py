@@ -0,0 +1,273 @@
+import os
+import copy
+import json
+import time
+import threading
+import numpy as np
+import pydicom.config
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from multiprocessing import shared_memory
+
+from modules.pool_helper import get_process_pool
+
+# ----------------------------
+# decode helper
+# ----------------------------
+# pixel decoding with an explicit handler per transfer syntax instead of the
+# first available pydicom handler:
+#   - decoder_handlers in the config file selects the handler per transfer syntax
+#   - otherwise the available handlers are timed on the first instance of each
+#     transfer syntax and the fastest is cached in <data_path>/decoders/<name>.json
+#     (a file per transfer syntax, so workers timing different transfer syntaxes
+#     do not overwrite each other, and the workers of later pools read it)
+#   - frames of compressed multi-frame instances are decoded by a process pool
+#     into a shared memory block (decode_processes)
+#   - decode time, frames and bytes are collected per transfer syntax
+# ----------------------------
+
+TRANSFER_SYNTAX_NAMES = {
+    '1.2.840.10008.1.2': 'implicit',
+    '1.2.840.10008.1.2.1': 'explicit',
+    '1.2.840.10008.1.2.1.99': 'deflated',
+    '1.2.840.10008.1.2.2': 'explicit_big_endian',
+    '1.2.840.10008.1.2.5': 'rle',
+    '1.2.840.10008.1.2.4.50': 'jpeg_baseline',
+    '1.2.840.10008.1.2.4.51': 'jpeg_extended',
+    '1.2.840.10008.1.2.4.57': 'jpeg_lossless',
+    '1.2.840.10008.1.2.4.70': 'jpeg_lossless_sv1',
+    '1.2.840.10008.1.2.4.80': 'jpegls_lossless',
+    '1.2.840.10008.1.2.4.81': 'jpegls_near_lossless',
+    '1.2.840.10008.1.2.4.90': 'jpeg2000_lossless',
+    '1.2.840.10008.1.2.4.91': 'jpeg2000',
+}
+
+# timed decodes per handler in the micro-benchmark
+BENCHMARK_REPEATS = 3
+
+# image pixel module elements needed to decode a single frame
+PIXEL_ELEMENTS = ['Rows', 'Columns', 'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration',
+                  'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation']
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+_statistics = {}
+_statistics_lock = threading.Lock()
+
+def get_transfer_syntax_name(transfer_syntax):
+    return TRANSFER_SYNTAX_NAMES.get(str(transfer_syntax), str(transfer_syntax))
+
+def get_handler_name(handler):
+    return handler.__name__.split('.')[-1][:-len('_handler')]
+
+# ----------------------------
+# decode
+# ----------------------------
+
+def decode_pixels(dataset, args):
+
+    transfer_syntax = str(dataset.file_meta.TransferSyntaxUID)
+    handler_name = get_handler(dataset, args)
+    frames = int(dataset.get('NumberOfFrames', 1) or 1)
+
+    start_time = time.perf_counter()
+    if frames > 1 and args['decode_processes'] > 0 and dataset.file_meta.TransferSyntaxUID.is_compressed:
+        pixel_array = decode_frames(dataset, args, handler_name, transfer_syntax, frames)
+    else:
+        if handler_name:
+            dataset.convert_pixel_data(handler_name)
+        pixel_array = dataset.pixel_array
+    decode_time = time.perf_counter() - start_time
+
+    # statistics per transfer syntax
+    with _statistics_lock:
+        statistics = _statistics.setdefault(get_transfer_syntax_name(transfer_syntax), {
+            'handler': handler_name, 'instances': 0, 'frames': 0, 'bytes': 0, 'seconds': 0.0})
+        statistics['instances'] += 1
+        statistics['frames'] += frames
+        statistics['bytes'] += len(dataset.PixelData) if 'PixelData' in dataset else 0
+        statistics['seconds'] += decode_time
+
+    return pixel_array
+
+# ----------------------------
+# handler selection (config override, cached benchmark, benchmark)
+# ----------------------------
+
+def get_handler(dataset, args):
+
+    transfer_syntax = str(dataset.file_meta.TransferSyntaxUID)
+    overrides = args['decoder_handlers'] or {}
+
+    for key in [transfer_syntax, get_transfer_syntax_name(transfer_syntax)]:
+        if key in overrides:
+            return overrides[key]
+
+    with _handlers_lock:
+        if transfer_syntax not in _handlers:
+            # timed by another worker or an earlier run
+            handler = load_handler_cache(args, transfer_syntax)
+            if handler is not None:
+                _handlers[transfer_syntax] = handler
+        if transfer_syntax in _handlers:
+            return _handlers[transfer_syntax]['handler']
+
+    timings = benchmark_handlers(dataset)
+    handler_name = min(timings, key=lambda name: timings[name] or 0) if timings else None
+
+    with _handlers_lock:
+        _handlers[transfer_syntax] = {'handler': handler_name, 'timings': timings}
+        save_handler_cache(args, transfer_syntax, _handlers[transfer_syntax])
+
+    return handler_name
+
+def benchmark_handlers(dataset):
+
+    transfer_syntax = dataset.file_meta.TransferSyntaxUID
+    handlers = [handler for handler in pydicom.config.pixel_data_handlers
+                if handler.supports_transfer_syntax(transfer_syntax) and handler.is_available()]
+
+    # nothing to choose from
+    if len(handlers) < 2:
+        return {get_handler_name(handler): None for handler in handlers}
+
+    # compressed multi-frame instances are timed on their first frame
+    frames = int(dataset.get('NumberOfFrames', 1) or 1)
+    if frames > 1 and transfer_syntax.is_compressed:
+        first_frame = next(generate_pixel_data_frame(dataset.PixelData, frames))
+        dataset = get_frame_dataset(str(transfer_syntax), get_pixel_elements(dataset), first_frame)
+
+    timings = {}
+    for handler in handlers:
+        handler_name = get_handler_name(handler)
+        try:
+            handler_times = []
+            for repeat in range(BENCHMARK_REPEATS):
+                # fresh copy, the dataset caches the converted pixel array
+                benchmark_dataset = copy.deepcopy(dataset)
+                start_time = time.perf_counter()
+                benchmark_dataset.convert_pixel_data(handler_name)
+                handler_times.append(time.perf_counter() - start_time)
+            timings[handler_name] = min(handler_times)
+        except Exception:
+            # handler cannot decode this data (e.g. unsupported bit depth)
+            continue
+
+    return timings
+
+def get_handler_cache_path(args, transfer_syntax):
+    return os.path.join(args['data_path'], 'decoders', f'{get_transfer_syntax_name(transfer_syntax)}.json')
+
+def load_handler_cache(args, transfer_syntax):
+
+    cache_path = get_handler_cache_path(args, transfer_syntax)
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with open(cache_path) as json_file:
+            return json.load(json_file)
+    except ValueError:
+        return None
+
+def save_handler_cache(args, transfer_syntax, handler):
+
+    # written to a temporary file and renamed, workers may time the same transfer syntax concurrently
+    cache_path = get_handler_cache_path(args, transfer_syntax)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(handler, json_file, indent=2)
+    os.replace(temp_path, cache_path)
+
+    return None
+
+# ----------------------------
+# parallel frame decoding (compressed multi-frame instances)
+# ----------------------------
+
+def decode_frames(dataset, args, handler_name, transfer_syntax, frames):
+
+    # samples (color) as the last axis, as pixel_array
+    samples = int(dataset.get('SamplesPerPixel', 1) or 1)
+    shape = (frames, dataset.Rows, dataset.Columns) + ((samples,) if samples > 1 else ())
+    dtype = pixel_dtype(dataset)
+    pixel_elements = get_pixel_elements(dataset)
+    frame_data = list(generate_pixel_data_frame(dataset.PixelData, frames))
+
+    pool = get_process_pool('decode', args['decode_processes'])
+    chunk_size = max(1, -(-frames // (args['decode_processes'] * 2)))
+
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * dtype.itemsize)
+    try:
+        futures_list = []
+        for frame_start in range(0, frames, chunk_size):
+            futures_list.append(pool.submit(decode_frame_task, shm.name, shape, dtype.str, frame_start,
+                                            frame_data[frame_start:frame_start + chunk_size], handler_name, transfer_syntax, pixel_elements))
+        for future in futures_list:
+            future.result()
+        pixel_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return pixel_array
+
+def decode_frame_task(shm_name, shape, dtype, frame_start, frame_data, handler_name, transfer_syntax, pixel_elements):
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pixel_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for index, frame in enumerate(frame_data):
+            frame_dataset = get_frame_dataset(transfer_syntax, pixel_elements, frame)
+            if handler_name:
+                frame_dataset.convert_pixel_data(handler_name)
+            pixel_array[frame_start + index] = frame_dataset.pixel_array
+        del pixel_array
+    finally:
+        shm.close()
+
+    return None
+
+def get_pixel_elements(dataset):
+    return {keyword: dataset.get(keyword) for keyword in PIXEL_ELEMENTS if keyword in dataset}
+
+# single frame dataset with the image pixel module of the instance
+def get_frame_dataset(transfer_syntax, pixel_elements, frame):
+
+    frame_dataset = Dataset()
+    frame_dataset.file_meta = FileMetaDataset()
+    frame_dataset.file_meta.TransferSyntaxUID = transfer_syntax
+    frame_dataset.is_little_endian = True
+    frame_dataset.is_implicit_VR = False
+    for keyword, value in pixel_elements.items():
+        setattr(frame_dataset, keyword, value)
+    frame_dataset.NumberOfFrames = 1
+    frame_dataset.add_new(0x7FE00010, 'OB', encapsulate([frame]))
+
+    return frame_dataset
+
+# ----------------------------
+# statistics (per process, reset per scan)
+# ----------------------------
+
+def reset_decode_statistics():
+    with _statistics_lock:
+        _statistics.clear()
+    return None
+
+def get_decode_statistics():
+    with _statistics_lock:
+        return {name: dict(statistics) for name, statistics in _statistics.items()}
+
+def merge_decode_statistics(results):
+
+    merged = {}
+    for result in results:
+        for name, statistics in (result.get('decode') or {}).items():
+            merged_statistics = merged.setdefault(name, {'handler': statistics['handler'], 'instances': 0, 'frames': 0, 'bytes': 0, 'seconds': 0.0})
+            for key in ['instances', 'frames', 'bytes', 'seconds']:
+                merged_statistics[key] += statistics[key]
+
+    return merged
@@ -0,0 +1,124 @@
+import os
+import time
+import pandas as pd
+from sqlalchemy import select, INTEGER, REAL
+
+from models.db import XnatScan, XnatInstanceQuality, XnatScanAcquisition
+from modules.results_helper import SCORE_COLUMNS, get_quality_rows, get_acquisition_row
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# ----------------------------
+# export tools
+# ----------------------------
+# streams the per-instance quality scores and the per-scan acquisition tags of
+# the configured projects to <data_path>/export/<run>-quality and -acquisition
+# (parquet with pyarrow installed, csv otherwise), export_chunk_rows at a time
+# ----------------------------
+
+SCAN_COLUMNS = ['project_id', 'subject_id', 'subject_label', 'experiment_id', 'experiment_label', 'scan_id', 'scan_modality', 'scan_type']
+
+class export_tools(object):
+
+    def run_export_functions(self, args, log, xtools, dbtools):
+
+        # scans processed before the result tables existed
+        self.index_scan_results(log, dbtools)
+
+        export_format = args.export_format
+        if export_format == 'parquet' and pyarrow is None:
+            log.warning('pyarrow is not installed; exporting csv instead of parquet')
+            export_format = 'csv'
+
+        scan_columns = [XnatScan.__table__.columns[column] for column in SCAN_COLUMNS]
+        quality_columns = [XnatInstanceQuality.sop_instance_uid, XnatInstanceQuality.frame] + [XnatInstanceQuality.__table__.columns[column] for column in SCORE_COLUMNS]
+        acquisition_columns = [column for column in XnatScanAcquisition.__table__.columns
+                               if column.name not in ['xnat_scan_acquisition_id', 'xnat_scan_id']]
+
+        quality_query = (select(*scan_columns, *quality_columns)
+                         .join_from(XnatInstanceQuality, XnatScan, XnatInstanceQuality.xnat_scan_id == XnatScan.xnat_scan_id)
+                         .where(XnatScan.project_id.in_(args.xnat_projects))
+                         .order_by(XnatInstanceQuality.xnat_scan_id, XnatInstanceQuality.sop_instance_uid, XnatInstanceQuality.frame))
+
+        acquisition_query = (select(*scan_columns, *acquisition_columns)
+                             .join_from(XnatScanAcquisition, XnatScan, XnatScanAcquisition.xnat_scan_id == XnatScan.xnat_scan_id)
+                             .where(XnatScan.project_id.in_(args.xnat_projects))
+                             .order_by(XnatScanAcquisition.xnat_scan_id))
+
+        os.makedirs(args.export_path, exist_ok=True)
+        run_name = log.start_time.strftime('%Y%m%d%H%M%S')
+
+        for name, query, columns in [['quality', quality_query, scan_columns + quality_columns],
+                                     ['acquisition', acquisition_query, scan_columns + acquisition_columns]]:
+            export_file = os.path.join(args.export_path, f'{run_name}-{name}.{export_format}')
+            self.export_query(args, log, dbtools, query, columns, export_file, export_format)
+
+        return None
+
+    # ----------------------------
+    # index scan results (fills the result tables from the JSON of earlier runs)
+    # ----------------------------
+    def index_scan_results(self, log, dbtools):
+
+        scans = dbtools.get_db_unindexed_result_scans()
+        for scan in scans:
+            dbtools.set_db_scan_quality(scan.xnat_scan_id, get_quality_rows(scan.xnat_scan_id, scan.scan_quality))
+            dbtools.set_db_scan_acquisition(scan.xnat_scan_id, get_acquisition_row(scan.xnat_scan_id, scan.scan_acquisition))
+        dbtools.flush_database()
+
+        if scans:
+            log.info(f'Indexed results of {len(scans)} scans')
+
+        return None
+
+    # ----------------------------
+    # export query (streamed in chunks, written to a temporary file and renamed when complete)
+    # ----------------------------
+    def export_query(self, args, log, dbtools, query, columns, export_file, export_format):
+
+        start_time = time.perf_counter()
+        temp_file = f'{export_file}.tmp'
+        rows = 0
+        writer = None
+
+        with dbtools.db.engine.connect().execution_options(stream_results=True) as connection:
+            try:
+                for chunk in pd.read_sql(query, connection, chunksize=args.export_chunk_rows):
+                    # nullable integers (read as float when a chunk has nulls)
+                    for column in columns:
+                        if isinstance(column.type, INTEGER):
+                            chunk[column.name] = chunk[column.name].astype('Int64')
+                    if export_format == 'parquet':
+                        if writer is None:
+                            schema = pyarrow.schema([(column.name, get_arrow_type(column.type)) for column in columns])
+                            writer = pyarrow.parquet.ParquetWriter(temp_file, schema)
+                        writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                    else:
+                        chunk.to_csv(temp_file, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+                    rows += len(chunk)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+        # header only file for an empty result
+        if rows == 0:
+            if export_format == 'parquet':
+                pyarrow.parquet.write_table(pyarrow.schema([(column.name, get_arrow_type(column.type)) for column in columns]).empty_table(), temp_file)
+            else:
+                pd.DataFrame(columns=[column.name for column in columns]).to_csv(temp_file, index=False)
+
+        os.replace(temp_file, export_file)
+        log.info(f'Exported {rows} rows in {time.perf_counter() - start_time:.2f} s: {export_file}')
+
+        return None
+
+def get_arrow_type(column_type):
+    if isinstance(column_type, INTEGER):
+        return pyarrow.int64()
+    if isinstance(column_type, REAL):
+        return pyarrow.float64()
+    return pyarrow.string()
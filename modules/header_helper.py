@@ -0,0 +1,105 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+
+from models.dicom_header import DicomHeader, FILTER_TERMS, get_sort_field
+
+# ----------------------------
+# header helper
+# ----------------------------
+# header index (header_index in the config file): the result of the header pass
+# of a scan (all instances in sort order with their header record, file name and
+# filter verdict) is kept in <header_path>/<project>/<subject>/<experiment>/<scan>.json.gz,
+# so a rerun (e.g. reset, or only the acquisition tags missing) rebuilds the sorted,
+# filtered instances without downloading the headers again
+#
+# an index is used only while the file names of the scan and its DICOM resource
+# size recorded by indexing are those it was built from (the daemon updates the
+# size of a scan whose files changed); delete the file to rebuild it
+# ----------------------------
+
+# bumped when the header record or the filter changes (older indexes are rebuilt)
+INDEX_VERSION = 2
+
+# filter verdicts besides the filter tags of DicomHeader.get_filter_reason
+LEADING_INSTANCE = 'leading'
+MISSING_SORT_KEY = 'sort_key'
+
+# ----------------------------
+# load (None if the scan has no index or its files changed)
+# ----------------------------
+
+def load_header_index(args, scan, scan_files):
+
+    index_path = get_header_index_path(args, scan)
+    if not os.path.exists(index_path):
+        return None
+
+    try:
+        with gzip.open(index_path, 'rt') as json_file:
+            index = json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION or index.get('signature') != get_signature(scan, scan_files):
+        return None
+
+    dicom_files, filtered_dicom_files = [], []
+    for instance in index['instances']:
+        header = DicomHeader.from_dict(instance['header'], scan_files[instance['file_name']])
+        dicom_files.append(header)
+        if instance['filter'] is None:
+            filtered_dicom_files.append(header)
+
+    return dicom_files, filtered_dicom_files
+
+# ----------------------------
+# save (dicom_files in sort order, as left by filter_dicom_files)
+# ----------------------------
+
+def save_header_index(args, scan, scan_files, dicom_files, filtered_dicom_files):
+
+    file_names = {id(scan_file): file_name for file_name, scan_file in scan_files.items()}
+    kept = {id(header) for header in filtered_dicom_files}
+    missing_sort_key = get_sort_field(dicom_files) is None
+
+    instances = []
+    for position, header in enumerate(dicom_files):
+        if id(header) in kept:
+            verdict = None
+        elif missing_sort_key:
+            verdict = MISSING_SORT_KEY
+        elif position < 3 and len(dicom_files) > 3:
+            verdict = LEADING_INSTANCE
+        else:
+            verdict = header.get_filter_reason(FILTER_TERMS)
+        instances.append({'file_name': file_names[id(header.scan_file)], 'filter': verdict, 'header': header.to_dict()})
+
+    index = {
+        'version': INDEX_VERSION,
+        'signature': get_signature(scan, scan_files),
+        'instances': instances,
+    }
+
+    index_path = get_header_index_path(args, scan)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    # per process, a speculative run of the scan may save it at the same time
+    temp_path = f'{index_path}.{os.getpid()}.tmp'
+    with gzip.open(temp_path, 'wt') as json_file:
+        json.dump(index, json_file, default=str)
+    os.replace(temp_path, index_path)
+
+    return None
+
+# file names of the scan and the resource size recorded by indexing
+def get_signature(scan, scan_files):
+
+    digest = hashlib.sha1(json.dumps([sorted(scan_files), scan.scan_file_size]).encode('utf-8'))
+    return digest.hexdigest()
+
+def get_header_index_path(args, scan):
+    keys = [scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id]
+    keys = [re.sub(r'[^A-Za-z0-9_.-]', '_', str(key)) for key in keys]
+    return os.path.join(args['header_path'], *keys[:-1], f'{keys[-1]}.json.gz')
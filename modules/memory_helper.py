@@ -0,0 +1,174 @@
+from modules.concurrency_helper import get_download_threads
+
+# ----------------------------
+# memory helper
+# ----------------------------
+# admission control for the scan worker pool: a scan is only submitted when its
+# estimated peak memory fits the remaining budget (memory_budget_mb)
+#
+# estimates come from the indexed DICOM resource size and, once a scan has been
+# processed, the pixel dimensions and frame counts from its header pass; the
+# measured worker peak RSS of finished scans corrects the estimates per modality
+# ----------------------------
+
+MB = 1024 * 1024
+
+# typical image dimensions [rows, columns, frames] when nothing is known about a scan
+DEFAULT_DIMENSIONS = {
+    'CT': [512, 512, 1],
+    'MR': [256, 256, 1],
+    'MG': [3328, 2560, 1],
+}
+
+# bytes per pixel: stored pixels (2), normalized uint8 RGB copy (3) and the
+# float64 working arrays of the PIQE block loop (~7 x 8)
+PIXEL_BYTES = 2
+PIQE_PIXEL_BYTES = 3 + 7 * 8
+
+# header record and file listing entry per instance
+HEADER_BYTES = 4096
+
+# weight of a new measurement in the per-modality correction
+FEEDBACK_WEIGHT = 0.3
+
+class memory_helper(object):
+
+    def __init__(self, args, workers, log=None):
+
+        self.budget = args['memory_budget_mb'] * MB
+        self.worker_base = args['memory_worker_base_mb'] * MB
+        self.workers = workers
+        self.concurrency = get_download_threads(args) if args['multi_thread'] == True else 1
+        self.log = log
+
+        self.corrections = {}
+        self.reserved = {}
+        # scans admitted past the first waiting scan
+        self.head_skips = 0
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    @property
+    def used(self):
+        return sum(self.reserved.values())
+
+    # ----------------------------
+    # estimate
+    # ----------------------------
+
+    def estimate(self, scan):
+
+        modality = scan.scan_modality
+        rows, columns, frames = DEFAULT_DIMENSIONS.get(modality, DEFAULT_DIMENSIONS['MR'])
+        file_count = scan.scan_file_count or 0
+        file_size = (scan.scan_file_size / file_count) if scan.scan_file_size and file_count else 0
+
+        frame_pixels = rows * columns
+
+        # dimensions from a previous header pass
+        if scan.scan_rows and scan.scan_columns:
+            frame_pixels, frames = scan.scan_rows * scan.scan_columns, scan.scan_frames or 1
+        # otherwise derive the pixel count from the average file size (uncompressed 16 bit)
+        elif file_size:
+            pixels = file_size / PIXEL_BYTES
+            frames = max(1, round(pixels / frame_pixels))
+            frame_pixels = min(frame_pixels, pixels)
+
+        # PIQE scores up to 10 frames (or 10%) of a multi-frame instance, one instance per thread
+        scored_frames = frames if frames <= 10 else max(10, frames // 10)
+        instance = frame_pixels * (frames * PIXEL_BYTES + scored_frames * PIQE_PIXEL_BYTES)
+
+        estimate = self.worker_base + file_count * HEADER_BYTES + self.concurrency * (instance + file_size)
+
+        return int(estimate * self.corrections.get(modality, 1.0))
+
+    # ----------------------------
+    # admission
+    # ----------------------------
+    # always admits a scan into an idle pool, so a scan larger than the whole
+    # budget still runs (on its own) instead of blocking the queue
+    # ----------------------------
+
+    def admit(self, scan_key, estimate):
+
+        if len(self.reserved) >= self.workers:
+            return False
+        if self.reserved and self.used + estimate > self.budget:
+            return False
+
+        self.reserved[scan_key] = estimate
+
+        return True
+
+    def release(self, scan_key):
+        return self.reserved.pop(scan_key, 0)
+
+    # waiting queue items to submit (at most slots) and their estimates: first fit in
+    # order, and once the first waiting scan has been passed over by as many scans as
+    # there are workers, none until it fits (all of them without a budget)
+    def admit_items(self, pending_items, slots):
+
+        admitted = []
+        for index, item in enumerate(pending_items):
+            if len(admitted) >= slots:
+                break
+            # the first of the items not admitted
+            first = index == len(admitted)
+            if not self.enabled:
+                admitted.append((item, 0))
+                continue
+
+            estimate = self.estimate(item.scan)
+            if not self.admit(item.scan.xnat_scan_id, estimate):
+                if first and self.head_skips >= self.workers:
+                    break
+                continue
+            if self.log:
+                self.log.debug(f'Admitted scan {item.scan.scan_id} - estimate: {estimate / MB:.0f} MB | reserved: {self.used / MB:.0f} of {self.budget / MB:.0f} MB')
+            self.head_skips = 0 if first else self.head_skips + 1
+            admitted.append((item, estimate))
+
+        return admitted
+
+    # ----------------------------
+    # feedback
+    # ----------------------------
+
+    def observe(self, scan, estimate, peak_rss):
+
+        if not peak_rss or not estimate:
+            return None
+
+        modality = scan.scan_modality
+        correction = self.corrections.get(modality, 1.0)
+        ratio = (peak_rss * MB) / (estimate / correction)
+        self.corrections[modality] = (1 - FEEDBACK_WEIGHT) * correction + FEEDBACK_WEIGHT * ratio
+
+        return None
+
+# ----------------------------
+# worker peak RSS (linux /proc, None elsewhere)
+# ----------------------------
+# the peak is reset at the start of each scan so a long lived pool worker
+# reports the peak of the current scan rather than of its lifetime
+# ----------------------------
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+    return None
+
+def get_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
@@ -0,0 +1,223 @@
+import time
+import cv2
+import numpy as np
+from pypiqe import piqe
+
+from modules.piqe_tile_helper import PIQE_TILE_MIN_PIXELS, piqe_tiled
+
+# ----------------------------
+# metric helper
+# ----------------------------
+# image quality metrics run in one pass over each decoded slice: the slice is
+# wrapped in a FrameContext whose intermediates (normalized image, foreground,
+# local mean and variance, gradient, histogram) are computed once on first use
+# and shared by all enabled metrics
+#
+# metrics and intermediates register themselves by name, quality_metrics in the
+# config file selects the metrics per modality ({"CT": ["piqe", "snr"], "default": ["piqe"]})
+#
+# quality_downsample sets a scoring resolution per modality ({"MG": 1024}): slices
+# with a longer side are area-downsampled to it before any intermediate is computed
+# (see benchmark/quality_calibration.py to choose a size)
+#
+# the scoring options of a modality (metrics, downsample size, piqe tile
+# processes) are passed to the scoring functions as one dict (get_scoring)
+# ----------------------------
+
+METRICS = {}
+INTERMEDIATES = {}
+
+DEFAULT_METRICS = {'default': ['piqe']}
+
+# pixel types cv2.resize takes as they are
+RESIZE_DTYPES = [np.uint8, np.uint16, np.int16, np.float32, np.float64]
+
+# window of the local mean and variance maps
+LOCAL_WINDOW = 7
+
+def register_metric(name):
+    def register(function):
+        METRICS[name] = function
+        return function
+    return register
+
+def register_intermediate(name):
+    def register(function):
+        INTERMEDIATES[name] = function
+        return function
+    return register
+
+def get_metric_names(args, modality):
+
+    quality_metrics = args['quality_metrics'] or DEFAULT_METRICS
+    metric_names = quality_metrics.get(modality, quality_metrics.get('default', DEFAULT_METRICS['default']))
+
+    for name in metric_names:
+        if name not in METRICS:
+            raise Exception(f'Unknown quality metric {name} (available: {sorted(METRICS)})')
+
+    return metric_names
+
+def get_scoring(args, modality):
+    return {
+        'metrics': get_metric_names(args, modality),
+        'downsample_size': get_downsample_size(args, modality),
+        'piqe_tile_processes': args['piqe_tile_processes'],
+    }
+
+# longest side to score the slices of the modality at, None for full resolution
+def get_downsample_size(args, modality):
+
+    quality_downsample = args['quality_downsample'] or {}
+
+    return quality_downsample.get(modality, quality_downsample.get('default'))
+
+# area-downsample so the longest side is at most downsample_size
+def downsample_frame(frame, downsample_size):
+
+    if not downsample_size or max(frame.shape) <= downsample_size:
+        return frame
+
+    scale = downsample_size / max(frame.shape)
+    size = (max(1, round(frame.shape[1] * scale)), max(1, round(frame.shape[0] * scale)))
+    if frame.dtype not in RESIZE_DTYPES:
+        frame = frame.astype(np.float32)
+
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+# ----------------------------
+# frame context (intermediates computed once per slice)
+# ----------------------------
+
+class FrameContext(object):
+
+    def __init__(self, frame, scoring=None):
+
+        self.frame = frame
+        self.scoring = scoring or {}
+        self.shared_time = 0.0
+        self._intermediates = {}
+        self._depth = 0
+
+    def get(self, name):
+
+        if name not in self._intermediates:
+            # intermediates may use other intermediates, only the outermost one is timed
+            self._depth += 1
+            start_time = time.perf_counter()
+            try:
+                self._intermediates[name] = INTERMEDIATES[name](self)
+            finally:
+                self._depth -= 1
+            if self._depth == 0:
+                self.shared_time += time.perf_counter() - start_time
+
+        return self._intermediates[name]
+
+# score the enabled metrics of one slice; metric_times collects the seconds per metric
+# (excluding the shared intermediates, collected under 'shared')
+def score_frame(frame, scoring, metric_times):
+
+    context = FrameContext(frame, scoring)
+    scores = {}
+
+    for name in scoring['metrics']:
+        shared_time = context.shared_time
+        start_time = time.perf_counter()
+        scores[f'{name}_score'] = METRICS[name](context)
+        metric_times[name] = metric_times.get(name, 0.0) + (time.perf_counter() - start_time) - (context.shared_time - shared_time)
+
+    metric_times['shared'] = metric_times.get('shared', 0.0) + context.shared_time
+
+    return scores
+
+def merge_metric_times(metric_times, other_times):
+    for name, seconds in other_times.items():
+        metric_times[name] = metric_times.get(name, 0.0) + seconds
+    return metric_times
+
+# ----------------------------
+# intermediates
+# ----------------------------
+
+# slice at the scoring resolution
+@register_intermediate('scoring_frame')
+def get_scoring_frame(context):
+    return downsample_frame(context.frame, context.scoring.get('downsample_size'))
+
+# normalized to 8 bit (min-max)
+@register_intermediate('image')
+def get_image(context):
+    return cv2.normalize(context.get('scoring_frame'), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+
+@register_intermediate('image_float')
+def get_image_float(context):
+    return context.get('image').astype(np.float32)
+
+# Otsu threshold of the normalized image
+@register_intermediate('foreground')
+def get_foreground(context):
+    _, mask = cv2.threshold(context.get('image'), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return mask > 0
+
+@register_intermediate('local_mean')
+def get_local_mean(context):
+    return cv2.boxFilter(context.get('image_float'), -1, (LOCAL_WINDOW, LOCAL_WINDOW))
+
+@register_intermediate('local_variance')
+def get_local_variance(context):
+    image = context.get('image_float')
+    local_mean = context.get('local_mean')
+    return np.maximum(cv2.boxFilter(image * image, -1, (LOCAL_WINDOW, LOCAL_WINDOW)) - local_mean * local_mean, 0)
+
+@register_intermediate('gradient')
+def get_gradient(context):
+    image = context.get('image_float')
+    return cv2.magnitude(cv2.Sobel(image, cv2.CV_32F, 1, 0), cv2.Sobel(image, cv2.CV_32F, 0, 1))
+
+@register_intermediate('histogram')
+def get_histogram(context):
+    return np.bincount(context.get('image').ravel(), minlength=256)
+
+# ----------------------------
+# metrics (None when undefined for the slice, e.g. no foreground)
+# ----------------------------
+
+# scored on the grayscale image (PIQE converts a 3-channel image to the same gray values),
+# large images in row tiles across the piqe tile pool when piqe_tile_processes is set
+@register_metric('piqe')
+def get_piqe_score(context):
+    image = context.get('image')
+    if context.scoring.get('piqe_tile_processes') and image.size >= PIQE_TILE_MIN_PIXELS:
+        return float(piqe_tiled(image, context.scoring['piqe_tile_processes']))
+    return float(piqe(image)[0])
+
+# mean foreground signal over the median local standard deviation in the foreground
+@register_metric('snr')
+def get_snr_score(context):
+    foreground = context.get('foreground')
+    if not foreground.any():
+        return None
+    noise = float(np.median(np.sqrt(context.get('local_variance')[foreground])))
+    return float(context.get('image_float')[foreground].mean() / noise) if noise > 0 else None
+
+# shannon entropy (bits) of the normalized image histogram
+@register_metric('entropy')
+def get_entropy_score(context):
+    histogram = context.get('histogram')
+    probabilities = histogram[histogram > 0] / histogram.sum()
+    return float((probabilities * np.log2(1 / probabilities)).sum())
+
+# mean gradient magnitude in the foreground (Tenengrad)
+@register_metric('sharpness')
+def get_sharpness_score(context):
+    foreground = context.get('foreground')
+    return float(context.get('gradient')[foreground].mean()) if foreground.any() else None
+
+# mean local standard deviation over local mean in the foreground
+@register_metric('contrast')
+def get_contrast_score(context):
+    foreground = context.get('foreground') & (context.get('local_mean') > 0)
+    if not foreground.any():
+        return None
+    return float((np.sqrt(context.get('local_variance')[foreground]) / context.get('local_mean')[foreground]).mean())
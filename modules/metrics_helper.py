@@ -0,0 +1,60 @@
+import time
+
+# ----------------------------
+# metrics helper
+# ----------------------------
+# collects per-scan stage times and counters in the worker so they can be
+# returned to the parent process (plain dicts, picklable)
+# ----------------------------
+
+class metrics_helper(object):
+
+    def __init__(self, project_id=None, subject_id=None, experiment_id=None, scan_id=None):
+
+        self.keys = {
+            'project_id': project_id,
+            'subject_id': subject_id,
+            'experiment_id': experiment_id,
+            'scan_id': scan_id,
+        }
+        self.stage_times = {}
+        self.counters = {}
+        self.peak_rss_mb = None
+        self.decode = {}
+        self.quality_metrics = {}
+        self.downloads = {}
+        # summary of the results of the scan (quality averages, normalization output)
+        self.results = {}
+        self.start_time = time.perf_counter()
+
+    # ----------------------------
+    # stage times
+    # ----------------------------
+
+    def start_stage(self):
+        return time.perf_counter()
+
+    def end_stage(self, stage, stage_start):
+        self.stage_times[stage] = self.stage_times.get(stage, 0.0) + (time.perf_counter() - stage_start)
+        return None
+
+    # ----------------------------
+    # counters
+    # ----------------------------
+
+    def count(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+        return None
+
+    def to_dict(self):
+        return {
+            **self.keys,
+            'total_time': time.perf_counter() - self.start_time,
+            'stage_times': dict(self.stage_times),
+            'counters': dict(self.counters),
+            'peak_rss_mb': self.peak_rss_mb,
+            'decode': self.decode,
+            'quality_metrics': dict(self.quality_metrics),
+            'downloads': dict(self.downloads),
+            'results': dict(self.results),
+        }
@@ -1,12 +1,376 @@
-import pydicom as dicom
+import os
+import cv2
+import json
+import numpy as np
+from modules.xnat_tools import get_worker_xnat_tools
+from modules.db_tools import get_worker_db_tools
+from modules.quality_tools import quality_tools
+from modules.stage_tools import stage_tools
+
+from modules.log_helper import log_helper
+from modules.metrics_helper import metrics_helper
+from modules.memory_helper import reset_peak_rss, get_peak_rss_mb
+from modules.pool_helper import run_scan_pool
+from modules.queue_helper import scan_queue
+from modules.archive_helper import queue_archive_scans, get_archive_files, release_archive_files
+from modules.decode_helper import reset_decode_statistics, get_decode_statistics
+from modules.concurrency_helper import configure_downloads, reset_download_statistics, get_download_statistics
+from modules.straggler_helper import check_worker_run, claim_worker_run
+
+import concurrent.futures as futures
+
+# histogram resolution for the percentile pass
+HISTOGRAM_BINS = 65536
+
+# normalization_method values (none only clips)
+NORMALIZATION_METHODS = ['zscore', 'minmax', 'none']
+
+# ----------------------------
+# normalization tools
+# ----------------------------
+# streaming normalization of the staged volume of each scan: the volume is read
+# in slabs of normalization_chunk_slices frames, so memory stays bounded by the
+# slab size (times the thread pool workers) whatever the number of slices
+#   pass 1 - value range
+#   pass 2 - histogram (percentile clipping)
+#   pass 3 - mean and standard deviation of the clipped values (z-score)
+#   pass 4 - intensity transform, resampling to the target spacing, write normalized.npy
+# ----------------------------
 
 class normalization_tools(object):
-    
-    def __init__(self):
-        # Add any initialization stuff here.
-        # self.
-        a='a'
-        
+
     def run_normalization_functions(self, args, log, xtools, dbtools):
 
-        return None
\ No newline at end of file
+        # before any scan is staged
+        self.check_normalization_method(args.getArgs())
+
+        scan_keys = quality_tools().get_scan_keys(args, log, dbtools)
+
+        return self.normalize_project(args.getArgs(), log, scan_keys, xtools, dbtools)
+
+    # ----------------------------
+    # normalize project
+    # ----------------------------
+    def normalize_project(self, args, log, scan_keys, xtools, dbtools):
+
+        # experiment archives (scans without a staged volume)
+        queue = None
+        if args['experiment_archive'] == True:
+            queue = scan_queue(keep_results=True)
+            queue_archive_scans(args, log, queue, scan_keys, ['normalization_functions'], xtools, dbtools, close=True)
+
+        return run_scan_pool(args, log, scan_keys, 'normalization_functions', xtools, dbtools, queue=queue)
+
+    # ----------------------------
+    # normalize scans
+    # ----------------------------
+    def normalize_scan(self, scan, args, log, xtools, dbtools):
+
+        log = log_helper(log.start_time, log.prog_name, log.log_path, log.log_level)
+
+        metrics = metrics_helper(scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id)
+
+        reset_peak_rss()
+        reset_decode_statistics()
+        configure_downloads(args, log)
+        reset_download_statistics()
+        try:
+            self.process_scan(scan, args, log, xtools, dbtools, metrics)
+        finally:
+            metrics.peak_rss_mb = get_peak_rss_mb()
+            metrics.decode = get_decode_statistics()
+            metrics.downloads = get_download_statistics()
+            if args['experiment_archive'] == True:
+                release_archive_files(args, scan, 'normalization_functions')
+
+        return metrics.to_dict()
+
+    def process_scan(self, scan, args, log, xtools, dbtools, metrics):
+
+        log.info(f'Normalizing Scan {scan.scan_id}')
+
+        if not xtools:
+            xtools = get_worker_xnat_tools(args)
+        if not dbtools:
+            dbtools = get_worker_db_tools(args)
+
+        edit_scan = dbtools.get_db_scan(scan.xnat_scan_id)
+
+        if edit_scan is None:
+            return None
+
+        if edit_scan.scan_modality not in ['MR', 'CT', 'MG']:
+            return None
+
+        # if reset or scan_normalization is blank
+        if args['reset'] != True and edit_scan.scan_normalization:
+            metrics.results['normalization'] = json.loads(edit_scan.scan_normalization).get('output')
+            return None
+
+        try:
+            xnat_scan = xtools.get_xnat_element(edit_scan.project_id, edit_scan.subject_id, edit_scan.experiment_id, edit_scan.scan_id)
+        except KeyError as exc:
+            log.warning("Cannot find subject from the database on XNAT; skipping subject.")
+            log.info(exc)
+            return None
+
+        # staged volume (shared with quality when stage_volumes is enabled), staged here otherwise
+        stage = stage_tools()
+        volume = stage.load_volume(args, edit_scan)
+        staged = False
+
+        if volume is None:
+            scan_files = get_archive_files(args, edit_scan) if args['experiment_archive'] == True else None
+            if scan_files is None:
+                file_records = dbtools.get_db_file_list(edit_scan.xnat_scan_id) if args['file_catalog'] == True else None
+                scan_files = xtools.get_scan_files(xnat_scan, file_records)
+            if not scan_files:
+                log.warning(f'No DICOM files for scan {edit_scan.scan_id}; skipping normalization.')
+                return None
+
+            qtools = quality_tools()
+
+            stage_start = metrics.start_stage()
+            metrics.count('files', len(scan_files))
+            dicom_files, filtered_dicom_files = qtools.get_scan_headers(args, log, edit_scan, scan_files, metrics, stage_start)
+            qtools.set_scan_dimensions(edit_scan, dicom_files)
+
+            if not filtered_dicom_files:
+                log.warning(f'No DICOM files left after filtering scan {edit_scan.scan_id}; skipping normalization.')
+                return None
+
+            stage_start = metrics.start_stage()
+            volume = stage.stage_volume(args, log, edit_scan, filtered_dicom_files, qtools.read_dicom)
+            staged = True
+            metrics.end_stage('stage', stage_start)
+
+        stage_start = metrics.start_stage()
+        try:
+            normalization = self.normalize_volume(args, log, volume)
+        finally:
+            # a volume staged only for normalization is removed once normalized.npy is written (kept with stage_volumes)
+            if staged and args['stage_volumes'] != True:
+                stage.remove_volume(volume)
+        metrics.end_stage('normalization', stage_start)
+        metrics.count('normalized_slices', normalization['output']['shape'][0])
+
+        edit_scan.scan_normalization = json.dumps(normalization)
+        metrics.results['normalization'] = normalization['output']
+        log.info(f'Scan normalization: {edit_scan.scan_normalization}')
+
+        # only the run of the scan that claims it writes the results (speculative runs, deadlines)
+        claim_worker_run()
+        stage_start = metrics.start_stage()
+        xtools.set_scan_json_resource(args, log, xnat_scan, edit_scan.scan_normalization, 'normalization')
+        dbtools.flush_database()
+        metrics.end_stage('upload', stage_start)
+
+        return None
+
+    # ----------------------------
+    # normalize volume
+    # ----------------------------
+    def normalize_volume(self, args, log, volume):
+
+        self.check_normalization_method(args)
+
+        array = volume.array
+        slopes, intercepts = volume.get_rescale()
+        chunk_slices = max(1, args['normalization_chunk_slices'])
+        slabs = [(start, min(start + chunk_slices, array.shape[0])) for start in range(0, array.shape[0], chunk_slices)]
+
+        method = args['normalization_method']
+        percentiles = args['normalization_percentiles']
+        ct_window = args['normalization_ct_window'] if volume.modality == 'CT' else None
+        window_range = [ct_window[0] - ct_window[1] / 2, ct_window[0] + ct_window[1] / 2] if ct_window else None
+
+        # modality values (rescaled, CT windowed) of a slab as float32
+        def read_slab(start, stop):
+            slab = array[start:stop].astype(np.float32)
+            slab *= slopes[start:stop, None, None]
+            slab += intercepts[start:stop, None, None]
+            if window_range:
+                np.clip(slab, window_range[0], window_range[1], out=slab)
+            return slab
+
+        # pass 1 - value range
+        slab_ranges = self.map_slabs(args, slabs, lambda start, stop: self.get_slab_range(read_slab(start, stop)))
+        value_min = float(min(x[0] for x in slab_ranges))
+        value_max = float(max(x[1] for x in slab_ranges))
+        statistics = {'min': value_min, 'max': value_max}
+
+        # pass 2 - percentile clipping bounds
+        clip_range = [value_min, value_max]
+        if percentiles and value_max > value_min:
+            histogram = sum(self.map_slabs(args, slabs, lambda start, stop: np.histogram(read_slab(start, stop), bins=HISTOGRAM_BINS, range=(value_min, value_max))[0]))
+            clip_range = [self.get_histogram_percentile(histogram, value_min, value_max, percentile) for percentile in percentiles]
+            statistics['percentile_low'], statistics['percentile_high'] = clip_range
+
+        # pass 3 - mean and standard deviation of the clipped values
+        if method == 'zscore':
+            slab_moments = self.map_slabs(args, slabs, lambda start, stop: self.get_slab_moments(np.clip(read_slab(start, stop), clip_range[0], clip_range[1])))
+            statistics['mean'], statistics['std'] = self.combine_moments(slab_moments)
+
+        def transform(slab):
+            np.clip(slab, clip_range[0], clip_range[1], out=slab)
+            if method == 'zscore':
+                slab -= statistics['mean']
+                slab /= statistics['std'] if statistics['std'] > 0 else 1.0
+            elif method == 'minmax':
+                slab -= clip_range[0]
+                slab /= (clip_range[1] - clip_range[0]) if clip_range[1] > clip_range[0] else 1.0
+            return slab
+
+        # pass 4 - transform, resample and write
+        output_spacing, output_shape = self.get_output_geometry(log, array.shape, volume.spacing, args['normalization_spacing'])
+        z_index, z_weight = self.get_slice_interpolation(array.shape[0], output_shape[0])
+
+        output_path = os.path.join(volume.volume_path, 'normalized.npy')
+        # per process, a speculative run of the scan may write it at the same time
+        output_temp_path = os.path.join(volume.volume_path, f'normalized.{os.getpid()}.tmp.npy')
+        output_array = np.lib.format.open_memmap(output_temp_path, mode='w+', dtype=np.float32, shape=tuple(output_shape))
+
+        def write_slab(start, stop):
+            # source slices needed for the output slices start..stop
+            source_start = int(z_index[start])
+            source_stop = int(min(z_index[stop - 1] + 1, array.shape[0] - 1)) + 1
+            source = transform(read_slab(source_start, source_stop))
+            if tuple(source.shape[1:]) != tuple(output_shape[1:]):
+                source = np.stack([cv2.resize(x, (output_shape[2], output_shape[1]), interpolation=cv2.INTER_LINEAR) for x in source])
+            lower = z_index[start:stop] - source_start
+            upper = np.minimum(lower + 1, source.shape[0] - 1)
+            weight = z_weight[start:stop, None, None]
+            output_array[start:stop] = source[lower] * (1 - weight) + source[upper] * weight
+            return None
+
+        output_slabs = [(start, min(start + chunk_slices, output_shape[0])) for start in range(0, output_shape[0], chunk_slices)]
+        try:
+            self.map_slabs(args, output_slabs, write_slab)
+            output_array.flush()
+        except BaseException:
+            # a cancelled run leaves no partial file
+            del output_array
+            os.remove(output_temp_path)
+            raise
+        del output_array
+        os.replace(output_temp_path, output_path)
+
+        log.info(f'Normalized volume {list(array.shape)} -> {output_shape}: {output_path}')
+
+        return {
+            'method': method,
+            'percentiles': percentiles,
+            'ct_window': ct_window,
+            'target_spacing': args['normalization_spacing'],
+            'statistics': statistics,
+            'input': {
+                'shape': list(array.shape),
+                'spacing': volume.spacing,
+                'dtype': str(array.dtype),
+            },
+            'output': {
+                'path': os.path.relpath(output_path, args['data_path']),
+                'shape': output_shape,
+                'spacing': output_spacing,
+                'dtype': 'float32',
+            },
+        }
+
+    def check_normalization_method(self, args):
+
+        if args['normalization_method'] not in NORMALIZATION_METHODS:
+            raise ValueError(f"normalization_method {args['normalization_method']!r} is not one of {NORMALIZATION_METHODS}")
+
+        return None
+
+    # ----------------------------
+    # slab map (thread pool workers share the memory map)
+    # ----------------------------
+    def map_slabs(self, args, slabs, function):
+
+        # ----------------------------
+        # Multi-threaded
+        # ----------------------------
+
+        # a cancelled run stops between slabs
+        def map_slab(start, stop):
+            check_worker_run()
+            return function(start, stop)
+
+        if args['multi_thread'] == True:
+            with futures.ThreadPoolExecutor(max_workers=args['multi_thread_workers']) as executor:
+                return list(executor.map(lambda slab: map_slab(*slab), slabs))
+
+        # ----------------------------
+        # Single-threaded
+        # ----------------------------
+
+        return [map_slab(*slab) for slab in slabs]
+
+    # ----------------------------
+    # slab statistics
+    # ----------------------------
+    def get_slab_range(self, slab):
+        return slab.min(), slab.max()
+
+    def get_slab_moments(self, slab):
+        mean = slab.mean(dtype=np.float64)
+        return slab.size, mean, float(np.square(slab - mean, dtype=np.float64).sum())
+
+    # parallel variance (Chan et al.) over the slab moments
+    def combine_moments(self, slab_moments):
+
+        count, mean, m2 = 0, 0.0, 0.0
+        for slab_count, slab_mean, slab_m2 in slab_moments:
+            total = count + slab_count
+            delta = slab_mean - mean
+            mean += delta * slab_count / total
+            m2 += slab_m2 + delta * delta * count * slab_count / total
+            count = total
+
+        return float(mean), float(np.sqrt(m2 / count)) if count else 0.0
+
+    def get_histogram_percentile(self, histogram, value_min, value_max, percentile):
+
+        cumulative = np.cumsum(histogram)
+        target = cumulative[-1] * percentile / 100
+        index = int(np.searchsorted(cumulative, target))
+        index = min(index, len(histogram) - 1)
+
+        # interpolate within the bin
+        below = cumulative[index - 1] if index > 0 else 0
+        fraction = (target - below) / histogram[index] if histogram[index] else 0.0
+        bin_width = (value_max - value_min) / len(histogram)
+
+        return float(value_min + (index + fraction) * bin_width)
+
+    # ----------------------------
+    # resampling geometry
+    # ----------------------------
+    def get_output_geometry(self, log, shape, spacing, target_spacing):
+
+        if not target_spacing:
+            return list(spacing), list(shape)
+
+        output_spacing = []
+        output_shape = []
+        for axis, size in enumerate(shape):
+            if target_spacing[axis] and spacing[axis]:
+                output_spacing.append(float(target_spacing[axis]))
+                output_shape.append(max(1, int(round(size * spacing[axis] / target_spacing[axis]))))
+            else:
+                if target_spacing[axis]:
+                    log.warning(f'Unknown spacing for axis {axis}; keeping {size} samples')
+                output_spacing.append(spacing[axis])
+                output_shape.append(size)
+
+        return output_spacing, output_shape
+
+    # source slice index and weight of each output slice (linear, slice centers aligned)
+    def get_slice_interpolation(self, source_slices, output_slices):
+
+        positions = (np.arange(output_slices) + 0.5) * source_slices / output_slices - 0.5
+        positions = np.clip(positions, 0, source_slices - 1)
+        index = np.floor(positions).astype(np.int64)
+
+        return index, (positions - index).astype(np.float32)
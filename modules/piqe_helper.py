@@ -0,0 +1,84 @@
+import random
+import numpy as np
+from multiprocessing import shared_memory
+
+from modules.pool_helper import get_process_pool
+from modules.metric_helper import score_frame
+
+# ----------------------------
+# piqe helper
+# ----------------------------
+# quality metric scoring (PIQE and the other metrics enabled for the modality, see
+# metric_helper) shared by the thread pool and the process pool compute modes
+#   threads   - get_piqe runs decode and scoring on the scan thread pool (GIL bound)
+#   processes - I/O threads decode into shared memory blocks (or pass the staged
+#               volume), a process pool scores the frames in place without pickling
+# ----------------------------
+
+def get_piqe_pool(processes):
+    return get_process_pool('piqe', processes)
+
+# ----------------------------
+# frames
+# ----------------------------
+
+# random sample of 10% (no less than 10) of the frames of a multi-frame instance
+def sample_frames(shape):
+
+    if len(shape) == 3:
+        list_length = shape[0]
+        sample_size = max(10, int(list_length * 0.1))
+        sample_size = min(sample_size, list_length)  # Ensure sample size does not exceed list length
+        return random.sample(range(list_length), sample_size), True
+    elif len(shape) > 3:
+        raise Exception(f'Unsupported pixel array shape {shape}')
+
+    return [0], False
+
+def get_frame(pixel_array, frame_index):
+    return pixel_array[frame_index] if len(pixel_array.shape) == 3 else pixel_array
+
+# one score dict per frame and the seconds spent per metric
+def score_frames(pixel_array, frame_indices, scoring):
+    metric_times = {}
+    scores = [score_frame(get_frame(pixel_array, frame_index), scoring, metric_times) for frame_index in frame_indices]
+    return scores, metric_times
+
+# ----------------------------
+# process pool tasks (attach to the pixels, nothing but the scores is pickled)
+# ----------------------------
+
+def score_shared_frames(shm_name, shape, dtype, frame_indices, scoring):
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pixel_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        scores = score_frames(pixel_array, frame_indices, scoring)
+        del pixel_array
+    finally:
+        shm.close()
+
+    return scores
+
+def score_volume_frames(volume_file, frame_start, frame_count, frame_indices, scoring):
+
+    volume_array = np.load(volume_file, mmap_mode='r')
+    pixel_array = volume_array[frame_start] if frame_count == 1 else volume_array[frame_start:frame_start + frame_count]
+
+    return score_frames(pixel_array, frame_indices, scoring)
+
+# ----------------------------
+# shared memory
+# ----------------------------
+
+def create_shared_array(pixel_array):
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, pixel_array.nbytes))
+    np.ndarray(pixel_array.shape, dtype=pixel_array.dtype, buffer=shm.buf)[:] = pixel_array
+
+    return shm
+
+def release_shared_array(shm):
+    shm.close()
+    shm.unlink()
+    return None
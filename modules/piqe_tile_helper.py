@@ -0,0 +1,117 @@
+import numpy as np
+import cv2
+from multiprocessing import shared_memory
+from pypiqe.piqe import noticeDistCriterion, noiseCriterion
+
+from modules.pool_helper import get_process_pool
+
+# ----------------------------
+# piqe tile helper
+# ----------------------------
+# PIQE of one image scored in block-aligned row tiles across a process pool
+# (piqe_tile_processes in the config file), for single large slices that would
+# otherwise be scored on one core
+#
+# same steps as pypiqe.piqe: the padded, 0-255 scaled image is prepared once and
+# shared; each tile reads PIQE_HALO extra rows on either side so its 7x7 gaussian
+# normalization matches the whole image, and returns the distortion of each of
+# its active blocks; the parent adds them up in block order, so the score is
+# identical to pypiqe.piqe on the whole image
+# ----------------------------
+
+PIQE_BLOCK_SIZE = 16
+PIQE_ACTIVITY_THRESHOLD = 0.1
+PIQE_BLOCK_IMPAIRED_THRESHOLD = 0.1
+PIQE_WINDOW_SIZE = 6
+# rows on either side of a tile read by the 7x7 gaussian window
+PIQE_HALO = 3
+
+# tiles per process (smaller tiles balance the blocks with more activity)
+TILES_PER_PROCESS = 4
+
+# smaller images are scored whole (the pool round trip costs more than it saves)
+PIQE_TILE_MIN_PIXELS = 1024 * 1024
+
+def get_piqe_tile_pool(processes):
+    return get_process_pool('piqe_tiles', processes)
+
+# ----------------------------
+# tiled piqe (parent)
+# ----------------------------
+
+def piqe_tiled(image, processes):
+
+    ip_image = get_piqe_input(image)
+    block_rows = ip_image.shape[0] // PIQE_BLOCK_SIZE
+    tiles = min(block_rows, processes * TILES_PER_PROCESS)
+    bounds = [PIQE_BLOCK_SIZE * (block_rows * tile // tiles) for tile in range(tiles + 1)]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, ip_image.nbytes))
+    try:
+        np.ndarray(ip_image.shape, dtype=ip_image.dtype, buffer=shm.buf)[:] = ip_image
+        pool = get_piqe_tile_pool(processes)
+        tile_futures = [pool.submit(score_piqe_tile, shm.name, ip_image.shape, ip_image.dtype.str, row_start, row_end)
+                        for row_start, row_end in zip(bounds[:-1], bounds[1:])]
+        tile_results = [future.result() for future in tile_futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # accumulated in block order, as pypiqe does
+    dist_block_scores = 0
+    active_blocks = 0
+    for block_scores in tile_results:
+        for block_score in block_scores:
+            dist_block_scores += block_score
+        active_blocks += len(block_scores)
+
+    return ((dist_block_scores + 1) / (1 + active_blocks)) * 100
+
+# padded to whole blocks (symmetric) and scaled to 0-255 by the image maximum
+def get_piqe_input(image):
+
+    rows, columns = image.shape[:2]
+    rows_pad = (PIQE_BLOCK_SIZE - rows % PIQE_BLOCK_SIZE) % PIQE_BLOCK_SIZE
+    columns_pad = (PIQE_BLOCK_SIZE - columns % PIQE_BLOCK_SIZE) % PIQE_BLOCK_SIZE
+    if rows_pad > 0 or columns_pad > 0:
+        image = np.pad(image, ((0, rows_pad), (0, columns_pad)), mode='symmetric')
+
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    return np.round(255 * (image / np.max(image)))
+
+# ----------------------------
+# process pool task (distortion of the active blocks of rows row_start to row_end)
+# ----------------------------
+
+def score_piqe_tile(shm_name, shape, dtype, row_start, row_end):
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        ip_image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        halo_start = max(0, row_start - PIQE_HALO)
+        halo_end = min(shape[0], row_end + PIQE_HALO)
+        tile = np.array(ip_image[halo_start:halo_end])
+        del ip_image
+    finally:
+        shm.close()
+
+    mu = cv2.GaussianBlur(tile, ksize=(7, 7), sigmaX=7/6, borderType=cv2.BORDER_REPLICATE)
+    sigma = np.sqrt(np.abs(cv2.GaussianBlur(tile * tile, ksize=(7, 7), sigmaX=7/6, borderType=cv2.BORDER_REPLICATE) - mu * mu))
+    imnorm = ((tile - mu) / (sigma + 1))[row_start - halo_start:row_end - halo_start]
+
+    n_segments = PIQE_BLOCK_SIZE - PIQE_WINDOW_SIZE + 1
+    block_scores = []
+    for i in range(0, imnorm.shape[0], PIQE_BLOCK_SIZE):
+        for j in range(0, imnorm.shape[1], PIQE_BLOCK_SIZE):
+            block = imnorm[i:i + PIQE_BLOCK_SIZE, j:j + PIQE_BLOCK_SIZE]
+            block_var = np.var(block, ddof=1)
+            if block_var > PIQE_ACTIVITY_THRESHOLD:
+                block_impaired = noticeDistCriterion(block, n_segments, PIQE_BLOCK_SIZE - 1, PIQE_WINDOW_SIZE, PIQE_BLOCK_IMPAIRED_THRESHOLD, PIQE_BLOCK_SIZE)
+                block_sigma, block_beta = noiseCriterion(block, PIQE_BLOCK_SIZE - 1, block_var)
+                wndc = 1 if block_impaired else 0
+                wnc = 1 if block_sigma > 2 * block_beta else 0
+                block_scores.append(wndc * (1 - block_var) + wnc * block_var)
+
+    return block_scores
@@ -0,0 +1,259 @@
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+from modules.memory_helper import memory_helper
+from modules.worker_helper import run_worker_scan, get_worker_context
+from modules.concurrency_helper import aimd_controller
+from modules.queue_helper import scan_queue
+from modules.straggler_helper import straggler_helper, CHECK_INTERVAL, CANCEL_GRACE
+
+import concurrent.futures as futures
+from concurrent.futures.process import BrokenProcessPool
+
+# ----------------------------
+# pool helper
+# ----------------------------
+# runs the scan function of a stage (quality_functions, normalization_functions)
+# over a list of scans, or the scans of the daemon queue as they arrive, in a
+# process pool with memory budget admission and, with adaptive_concurrency, an
+# AIMD limit on the scans in flight (multi_proc) or in this process, and
+# deadlines and speculative copies of the scans in flight (straggler helper);
+# process pools for work within a scan (piqe, decode) are kept per process
+# ----------------------------
+
+# seconds between looks at the queue while the daemon waits for scans
+QUEUE_WAIT = 1
+
+SCAN_POOL = 'scan_workers'
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+def run_scan_pool(args, log, scan_list, stage, xtools, dbtools, queue=None):
+
+    # a batch run processes the scan list for one stage, the daemon passes its (open) queue
+    if queue is None:
+        queue = scan_queue.from_list(scan_list, stage)
+
+    # ----------------------------
+    # Multi-processing
+    # Set the number of CPUs in the config file.
+    # ----------------------------
+
+    if args['multi_proc'] == True:
+
+        workers = 60 if args['multi_proc_cpu'] > 60 else args['multi_proc_cpu'] if args['multi_proc_cpu'] >= 1 else 1
+
+        # adaptive concurrency - the pool is sized to the upper bound, the controller limits the scans in flight
+        # (cpu utilization, failed scans and the download latency and errors reported by the workers)
+        controller = None
+        if args['adaptive_concurrency']:
+            bounds = [min(60, bound) for bound in args['adaptive_worker_bounds']]
+            controller = aimd_controller('scan workers', bounds, workers, args['adaptive_interval'], log, cpu=True)
+            workers = controller.maximum
+
+        # memory budget admission (set memory_budget_mb in the config file, 0 submits all scans at once)
+        memory = memory_helper(args, workers, log)
+
+        # deadlines and speculative copies of the running scans (straggler helper, which keeps the runs in flight)
+        straggler = straggler_helper(args, log, stage)
+
+        # the daemon keeps its scan workers (and their imports and pools) between scans
+        wait_timeout = args['adaptive_interval'] if controller else None
+        if args['daemon'] == True:
+            wait_timeout = min(wait_timeout or QUEUE_WAIT, QUEUE_WAIT)
+        if straggler.enabled:
+            wait_timeout = min(wait_timeout or CHECK_INTERVAL, CHECK_INTERVAL)
+
+        executor = get_scan_pool(args, workers) if args['daemon'] == True else futures.ProcessPoolExecutor(max_workers=workers, mp_context=get_worker_context(args))
+
+        straggler.start_runs(args)
+
+        def submit(item, estimate, speculative):
+            run_args, run_id = straggler.get_run_args(get_item_args(args, item), item)
+            future = executor.submit(run_worker_scan, item.stages[0], item.scan, run_args, log, xtools=None, dbtools=None)
+            straggler.add_run(future, item, estimate, speculative, run_id)
+            return None
+
+        try:
+            while not queue.finished() or straggler.busy:
+
+                # process scans (memory admission within the slots left)
+                pending_items = queue.pending()
+                for item, estimate in memory.admit_items(pending_items, get_slots(args, workers, pending_items, controller, straggler)):
+                    pending_items.remove(item)
+                    queue.take(item)
+                    submit(item, estimate, False)
+
+                # speculative copies on the workers left idle once no scan is waiting
+                if straggler.speculative and not pending_items:
+                    for item in straggler.get_speculative_runs(workers - straggler.busy):
+                        log.info(f'Speculative run - project: {item.scan.project_id} | experiment: {item.scan.experiment_id} | scan: {item.scan.scan_id}')
+                        submit(item, 0, True)
+
+                if not straggler.busy:
+                    queue.wait(QUEUE_WAIT)
+                    continue
+
+                done_futures, _ = futures.wait(straggler.get_futures(), timeout=wait_timeout, return_when=futures.FIRST_COMPLETED)
+
+                broken = False
+                completed = 0
+                for future in done_futures:
+                    broken = broken or is_broken(future)
+                    scan_run = straggler.end_run(future)
+                    if scan_run is None:
+                        continue
+                    item, estimate, speculative, result, error = scan_run
+                    memory.release(item.scan.xnat_scan_id)
+                    completed += 1
+                    if error is None:
+                        memory.observe(item.scan, estimate, result['peak_rss_mb'])
+                        queue.complete(item, {**result, 'attempts': straggler.get_attempts(item), 'speculative': speculative})
+                        if controller:
+                            controller.observe_scan(result)
+                    elif isinstance(error, futures.CancelledError):
+                        # not started by a pool that was replaced
+                        queue.retry(item)
+                    else:
+                        log.error(f'Project Scan Error - error: {str(error)}')
+                        queue.complete(item, error=str(error))
+                        if controller:
+                            controller.observe_scan()
+
+                # scans past their deadline are run again or failed, the stage deadline drops the waiting scans
+                stage_expired = straggler.stage_expired()
+                if stage_expired:
+                    log.warning(f'Stage timeout {stage} - scans waiting: {len(pending_items)} | running: {len(straggler.scan_runs)}')
+                    queue.close(cancel=True)
+                for item, reason, retried in straggler.sweep(stage_expired, broken):
+                    memory.release(item.scan.xnat_scan_id)
+                    if retried:
+                        log.warning(f'Scan {reason}, running it again - project: {item.scan.project_id} | experiment: {item.scan.experiment_id} | scan: {item.scan.scan_id}')
+                        queue.retry(item)
+                    else:
+                        log.error(f'Project Scan Error - error: cancelled, {reason} - project: {item.scan.project_id} | experiment: {item.scan.experiment_id} | scan: {item.scan.scan_id}')
+                        queue.complete(item, error=f'cancelled, {reason}')
+
+                # cancelled runs stuck in a call are left to their pool (shut down without waiting), the scans go to a new one
+                stuck = straggler.drop_stuck_runs()
+                if stuck:
+                    log.warning(f'Cancelled scan runs not stopped after {CANCEL_GRACE} s: {stuck}, starting a new scan worker pool')
+                    executor = replace_scan_pool(args, executor, workers)
+
+                # a scan worker that died takes the pool with it; the daemon starts a new one
+                elif broken and args['daemon'] == True:
+                    executor = reset_scan_pool(args, workers)
+
+                if controller:
+                    controller.adjust(queue_depth=len(pending_items), in_use=len(straggler.scan_runs) + completed)
+
+        finally:
+            if args['daemon'] != True:
+                executor.shutdown(wait=not straggler.abandoned, cancel_futures=True)
+            straggler.end_runs()
+
+        straggler.log_statistics()
+
+    # ----------------------------
+    # Single-processing
+    # ----------------------------
+
+    else:
+        # the stage deadline applies between scans
+        straggler = straggler_helper(args, log, stage)
+
+        # process scans
+        while not queue.finished():
+
+            if straggler.stage_expired():
+                log.warning(f'Stage timeout {stage} - scans waiting: {len(queue.pending())}')
+                queue.close(cancel=True)
+                break
+
+            item = queue.next(QUEUE_WAIT)
+            if item is None:
+                continue
+            # listings cached by the session of the daemon may predate the scan
+            if args['daemon'] == True and xtools:
+                xtools.clear_cache()
+            try:
+                queue.complete(item, run_worker_scan(item.stages[0], item.scan, get_item_args(args, item), log, xtools, dbtools))
+            except Exception as e:
+                queue.complete(item, error=str(e))
+                # the daemon keeps running, a batch run stops at the error
+                if args['daemon'] != True:
+                    raise
+                log.error(f'Project Scan Error - error: {str(e)}')
+
+        straggler.log_statistics()
+
+    return queue.results
+
+# args of a queued scan (with the options of its jobs, e.g. reset)
+def get_item_args(args, item):
+    return {**args, **item.options} if item.options else args
+
+# scans that may be submitted: the adaptive limit on the scans in flight, and no more
+# runs than workers for the daemon (so that jobs queued later run next) and with
+# deadlines (a submitted scan is running, so its time is its own)
+def get_slots(args, workers, pending_items, controller, straggler):
+
+    slots = len(pending_items)
+    if controller:
+        slots = min(slots, controller.get_slots(len(straggler.scan_runs)))
+    if args['daemon'] == True or straggler.enabled:
+        slots = min(slots, workers - straggler.busy)
+
+    return max(0, slots)
+
+# a run that failed because its pool broke (a scan worker died)
+def is_broken(future):
+    return not future.cancelled() and isinstance(future.exception(), BrokenProcessPool)
+
+# ----------------------------
+# scan worker pool kept for the life of the daemon
+# ----------------------------
+
+def get_scan_pool(args, workers):
+
+    with _process_pools_lock:
+        if SCAN_POOL not in _process_pools:
+            _process_pools[SCAN_POOL] = futures.ProcessPoolExecutor(max_workers=workers, mp_context=get_worker_context(args))
+            Finalize(None, _process_pools[SCAN_POOL].shutdown, exitpriority=100)
+
+        return _process_pools[SCAN_POOL]
+
+def reset_scan_pool(args, workers):
+
+    with _process_pools_lock:
+        pool = _process_pools.pop(SCAN_POOL, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return get_scan_pool(args, workers)
+
+# a new pool for the scans, the runs left in the old one end on their own (the daemon pool is replaced for the daemon)
+def replace_scan_pool(args, executor, workers):
+
+    if args['daemon'] == True:
+        return reset_scan_pool(args, workers)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    return futures.ProcessPoolExecutor(max_workers=workers, mp_context=get_worker_context(args))
+
+# ----------------------------
+# process pool per (scan worker) process, reused across scans
+# ----------------------------
+
+def get_process_pool(name, processes):
+
+    with _process_pools_lock:
+        if name not in _process_pools:
+            # always spawned, a forked copy of a threaded scan worker is not safe
+            _process_pools[name] = futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+            # a pool worker process joins its children on exit, so the pool is shut down
+            # first (before the queue feeder threads are closed at exit priority 10)
+            Finalize(None, _process_pools[name].shutdown, exitpriority=100)
+
+        return _process_pools[name]
@@ -0,0 +1,198 @@
+import os
+import re
+import sys
+import zlib
+import glob
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+# ----------------------------
+# profile helper
+# ----------------------------
+# opt-in profiling of a sampled subset of scans inside the worker processes
+#   cprofile - deterministic, one profile per thread pool task merged into the scan profile
+#   sampling - low-overhead wall-clock stack sampling of all threads (collapsed stacks)
+# output is written to <log_path>/profiles/<run>/ and tagged with the scan keys,
+# merged run profiles to <log_path>/profiles/<run>.pstats (or .collapsed)
+# ----------------------------
+
+class profile_helper(object):
+
+    def __init__(self, args, log, scan):
+
+        self.mode = args['profile_mode'] if args['profile'] == True else None
+        self.memory = args['profile'] == True and args['profile_memory'] == True
+        self.interval = args['profile_interval']
+
+        self.scan_tag = re.sub(r'[^A-Za-z0-9_.-]', '_', f'{scan.project_id}_{scan.subject_id}_{scan.experiment_id}_{scan.scan_id}')
+        self.profile_path = get_profile_path(args, log)
+
+        # deterministic sample, so reruns profile the same scans
+        if self.mode and not is_sampled(self.scan_tag, args['profile_sample_rate']):
+            self.mode = None
+            self.memory = False
+
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.thread_profiles = []
+
+    @property
+    def enabled(self):
+        return self.mode is not None or self.memory
+
+    # ----------------------------
+    # start / stop
+    # ----------------------------
+
+    def start(self):
+
+        if not self.enabled:
+            return None
+
+        os.makedirs(self.profile_path, exist_ok=True)
+
+        if self.memory:
+            tracemalloc.start(25)
+
+        if self.mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.mode == 'sampling':
+            self.profiler = sampling_profiler(self.interval)
+            self.profiler.start()
+
+        return None
+
+    def stop(self, log):
+
+        if not self.enabled:
+            return None
+
+        file_base = os.path.join(self.profile_path, self.scan_tag)
+
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            with self.lock:
+                for thread_profile in self.thread_profiles:
+                    stats.add(thread_profile)
+            stats.dump_stats(f'{file_base}.pstats')
+            log.info(f'Profile written: {file_base}.pstats')
+        elif self.mode == 'sampling':
+            self.profiler.stop()
+            self.profiler.write(f'{file_base}.collapsed')
+            log.info(f'Profile written: {file_base}.collapsed')
+
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(f'{file_base}.tracemalloc')
+            for stat in snapshot.statistics('lineno')[:10]:
+                log.info(f'Memory hot spot ({self.scan_tag}): {stat}')
+
+        return None
+
+    # ----------------------------
+    # wrap thread pool tasks (cProfile only sees the thread it is enabled in)
+    # ----------------------------
+
+    def wrap(self, function):
+
+        if self.mode != 'cprofile':
+            return function
+
+        def profiled_function(*args, **kwargs):
+            thread_profile = cProfile.Profile()
+            thread_profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                thread_profile.disable()
+                with self.lock:
+                    self.thread_profiles.append(thread_profile)
+
+        return profiled_function
+
+# ----------------------------
+# sampling profiler
+# ----------------------------
+# samples the stacks of all threads every interval seconds and counts
+# collapsed stacks (flamegraph.pl / speedscope format)
+# ----------------------------
+
+class sampling_profiler(threading.Thread):
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self.stop_event = threading.Event()
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        return None
+
+    def write(self, file_path):
+        with open(file_path, 'w') as file:
+            for stack, count in sorted(self.stacks.items()):
+                file.write(f'{stack} {count}\n')
+        return None
+
+# ----------------------------
+# run level functions
+# ----------------------------
+
+def get_profile_path(args, log):
+    return os.path.join(args['log_path'], 'profiles', log.start_time.strftime("%Y%m%d%H%M%S"))
+
+def is_sampled(scan_tag, sample_rate):
+    return (zlib.crc32(scan_tag.encode()) % 10000) < sample_rate * 10000
+
+def merge_run_profiles(args, log):
+
+    if args['profile'] != True or not args['profile_merge']:
+        return None
+
+    profile_path = get_profile_path(args, log)
+
+    if args['profile_mode'] == 'cprofile':
+        profile_files = sorted(glob.glob(os.path.join(profile_path, '*.pstats')))
+        if profile_files:
+            stats = pstats.Stats(profile_files[0])
+            for profile_file in profile_files[1:]:
+                stats.add(profile_file)
+            stats.dump_stats(f'{profile_path}.pstats')
+            log.info(f'Merged {len(profile_files)} scan profiles: {profile_path}.pstats')
+
+    elif args['profile_mode'] == 'sampling':
+        profile_files = sorted(glob.glob(os.path.join(profile_path, '*.collapsed')))
+        stacks = {}
+        for profile_file in profile_files:
+            with open(profile_file) as file:
+                for line in file:
+                    stack, count = line.rstrip('\n').rsplit(' ', 1)
+                    stacks[stack] = stacks.get(stack, 0) + int(count)
+        if stacks:
+            with open(f'{profile_path}.collapsed', 'w') as file:
+                for stack, count in sorted(stacks.items()):
+                    file.write(f'{stack} {count}\n')
+            log.info(f'Merged {len(profile_files)} scan profiles: {profile_path}.collapsed')
+
+    return None
@@ -1,114 +1,130 @@
+import os
 import pydicom as dicom
 from pydicom.multival import MultiValue
-import cv2
+import time
 import random
+import threading
 import json
-from pypiqe import piqe
-from modules.xnat_tools import xnat_tools
-from modules.db_tools import db_tools
+from modules.xnat_tools import get_worker_xnat_tools
+from modules.db_tools import get_worker_db_tools
 
 from modules.log_helper import log_helper
+from models.dicom_header import DicomHeader, FILTER_TERMS, SORT_FIELDS, get_sort_field
+from modules.metrics_helper import metrics_helper
+from modules.stage_tools import stage_tools
+from modules.memory_helper import reset_peak_rss, get_peak_rss_mb
+from modules.pool_helper import run_scan_pool
+from modules.queue_helper import scan_queue
+from modules.archive_helper import queue_archive_scans, get_archive_files, release_archive_files
+from modules.header_helper import load_header_index, save_header_index
+from modules.piqe_helper import get_piqe_pool, sample_frames, score_frames, score_shared_frames, score_volume_frames, create_shared_array, release_shared_array
+from modules.metric_helper import get_scoring, merge_metric_times
+from modules.profile_helper import profile_helper, merge_run_profiles
+from modules.results_helper import get_quality_rows, get_acquisition_row, get_acquisition_summary, get_quality_summary
+from modules.decode_helper import decode_pixels, reset_decode_statistics, get_decode_statistics, merge_decode_statistics
+from modules.concurrency_helper import configure_downloads, download_request, get_download_threads, reset_download_statistics, get_download_statistics
+from modules.straggler_helper import check_worker_run, claim_worker_run
 
 import concurrent.futures as futures
+from contextlib import nullcontext
 
 class quality_tools(object):
 
     def run_quality_functions(self, args, log, xtools, dbtools):
         
-        for project in args.xnat_projects:
-            project_scan_list = []            
-            
-            if not args.xnat_subjects:
-                project_scan_list.extend(dbtools.get_db_scan_list(df=False, project=project))
-            else:
-                for subject in args.xnat_subjects:
-                    if not args.xnat_experiments:
-                        project_scan_list.extend(dbtools.get_db_scan_list(df=False, project=project, subject=subject))
-                    else:
-                        for experiment in args.xnat_experiments:
-                            if not args.xnat_scans:
-                                project_scan_list.extend(dbtools.get_db_scan_list(df=False, project=project, subject=subject, experiment=experiment))
-                            else:
-                                for scan in args.xnat_scans:
-                                    project_scan_list.extend(dbtools.get_db_scan_list(df=False, project=project, subject=subject, experiment=experiment, scan=scan))
-                                
-
-            self.preprocess_project(args.getArgs(), log, project_scan_list, xtools, dbtools)  
+        scan_keys = self.get_scan_keys(args, log, dbtools)
 
-        return None
+        results = self.preprocess_project(args.getArgs(), log, scan_keys, xtools, dbtools)
 
-    # ----------------------------
-    # preprocess project
-    # ----------------------------
-    def preprocess_project(self, args, log, project_scan_list, xtools, dbtools):
-        
-        return_results = []
+        merge_run_profiles(args.getArgs(), log)
 
-        # ----------------------------
-        # Multi-processing
-        # Set the number of CPUs in the config file.
-        # ----------------------------
+        for name, statistics in merge_decode_statistics(results).items():
+            log.info(f'Decode {name} ({statistics["handler"]}) - instances: {statistics["instances"]} | frames: {statistics["frames"]} | '
+                     f'{statistics["bytes"] / 1048576:.1f} MB | {statistics["seconds"]:.2f} s | {1000 * statistics["seconds"] / max(1, statistics["frames"]):.2f} ms/frame')
 
-        if args['multi_proc'] == True:
-            
-            workers = 60 if args['multi_proc_cpu'] > 60 else args['multi_proc_cpu'] if args['multi_proc_cpu'] >= 1 else 1
+        scored_frames = sum(result['counters'].get('scored_frames', 0) for result in results if result)
+        metric_times = {}
+        for result in results:
+            if result:
+                merge_metric_times(metric_times, result.get('quality_metrics') or {})
+        for name, seconds in sorted(metric_times.items()):
+            log.info(f'Quality metric {name} - frames: {scored_frames} | {seconds:.2f} s | {1000 * seconds / max(1, scored_frames):.2f} ms/frame')
 
-            with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        downloads = [result.get('downloads') or {} for result in results if result]
+        requests = sum(download.get('requests', 0) for download in downloads)
+        if requests:
+            log.info(f'Downloads - requests: {requests} | errors: {sum(download.get("errors", 0) for download in downloads)} | '
+                     f'timeouts: {sum(download.get("timeouts", 0) for download in downloads)} | '
+                     f'{1000 * sum(download.get("seconds", 0.0) for download in downloads) / requests:.1f} ms/request')
 
-                futures_list = []
+        return results
 
-                # process scans
-                for project_scan in project_scan_list:
-                    futures_list.append(executor.submit(self.preprocess_scan, project_scan, args, log, xtools=None, dbtools=None))
+    # ----------------------------
+    # get scan keys (one query for the configured projects, subjects, experiments and scans)
+    # ----------------------------
+    def get_scan_keys(self, args, log, dbtools):
 
-                # for future in futures.as_completed(futures_list):
-                #     return_results.append(future.result())
+        start_time = time.perf_counter()
+        scan_keys = dbtools.get_db_scan_keys(args.xnat_projects, args.xnat_subjects, args.xnat_experiments, args.xnat_scans)
+        log.info(f'Selected {len(scan_keys)} scans in {1000 * (time.perf_counter() - start_time):.1f} ms')
 
-        # ----------------------------
-        # Single-processing
-        # ----------------------------
+        return scan_keys
+
+    # ----------------------------
+    # preprocess project
+    # ----------------------------
+    def preprocess_project(self, args, log, scan_keys, xtools, dbtools):
 
-        else:            
-            # process scans
-            for project_scan in project_scan_list:
+        # experiment archives - the scans of an archive are queued once it has been unpacked
+        queue = None
+        if args['experiment_archive'] == True:
+            queue = scan_queue(keep_results=True)
+            queue_archive_scans(args, log, queue, scan_keys, ['quality_functions'], xtools, dbtools, close=True)
 
-                #return_results.append(self.preprocess_scan(project_scan, args, log, xtools, dbtools))
-                self.preprocess_scan(project_scan, args, log, xtools, dbtools)
+        return run_scan_pool(args, log, scan_keys, 'quality_functions', xtools, dbtools, queue=queue)
 
     # ----------------------------
     # preprocess scans
     # ----------------------------
     def preprocess_scan(self, scan, args, log, xtools, dbtools):
-        
-        # get sort key
-        def get_sort_key(x):
-            dataset = x[1]
-            if "InstanceNumber" in dataset:
-                return dataset.InstanceNumber
-            elif "ImagePositionPatient" in dataset:
-                return dataset.ImagePositionPatient
-            elif "SliceLocation" in dataset:
-                return dataset.SliceLocation
-            elif "AcquisitionTime" in dataset:
-                return dataset.AcquisitionTime
-            else:
-                return dataset.SOPInstanceUID
 
         log = log_helper(log.start_time, log.prog_name, log.log_path, log.log_level)
 
+        metrics = metrics_helper(scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id)
+
+        # opt-in profiling (sampled subset of scans)
+        profiler = profile_helper(args, log, scan)
+        reset_peak_rss()
+        reset_decode_statistics()
+        configure_downloads(args, log)
+        reset_download_statistics()
+        profiler.start()
+        try:
+            self.process_scan(scan, args, log, xtools, dbtools, metrics, profiler)
+        finally:
+            profiler.stop(log)
+            metrics.peak_rss_mb = get_peak_rss_mb()
+            metrics.decode = get_decode_statistics()
+            metrics.downloads = get_download_statistics()
+            if args['experiment_archive'] == True:
+                release_archive_files(args, scan, 'quality_functions')
+
+        return metrics.to_dict()
+
+    def process_scan(self, scan, args, log, xtools, dbtools, metrics, profiler):
+
         log.info(f'Processing Scan {scan.scan_id}')
                 
         #try:
 
         if not xtools:
-            xtools = xnat_tools(args['xnat_server'], args['xnat_user'], args['xnat_password'])
+            xtools = get_worker_xnat_tools(args)
         if not dbtools:
-            dbtools = db_tools(args['db_connect_string'])
+            dbtools = get_worker_db_tools(args)
 
-        edit_scan_list = dbtools.get_db_scan_list(False, scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id)
+        edit_scan = dbtools.get_db_scan(scan.xnat_scan_id)
 
-        if len(edit_scan_list) > 0:
-            edit_scan = edit_scan_list[0]
+        if edit_scan is not None:
             #log.debug(f'Edit Scan Created')
 
             # ??? Check whether this is best filter.
@@ -117,15 +133,28 @@ class quality_tools(object):
                 # if reset or scan_quality or scan_acquisition is blank
                 if args['reset'] == True or not edit_scan.scan_quality or not edit_scan.scan_acquisition:
 
+                    # staged volume from an earlier run (skips the DICOM download)
+                    stage = stage_tools() if args['stage_volumes'] == True else None
+                    volume = stage.load_volume(args, edit_scan) if stage else None
+
                     # get xnat scan element
+                    stage_start = metrics.start_stage()
                     try:
                         xnat_scan = xtools.get_xnat_element(edit_scan.project_id, edit_scan.subject_id, edit_scan.experiment_id, edit_scan.scan_id)
                         # get dicom files
-                        scan_files = xnat_scan.resources['DICOM'].files if 'DICOM' in xnat_scan.resources else None                    
+                        if volume is not None:
+                            scan_files = None
+                        else:
+                            # unpacked from the experiment archive, read from XNAT file by file otherwise
+                            scan_files = get_archive_files(args, edit_scan) if args['experiment_archive'] == True else None
+                            if scan_files is None:
+                                file_records = dbtools.get_db_file_list(edit_scan.xnat_scan_id) if args['file_catalog'] == True else None
+                                scan_files = xtools.get_scan_files(xnat_scan, file_records)
                     except KeyError as exc:
                         log.warning("Cannot find subject from the database on XNAT; skipping subject.")
                         log.info(exc)
                         scan_files = None
+                        volume = None
                         
                         
 
@@ -135,72 +164,25 @@ class quality_tools(object):
                     if scan_files:
 
                         log.info(f'Retrieving DICOM Files')
+                        metrics.count('files', len(scan_files))
                         
-                        # ----------------------------
-                        # Multi-threaded
-                        # Warning - Maxes out CPU
-                        # ----------------------------
-
-                        if args['multi_thread'] == True:
+                        dicom_files, filtered_dicom_files = self.get_scan_headers(args, log, edit_scan, scan_files, metrics, stage_start, profiler)
 
-                            # retrieve the header information from the DICOM files
-                            with futures.ThreadPoolExecutor(max_workers=args['multi_thread_workers']) as executor:
+                        self.set_scan_dimensions(edit_scan, dicom_files)
+                        metrics.count('filtered_files', len(filtered_dicom_files))
 
-                                futures_list = []
+                        # decode the filtered instances once into the stage volume
+                        if stage and filtered_dicom_files:
+                            stage_start = metrics.start_stage()
+                            volume = stage.stage_volume(args, log, edit_scan, filtered_dicom_files, self.read_dicom)
+                            filtered_dicom_files = volume.headers
+                            metrics.end_stage('stage', stage_start)
 
-                                for scan_key, scan_file in scan_files.items():
-                                    futures_list.append(executor.submit(self.read_dicom, scan_file, True))
+                    elif volume is not None:
+                        log.info(f'Using staged volume: {volume.volume_path}')
+                        filtered_dicom_files = volume.headers
+                        metrics.count('filtered_files', len(filtered_dicom_files))
 
-                                for future in futures.as_completed(futures_list):
-                                    dicom_files.append(future.result())
-
-                        # ----------------------------
-                        # Single-threaded
-                        # ----------------------------
-
-                        else:
-                            # retrieve the header information from the DICOM files
-                            for scan_key, scan_file in scan_files.items():
-
-                                #with scan_file.open() as dicom_file:
-                                    #dataset = dicom.dcmread(dicom_file, stop_before_pixels=True)
-                                    #datasets.append([scan_file, dataset])
-                                dicom_files.append(self.read_dicom(scan_file, exclude_pixels=True))
-
-
-                        # ----------------------------
-                        # sort datasets by InstanceNumber, ImagePositionPatient, SliceLocation, AcquisitionTime, SOPInstanceUID
-                        # ----------------------------
-                        try:
-                            dicom_files.sort(key=get_sort_key)
-                        except AttributeError as error:
-                            log.warning("No sort key found when sorting DICOM files; most likely no SOPInstanceUID. Skipping this scan.")
-                            log.warning(error)
-                            dicom_files = []
-                        #log.debug(f'DICOM files sorted ({len(dicom_files)})')
-
-                        # ----------------------------
-                        # filter out scouts, localizers, b0s
-                        # ----------------------------
-
-                        # ensure not Scout or Localizer (Ignore first 3 slices, check Series description for "scout" or "localizer", check ImageType for "localizer")
-                        # ensure not B0 bias correction (Check Series description or Sequence name for "b0")
-
-                        # cut off first 3 slices
-                        if len(dicom_files) > 3:
-                            filtered_dicom_files = dicom_files[3:]
-                        else:
-                            filtered_dicom_files = dicom_files
-                            
-                        #log.debug(f'DICOM files filtered ({len(filtered_dicom_files)})')
-            
-                        # check remaining slices for scout, localizer, b0 and filter out
-                        disallowed_terms = ['scout', 'localizer', 'b0']
-                        filtered_dicom_files = [ds for ds in filtered_dicom_files 
-                            if not any(x.lower() in disallowed_terms for x in ds[1].ImageType)
-                            and ('SeriesDescription' not in ds[1] or not any(term in ds[1].SeriesDescription.lower() for term in disallowed_terms))
-                            and ('ProtocolName' not in ds[1] or not any(term in ds[1].ProtocolName.lower() for term in disallowed_terms))
-                            and ('SequenceName' not in ds[1] or not any(term in ds[1].SequenceName.lower() for term in disallowed_terms))]
                     log.info(f'Num dicom files: {len(filtered_dicom_files)}')
 
                     if filtered_dicom_files:
@@ -210,18 +192,34 @@ class quality_tools(object):
                             log.info(f'Subject label: {edit_scan.subject_label}')
                             log.info(f'Experiment label: {edit_scan.experiment_label}')
                             log.info(f'Scan ID: {edit_scan.scan_id}')
-                            edit_scan.scan_quality = self.get_quality_score(edit_scan, xnat_scan, filtered_dicom_files, log, args)
+                            stage_start = metrics.start_stage()
+                            edit_scan.scan_quality = self.get_quality_score(edit_scan, xnat_scan, filtered_dicom_files, log, args, profiler, volume, metrics)
+                            metrics.end_stage('quality', stage_start)
                             log.info(f"Quality score: {edit_scan.scan_quality}")
+                            # only the run of the scan that claims it writes the results (speculative runs, deadlines)
+                            claim_worker_run()
+                            stage_start = metrics.start_stage()
                             xtools.set_scan_json_resource(args, log, xnat_scan, edit_scan.scan_quality, 'quality_score')
+                            dbtools.set_db_scan_quality(edit_scan.xnat_scan_id, get_quality_rows(edit_scan.xnat_scan_id, edit_scan.scan_quality))
                             dbtools.flush_database()
+                            metrics.end_stage('upload', stage_start)
 
                         # get acquisition variables
                         if not edit_scan.scan_acquisition or args['reset'] == True:
                             log.info(f'Retrieving Acquisition Variables')
+                            stage_start = metrics.start_stage()
                             edit_scan.scan_acquisition = self.get_acquisition_tags(edit_scan, xnat_scan, filtered_dicom_files, log)
+                            metrics.end_stage('acquisition', stage_start)
                             log.info(f"Scan acquisition: {edit_scan.scan_acquisition}")
+                            claim_worker_run()
+                            stage_start = metrics.start_stage()
                             xtools.set_scan_json_resource(args, log, xnat_scan, edit_scan.scan_acquisition, 'acquisition_variables')
+                            dbtools.set_db_scan_acquisition(edit_scan.xnat_scan_id, get_acquisition_row(edit_scan.xnat_scan_id, edit_scan.scan_acquisition))
                             dbtools.flush_database()
+                            metrics.end_stage('upload', stage_start)
+
+                    # results of the scan, computed now or by an earlier run
+                    metrics.results.update(get_quality_summary(edit_scan.scan_quality))
 
             #return edit_scan
                 
@@ -231,13 +229,135 @@ class quality_tools(object):
 
 
 
+    # ----------------------------
+    # scan headers, sorted and filtered (from the header index of an earlier run while the files are unchanged)
+    # ----------------------------
+    def get_scan_headers(self, args, log, edit_scan, scan_files, metrics, stage_start, profiler=None):
+
+        header_index = load_header_index(args, edit_scan, scan_files) if args['header_index'] == True else None
+        if header_index is not None:
+            dicom_files, filtered_dicom_files = header_index
+            log.info(f'Using header index ({len(dicom_files)} instances)')
+            metrics.count('indexed_files', len(dicom_files))
+            metrics.end_stage('headers', stage_start)
+            return dicom_files, filtered_dicom_files
+
+        dicom_files = self.read_scan_headers(args, scan_files, profiler)
+
+        metrics.end_stage('headers', stage_start)
+        stage_start = metrics.start_stage()
+
+        filtered_dicom_files = self.filter_dicom_files(log, dicom_files)
+
+        metrics.end_stage('filter', stage_start)
+
+        if args['header_index'] == True and dicom_files:
+            save_header_index(args, edit_scan, scan_files, dicom_files, filtered_dicom_files)
+
+        return dicom_files, filtered_dicom_files
+
+    # ----------------------------
+    # read scan headers
+    # ----------------------------
+    def read_scan_headers(self, args, scan_files, profiler=None):
+
+        dicom_files = []
+
+        # ----------------------------
+        # Multi-threaded
+        # Warning - Maxes out CPU
+        # ----------------------------
+
+        if args['multi_thread'] == True:
+
+            # retrieve the header information from the DICOM files
+            with futures.ThreadPoolExecutor(max_workers=get_download_threads(args)) as executor:
+
+                futures_list = []
+
+                for scan_key, scan_file in scan_files.items():
+                    read_dicom_header = profiler.wrap(self.read_dicom_header) if profiler else self.read_dicom_header
+                    futures_list.append(executor.submit(read_dicom_header, scan_file))
+
+                for future in futures.as_completed(futures_list):
+                    dicom_files.append(future.result())
+
+        # ----------------------------
+        # Single-threaded
+        # ----------------------------
+
+        else:
+            # retrieve the header information from the DICOM files
+            for scan_key, scan_file in scan_files.items():
+
+                #with scan_file.open() as dicom_file:
+                    #dataset = dicom.dcmread(dicom_file, stop_before_pixels=True)
+                    #datasets.append([scan_file, dataset])
+                dicom_files.append(self.read_dicom_header(scan_file))
+
+        return dicom_files
+
+    # ----------------------------
+    # image dimensions (memory estimates of later runs)
+    # ----------------------------
+    def set_scan_dimensions(self, edit_scan, dicom_files):
+
+        if dicom_files:
+            edit_scan.scan_file_count = len(dicom_files)
+            edit_scan.scan_rows = max(header.rows for header in dicom_files)
+            edit_scan.scan_columns = max(header.columns for header in dicom_files)
+            edit_scan.scan_frames = max(header.number_of_frames for header in dicom_files)
+
+        return None
+
+    # ----------------------------
+    # sort and filter dicom files
+    # ----------------------------
+    def filter_dicom_files(self, log, dicom_files):
+
+        # ----------------------------
+        # sort datasets by InstanceNumber, ImagePositionPatient, SliceLocation, AcquisitionTime, SOPInstanceUID
+        # ----------------------------
+        sort_field = get_sort_field(dicom_files)
+        if sort_field is None:
+            log.warning(f'No sort field ({", ".join(SORT_FIELDS)}) present on all {len(dicom_files)} DICOM files. Skipping this scan.')
+            dicom_files = []
+        else:
+            dicom_files.sort(key=lambda header: header.get_sort_key(sort_field))
+        #log.debug(f'DICOM files sorted ({len(dicom_files)})')
+
+        # ----------------------------
+        # filter out scouts, localizers, b0s
+        # ----------------------------
+
+        # ensure not Scout or Localizer (Ignore first 3 slices, check Series description for "scout" or "localizer", check ImageType for "localizer")
+        # ensure not B0 bias correction (Check Series description or Sequence name for "b0")
+
+        # cut off first 3 slices
+        if len(dicom_files) > 3:
+            filtered_dicom_files = dicom_files[3:]
+        else:
+            filtered_dicom_files = dicom_files
+
+        #log.debug(f'DICOM files filtered ({len(filtered_dicom_files)})')
+
+        # check remaining slices for scout, localizer, b0 and filter out
+        filtered_dicom_files = [header for header in filtered_dicom_files
+            if header.get_filter_reason(FILTER_TERMS) is None]
+
+        return filtered_dicom_files
+
     # ----------------------------
     # read dicom
     # ----------------------------
     def read_dicom(self, scan_file, exclude_pixels):
 
+        # a cancelled run stops between files
+        check_worker_run()
+
         dataset = None
-        with scan_file.open() as dicom_file:
+        # counted (and, with adaptive_concurrency, limited) as one download, unless unpacked from an experiment archive
+        with (nullcontext() if getattr(scan_file, 'local', False) else download_request()), scan_file.open() as dicom_file:
 
             try:
                 dataset = dicom.dcmread(dicom_file, stop_before_pixels=exclude_pixels)
@@ -248,9 +368,27 @@ class quality_tools(object):
         return [scan_file, dataset]
 
     # ----------------------------
-    # get acquisition variables
+    # read dicom pixels (decoded with the selected handler for the transfer syntax)
     # ----------------------------
-    def get_acquisition_tags(self, edit_scan, xnat_scan, dicom_files, log):
+    def read_dicom_pixels(self, scan_file, args):
+
+        dataset = self.read_dicom(scan_file, exclude_pixels=False)[1]
+        return dataset, decode_pixels(dataset, args)
+
+    # ----------------------------
+    # read dicom header
+    # ----------------------------
+    # reduces the header to a compact record; the Dataset is discarded here
+    # ----------------------------
+    def read_dicom_header(self, scan_file):
+
+        dataset = self.read_dicom(scan_file, exclude_pixels=True)[1]
+        return DicomHeader(scan_file, dataset, self.get_acquisition_tag_list(dataset.get('Modality', None)))
+
+    # ----------------------------
+    # get acquisition tag list
+    # ----------------------------
+    def get_acquisition_tag_list(self, modality):
 
         # all
         all_list = [
@@ -324,6 +462,19 @@ class quality_tools(object):
             'ImageLaterality',              # (0020,0062) - Image Laterality
             ]
 
+        if modality == 'CT':
+            return [*all_list, *ct_mg_list, *ct_list]
+        elif modality == 'MG':
+            return [*all_list, *ct_mg_list, *mg_list]
+        elif modality == 'MR':
+            return [*all_list, *mr_list]
+
+        return []
+
+    # ----------------------------
+    # get acquisition variables
+    # ----------------------------
+    def get_acquisition_tags(self, edit_scan, xnat_scan, dicom_files, log):
 
         def handle_multivalue(obj):
             if isinstance(obj, MultiValue):
@@ -338,28 +489,18 @@ class quality_tools(object):
 
             # Option 2
             # Read first DICOM file in sorted dataset list
-            #dicom_dataset = datasets[0][1]
+            #dicom_header = dicom_files[0]
 
             # Option 3
             # Read random DICOM file in scan
-            dicom_dataset = random.choice(dicom_files)[1]
-    
-            extract_dict = {}
-
-            if dicom_dataset.Modality == 'CT':
-                combined_list = [*all_list, *ct_mg_list, *ct_list]
-                for tag in combined_list:
-                    extract_dict[tag] = dicom_dataset.get(tag, None)
-            elif dicom_dataset.Modality == 'MG':
-                combined_list = [*all_list, *ct_mg_list, *mg_list]
-                for tag in combined_list:
-                    extract_dict[tag] = dicom_dataset.get(tag, None)
-            elif dicom_dataset.Modality == 'MR':
-                combined_list = [*all_list, *mr_list]
-                for tag in combined_list:
-                    extract_dict[tag] = dicom_dataset.get(tag, None)
-
-            if len(extract_dict) != 0:
+            #dicom_header = random.choice(dicom_files)
+
+            # Option 4
+            # Most common value of each tag across the filtered instances, with its consistency
+            # (acquisition tags for the modality were extracted during the header pass)
+            extract_dict = get_acquisition_summary(dicom_files)
+
+            if len(extract_dict) > 1:
                 return json.dumps(extract_dict, default=handle_multivalue)
 
             return None
@@ -371,11 +512,16 @@ class quality_tools(object):
     # ----------------------------
     # get quality score
     # ----------------------------
-    def get_quality_score(self, edit_scan, xnat_scan, dicom_files, log, args):
+    def get_quality_score(self, edit_scan, xnat_scan, dicom_files, log, args, profiler=None, volume=None, metrics=None):
 
         results_dict = {}
         results_dict['instances'] = {}
 
+        # quality metrics enabled for the modality (scored together in one pass per slice),
+        # scoring resolution and piqe tile processes
+        scoring = get_scoring(args, edit_scan.scan_modality)
+        metric_times = {}
+
         #try:
         # Randomly select 10%, no less than 10 or length of list.
         list_length = len(dicom_files)
@@ -383,30 +529,38 @@ class quality_tools(object):
         sample_size = min(sample_size, list_length)  # Ensure sample size does not exceed list length
         selected_dicom_files = random.sample(dicom_files, sample_size)
 
+        # ----------------------------
+        # Multi-processing (shared memory)
+        # Set piqe_processes in the config file.
+        # ----------------------------
+
+        if args['piqe_processes'] > 0:
+
+            for dicom_file, return_list, return_times in self.get_piqe_shared(selected_dicom_files, args, scoring, volume):
+                self.set_instance_scores(results_dict, dicom_file, return_list)
+                merge_metric_times(metric_times, return_times)
+
         # ----------------------------
         # Multi-threaded
         # Warning - Maxes out CPU
         # ----------------------------
 
-        if args['multi_thread'] == True:
+        elif args['multi_thread'] == True:
 
             # retrieve the header information from the DICOM files
-            with futures.ThreadPoolExecutor(max_workers=args['multi_thread_workers']) as executor:
+            with futures.ThreadPoolExecutor(max_workers=get_download_threads(args)) as executor:
 
-                futures_list = []
+                futures_dict = {}
 
                 for dicom_file in selected_dicom_files:
-                    futures_list.append(executor.submit(self.get_piqe, dicom_file))
+                    get_piqe = profiler.wrap(self.get_piqe) if profiler else self.get_piqe
+                    futures_dict[executor.submit(get_piqe, dicom_file, log, args, scoring, volume)] = dicom_file
 
-                for future in futures.as_completed(futures_list):
-                    # dicom_file, score, artifact_mask, noise_mask, activity_mask = future.result()
-                    return_list = future.result()
-                    for item in return_list:
-                        dicom_index = str(dicom_file[1].SOPInstanceUID)
-                        if 'slice' in item.keys():
-                            dicom_index += f"-{str(item['slice'])}"
-                        results_dict['instances'][dicom_index] = {}
-                        results_dict['instances'][dicom_index]['piqe_score'] = item['score']
+                for future in futures.as_completed(futures_dict):
+                    dicom_file = futures_dict[future]
+                    return_list, return_times = future.result()
+                    self.set_instance_scores(results_dict, dicom_file, return_list)
+                    merge_metric_times(metric_times, return_times)
 
         # ----------------------------
         # Single-threaded
@@ -415,84 +569,110 @@ class quality_tools(object):
         else:
             # retrieve the pixel information from the DICOM files
             for dicom_file in selected_dicom_files:
-                # dicom_file, score, artifact_mask, noise_mask, activity_mask = self.get_piqe(dicom_file, log)
-                return_list = self.get_piqe(dicom_file, log)
-                for item in return_list:
-                    dicom_index = str(dicom_file[1].SOPInstanceUID)
-                    if 'slice' in item.keys():
-                        dicom_index += f"-{str(item['slice'])}"
-                    results_dict['instances'][dicom_index] = {}
-                    results_dict['instances'][dicom_index]['piqe_score'] = item['score']
-                    #results_dict['instances'][dicom_file[1].SOPInstanceUID]['artifact_mask'] = artifact_mask
-                    #results_dict['instances'][dicom_file[1].SOPInstanceUID]['noise_mask'] = noise_mask
-                    #results_dict['instances'][dicom_file[1].SOPInstanceUID]['activity_mask'] = activity_mask
-
-        # Calculate and log the average score
-        scores = [instance['piqe_score'] for instance in results_dict['instances'].values()]
-        log.info(f"Scores: {scores}")
-        log.info(f"Length of scores: {len(scores)}")
-        average_score = sum(scores) / len(scores)
-        #print(f"Average PIQE Score: {average_score:.2f}")
-        results_dict['average_piqe_score'] = average_score
+                return_list, return_times = self.get_piqe(dicom_file, log, args, scoring, volume)
+                self.set_instance_scores(results_dict, dicom_file, return_list)
+                merge_metric_times(metric_times, return_times)
+
+        # Calculate and log the average score of each metric (slices where a metric is undefined are skipped)
+        for name in scoring['metrics']:
+            scores = [instance[f'{name}_score'] for instance in results_dict['instances'].values() if instance[f'{name}_score'] is not None]
+            log.info(f"{name} scores: {scores}")
+            results_dict[f'average_{name}_score'] = sum(scores) / len(scores) if scores else None
+        results_dict['metric_times'] = metric_times
+        results_dict['downsample_size'] = scoring['downsample_size']
+
+        if metrics is not None:
+            metrics.count('scored_frames', len(results_dict['instances']))
+            merge_metric_times(metrics.quality_metrics, metric_times)
 
         return json.dumps(results_dict)
 
         # except Exception as e:     
         #     log.error(f'Quality Score Error - project: {edit_scan.project_name} | subject: {edit_scan.subject_label} | experiment: {edit_scan.experiment_label} | scan: {edit_scan.scan_id} | error: {str(e)}')
         #     return None
+
+    # instance keys are the SOP Instance UID, with -<frame> for multi-frame instances
+    def set_instance_scores(self, results_dict, dicom_file, return_list):
+        for item in return_list:
+            dicom_index = dicom_file.sop_instance_uid
+            if 'slice' in item.keys():
+                dicom_index += f"-{str(item['slice'])}"
+            results_dict['instances'][dicom_index] = item['scores']
+        return None
     
-    def get_piqe(self, dicom_file, log):
-
-        # Get dicom header with pixels
-        full_dicom_file = self.read_dicom(dicom_file[0], exclude_pixels=False)[1]
-
-        # Get pixel data as numpy array
-        check_array = full_dicom_file.pixel_array
-        record_slice_idx = False
-        selected_slice_indexes = [0]
-        if len(check_array.shape) == 3:
-            list_length = check_array.shape[0]
-            sample_size = max(10, int(list_length * 0.1))
-            sample_size = min(sample_size, list_length)  # Ensure sample size does not exceed list length
-            selected_slice_indexes = random.sample(range(list_length), sample_size)
-            record_slice_idx = True
-        elif len(check_array.shape) > 3:
-            raise Exception
+    # ----------------------------
+    # get piqe (process pool)
+    # ----------------------------
+    # I/O threads download and decode the instances into shared memory blocks while
+    # the process pool scores them; in-flight blocks are bounded to two per process
+    # ----------------------------
+    def get_piqe_shared(self, dicom_files, args, scoring, volume=None):
+
+        pool = get_piqe_pool(args['piqe_processes'])
+        in_flight = threading.BoundedSemaphore(args['piqe_processes'] * 2)
+
+        def release(future, shm):
+            if shm is not None:
+                release_shared_array(shm)
+            in_flight.release()
+            return None
+
+        def submit(dicom_file):
+            check_worker_run()
+            in_flight.acquire()
+            shm = None
+            try:
+                # staged volume - the scoring processes map the volume file themselves
+                if volume is not None:
+                    frame_start, frame_count = volume.frame_index[dicom_file.sop_instance_uid]
+                    frame_indices, record_slice_idx = sample_frames(volume.get_instance(dicom_file.sop_instance_uid).shape)
+                    future = pool.submit(score_volume_frames, os.path.join(volume.volume_path, 'volume.npy'), frame_start, frame_count, frame_indices, scoring)
+                else:
+                    pixel_array = self.read_dicom_pixels(dicom_file.scan_file, args)[1]
+                    frame_indices, record_slice_idx = sample_frames(pixel_array.shape)
+                    shm = create_shared_array(pixel_array)
+                    future = pool.submit(score_shared_frames, shm.name, pixel_array.shape, pixel_array.dtype.str, frame_indices, scoring)
+            except:
+                release(None, shm)
+                raise
+            future.add_done_callback(lambda future: release(future, shm))
+            return dicom_file, frame_indices, record_slice_idx, future
+
+        io_workers = get_download_threads(args) if args['multi_thread'] == True else 1
+        with futures.ThreadPoolExecutor(max_workers=io_workers) as executor:
+            submitted = list(executor.map(submit, dicom_files))
+
+        results = []
+        for dicom_file, frame_indices, record_slice_idx, future in submitted:
+            scores, metric_times = future.result()
+            results.append([dicom_file, self.get_slice_scores(frame_indices, record_slice_idx, scores), metric_times])
+
+        return results
+
+    def get_piqe(self, dicom_file, log, args, scoring, volume=None):
+
+        check_worker_run()
+
+        # Get pixel data as numpy array (view into the staged volume, or decoded from the dicom file)
+        if volume is not None:
+            check_array = volume.get_instance(dicom_file.sop_instance_uid)
+        else:
+            check_array = self.read_dicom_pixels(dicom_file.scan_file, args)[1]
+        log.info(f"Check array shape: {check_array.shape}")
+        selected_slice_indexes, record_slice_idx = sample_frames(check_array.shape)
+
+        # all enabled metrics in one pass over each selected slice
+        scores, metric_times = score_frames(check_array, selected_slice_indexes, scoring)
+
+        return self.get_slice_scores(selected_slice_indexes, record_slice_idx, scores), metric_times
+
+    def get_slice_scores(self, frame_indices, record_slice_idx, scores):
 
         return_list = []
-        for idx in selected_slice_indexes:
-            if len(selected_slice_indexes) > 1 and len(check_array.shape) == 3:
-                check_array_slice = check_array[idx, :, :]
-            else:
-                check_array_slice = check_array
-            # Normalize pixel array if necessary
-            log.info(f"Check array shape: {check_array_slice.shape}")
-            check_image = cv2.normalize(check_array_slice, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
-            log.info(f"Check image shape: {check_image.shape}")
-
-            # Convert image from grayscale to RGB because PIQE needs a 3-channel image
-            check_image = cv2.cvtColor(check_image, cv2.COLOR_GRAY2RGB)
-            log.info(check_image.shape)
-
-            # Open the image using OpenCV
-            #cv2.imshow('DICOM image', pixel_array)
-
-            # Wait for a key press and then close the image window
-            #cv2.waitKey(0)
-            #cv2.destroyAllWindows()
-
-            score, artifact_mask, noise_mask, activity_mask = piqe(check_image)
-            slice_dict = {
-                'score': score,
-                'artifact_mask': artifact_mask,
-                'noise_mask': noise_mask,
-                'activity_mask': activity_mask
-            }
+        for idx, slice_scores in zip(frame_indices, scores):
+            slice_dict = {'scores': slice_scores}
             if record_slice_idx:
                 slice_dict['slice'] = idx
-            #print(f"Score: {Score:.2f}")
             return_list.append(slice_dict)
 
         return return_list
-
-
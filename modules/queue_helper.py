@@ -0,0 +1,339 @@
+import time
+import uuid
+import itertools
+import threading
+from datetime import datetime
+from collections import deque, namedtuple, OrderedDict
+
+# ----------------------------
+# queue helper
+# ----------------------------
+# scans waiting for the scan worker pool, in priority order (then in order of
+# arrival); run_scan_pool takes them until the queue is closed and empty (a batch
+# run closes it once filled, the daemon keeps it open)
+#
+# a scan queued for several stages (quality_functions, normalization_functions)
+# is queued again for its next stage when a stage completes; a scan already
+# waiting or running is not queued twice
+#
+# jobs (daemon job API) queue their scans at PRIORITY_JOB, ahead of the bulk
+# work; a job for a scan already waiting raises its priority, a job for a scan
+# running follows it; the state and results of each scan are kept on the job
+# ----------------------------
+
+PRIORITY_JOB = 0
+PRIORITY_BULK = 10
+
+# result columns of a scan per stage (scans with all of them are not queued, unless reset)
+STAGE_RESULTS = {
+    'quality_functions': ['scan_quality', 'scan_acquisition'],
+    'normalization_functions': ['scan_normalization'],
+}
+
+# errors kept for the status endpoint
+RECENT_ERRORS = 20
+# scans per minute over the last THROUGHPUT_WINDOW seconds
+THROUGHPUT_WINDOW = 600
+# jobs kept for polling (the oldest are dropped first)
+MAX_JOBS = 1000
+
+QueueItem = namedtuple('QueueItem', ['priority', 'sequence', 'stages', 'scan', 'jobs', 'options'])
+
+class scan_queue(object):
+
+    def __init__(self, keep_results=False):
+
+        self.condition = threading.Condition()
+        self.items = []
+        self.queued = set()
+        self.sequence = itertools.count()
+        self.closed = False
+        self.running = 0
+        self.keep_results = keep_results
+        self.results = []
+
+        self.start_time = time.monotonic()
+        self.processed = 0
+        self.failed = 0
+        self.completed = deque()
+        self.recent_errors = deque(maxlen=RECENT_ERRORS)
+
+        self.jobs = OrderedDict()
+        self.job_times = {}
+        # jobs submitted for a scan while it was running
+        self.following_jobs = {}
+
+    # batch run (the scans of one stage, closed)
+    @classmethod
+    def from_list(cls, scan_list, stage):
+
+        queue = cls(keep_results=True)
+        for scan in scan_list:
+            queue.put(scan, [stage])
+        queue.close()
+
+        return queue
+
+    # options are applied to the args of the scan workers (e.g. reset)
+    def put(self, scan, stages, priority=PRIORITY_BULK, job_id=None, options=None):
+
+        with self.condition:
+            if job_id is not None:
+                self.add_job_scan(job_id, scan, stages)
+
+            if scan.xnat_scan_id in self.queued:
+                if job_id is None:
+                    return False
+                for index, item in enumerate(self.items):
+                    if item.scan.xnat_scan_id == scan.xnat_scan_id:
+                        self.items[index] = item._replace(priority=min(item.priority, priority), jobs=item.jobs + (job_id,),
+                                                          options={**item.options, **(options or {})})
+                        break
+                else:
+                    self.following_jobs.setdefault(scan.xnat_scan_id, []).append(job_id)
+                    self.set_job_scan(job_id, scan.xnat_scan_id, state='running')
+                self.condition.notify_all()
+                return True
+
+            self.queued.add(scan.xnat_scan_id)
+            self.items.append(QueueItem(priority, next(self.sequence), tuple(stages), scan, (job_id,) if job_id is not None else (), options or {}))
+            self.condition.notify_all()
+
+        return True
+
+    # waiting scans, in the order they are taken
+    def pending(self):
+        with self.condition:
+            return sorted(self.items)
+
+    def take(self, item):
+
+        with self.condition:
+            self.items.remove(item)
+            self.running += 1
+            for job_id in item.jobs:
+                self.set_job_scan(job_id, item.scan.xnat_scan_id, state='running')
+
+        return None
+
+    # first waiting scan (None if none arrives within timeout)
+    def next(self, timeout=None):
+
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            if not self.items:
+                return None
+            item = min(self.items)
+            self.take(item)
+
+        return item
+
+    def complete(self, item, result=None, error=None):
+
+        with self.condition:
+            self.running -= 1
+            scan_id = item.scan.xnat_scan_id
+            jobs = item.jobs + tuple(self.following_jobs.pop(scan_id, []))
+            for job_id in jobs:
+                self.set_job_result(job_id, scan_id, item.stages[0], result, error, final=error is not None or len(item.stages) == 1)
+
+            if error is not None:
+                self.failed += 1
+                self.queued.discard(scan_id)
+                self.record_error(f'{item.stages[0]} - project: {item.scan.project_id} | experiment: {item.scan.experiment_id} | scan: {item.scan.scan_id} | error: {error}')
+            elif len(item.stages) > 1:
+                self.items.append(item._replace(sequence=next(self.sequence), stages=item.stages[1:], jobs=jobs))
+            else:
+                self.processed += 1
+                self.queued.discard(scan_id)
+                self.completed.append(time.monotonic())
+            if self.keep_results and result is not None:
+                self.results.append(result)
+            self.condition.notify_all()
+
+        return None
+
+    # a running scan back to the waiting scans (cancelled by the pool, run again)
+    def retry(self, item):
+
+        with self.condition:
+            self.running -= 1
+            self.items.append(item)
+            for job_id in item.jobs:
+                self.set_job_scan(job_id, item.scan.xnat_scan_id, state='queued')
+            self.condition.notify_all()
+
+        return None
+
+    def record_error(self, message):
+
+        with self.condition:
+            self.recent_errors.append({'time': datetime.now().isoformat(timespec='seconds'), 'error': message})
+
+        return None
+
+    # wait for a scan to be queued (or the queue to be closed)
+    def wait(self, timeout=None):
+
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+
+        return None
+
+    # cancel drops the waiting scans (the running ones complete)
+    def close(self, cancel=False):
+
+        with self.condition:
+            self.closed = True
+            if cancel:
+                for item in self.items:
+                    self.queued.discard(item.scan.xnat_scan_id)
+                    for job_id in item.jobs:
+                        self.set_job_result(job_id, item.scan.xnat_scan_id, item.stages[0], None, 'cancelled', final=True)
+                self.items.clear()
+            self.condition.notify_all()
+
+        return None
+
+    # closed and no scan waiting (scans still running are followed by the pool)
+    def finished(self):
+        with self.condition:
+            return self.closed and not self.items
+
+    def idle(self):
+        with self.condition:
+            return not self.items and self.running == 0
+
+    # ----------------------------
+    # jobs
+    # ----------------------------
+
+    def create_job(self, request):
+
+        job_id = uuid.uuid4().hex
+        with self.condition:
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'state': 'submitted',
+                'submitted': datetime.now().isoformat(timespec='seconds'),
+                'finished': None,
+                'first_result_seconds': None,
+                'request': request,
+                'scans': {},
+                'error': None,
+            }
+            self.job_times[job_id] = time.monotonic()
+            while len(self.jobs) > MAX_JOBS:
+                dropped_id, _ = self.jobs.popitem(last=False)
+                self.job_times.pop(dropped_id, None)
+
+        return job_id
+
+    # jobs waiting to be resolved to scans, oldest first
+    def get_submitted_jobs(self):
+        with self.condition:
+            return [(job_id, job['request']) for job_id, job in self.jobs.items() if job['state'] == 'submitted']
+
+    def fail_job(self, job_id, error):
+
+        with self.condition:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(state='failed', error=error, finished=datetime.now().isoformat(timespec='seconds'))
+
+        return None
+
+    def get_job(self, job_id):
+
+        with self.condition:
+            if job_id not in self.jobs:
+                return None
+            job = self.jobs[job_id]
+            return {**job, 'scans': [dict(scan, results=dict(scan['results'])) for scan in job['scans'].values()]}
+
+    def get_jobs(self):
+        with self.condition:
+            return [{**{key: job[key] for key in ['job_id', 'state', 'submitted', 'finished', 'first_result_seconds', 'error']}, 'scans': len(job['scans'])}
+                    for job in self.jobs.values()]
+
+    def add_job_scan(self, job_id, scan, stages):
+
+        job = self.jobs.get(job_id)
+        if job is not None and scan.xnat_scan_id not in job['scans']:
+            job['scans'][scan.xnat_scan_id] = {
+                'project_id': scan.project_id,
+                'subject_id': scan.subject_id,
+                'experiment_id': scan.experiment_id,
+                'scan_id': scan.scan_id,
+                'state': 'queued',
+                'stages': list(stages),
+                'seconds': 0.0,
+                'results': {},
+                'error': None,
+            }
+            if job['state'] == 'submitted':
+                job['state'] = 'queued'
+
+        return None
+
+    def set_job_scan(self, job_id, xnat_scan_id, **values):
+
+        job = self.jobs.get(job_id)
+        if job is not None and xnat_scan_id in job['scans']:
+            job['scans'][xnat_scan_id].update(values)
+            if values.get('state') == 'running' and job['state'] == 'queued':
+                job['state'] = 'running'
+
+        return None
+
+    def set_job_result(self, job_id, xnat_scan_id, stage, result, error, final):
+
+        job = self.jobs.get(job_id)
+        if job is None or xnat_scan_id not in job['scans']:
+            return None
+
+        job_scan = job['scans'][xnat_scan_id]
+        if result:
+            job_scan['seconds'] += result.get('total_time') or 0.0
+            job_scan['results'].update(result.get('results') or {})
+        if error is not None:
+            job_scan['state'], job_scan['error'] = 'failed', f'{stage} - {error}'
+        elif final:
+            job_scan['state'] = 'completed'
+            if job['first_result_seconds'] is None:
+                job['first_result_seconds'] = round(time.monotonic() - self.job_times[job_id], 3)
+
+        states = [scan['state'] for scan in job['scans'].values()]
+        if all(state in ('completed', 'failed') for state in states):
+            job['state'] = 'failed' if all(state == 'failed' for state in states) else 'completed'
+            job['finished'] = datetime.now().isoformat(timespec='seconds')
+
+        return None
+
+    # ----------------------------
+    # status
+    # ----------------------------
+
+    def get_status(self):
+
+        with self.condition:
+            now = time.monotonic()
+            while self.completed and self.completed[0] < now - THROUGHPUT_WINDOW:
+                self.completed.popleft()
+            window = min(THROUGHPUT_WINDOW, max(1.0, now - self.start_time))
+
+            jobs = {}
+            for job in self.jobs.values():
+                jobs[job['state']] = jobs.get(job['state'], 0) + 1
+
+            return {
+                'queue_depth': len(self.items),
+                'queued_job_scans': sum(1 for item in self.items if item.jobs),
+                'running': self.running,
+                'processed': self.processed,
+                'failed': self.failed,
+                'scans_per_minute': round(60 * len(self.completed) / window, 2),
+                'jobs': jobs,
+                'recent_errors': list(self.recent_errors),
+            }
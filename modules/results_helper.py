@@ -0,0 +1,271 @@
+import json
+import numpy as np
+from collections import Counter
+from sqlalchemy import INTEGER, REAL
+
+from models.db import XnatInstanceQuality, XnatScanAcquisition
+
+# ----------------------------
+# results helper
+# ----------------------------
+# converts the scan_quality and scan_acquisition JSON of a scan into rows of the
+# xnat_instance_quality (one per scored instance and frame) and
+# xnat_scan_acquisition (one per scan, typed columns) tables, and summarizes the
+# acquisition tags of the filtered instances of a scan into scan_acquisition
+# ----------------------------
+
+# acquisition tag -> xnat_scan_acquisition column
+ACQUISITION_COLUMNS = {
+    'StudyInstanceUID': 'study_instance_uid',
+    'SeriesInstanceUID': 'series_instance_uid',
+    'Manufacturer': 'manufacturer',
+    'Modality': 'modality',
+    'ImageType': 'image_type',
+    'SliceThickness': 'slice_thickness',
+    'SpacingBetweenSlices': 'spacing_between_slices',
+    'ImagePositionPatient': 'image_position_patient',
+    'ImageOrientationPatient': 'image_orientation_patient',
+    'PixelSpacing': 'pixel_spacing',
+    'ContrastBolusAgent': 'contrast_bolus_agent',
+    'ScanningSequence': 'scanning_sequence',
+    'SequenceVariant': 'sequence_variant',
+    'ScanOptions': 'scan_options',
+    'MRAcquisitionType': 'mr_acquisition_type',
+    'SequenceName': 'sequence_name',
+    'RepetitionTime': 'repetition_time',
+    'EchoTime': 'echo_time',
+    'MagneticFieldStrength': 'magnetic_field_strength',
+    'EchoTrainLength': 'echo_train_length',
+    'FlipAngle': 'flip_angle',
+    'ContrastBolusUsageSequence': 'contrast_bolus_usage_sequence',
+    'ContrastBolusAgentPhase': 'contrast_bolus_agent_phase',
+    'KVP': 'kvp',
+    'FocalSpots': 'focal_spots',
+    'DistanceSourceToDetector': 'distance_source_to_detector',
+    'DistanceSourceToPatient': 'distance_source_to_patient',
+    'ExposureTime': 'exposure_time',
+    'XRayTubeCurrentInmA': 'x_ray_tube_current_in_ma',
+    'Exposure': 'exposure',
+    'FilterType': 'filter_type',
+    'GantryDetectorTilt': 'gantry_detector_tilt',
+    'TableHeight': 'table_height',
+    'ConvolutionKernel': 'convolution_kernel',
+    'SpiralPitchFactor': 'spiral_pitch_factor',
+    'BodyPartThickness': 'body_part_thickness',
+    'CompressionForce': 'compression_force',
+    'ViewPosition': 'view_position',
+    'ImageLaterality': 'image_laterality',
+}
+
+# tags expected to differ between the instances of a scan (not reported as varying)
+PER_INSTANCE_TAGS = ['ImagePositionPatient']
+
+# values counted as they are
+NONE_TYPE = type(None)
+HASHABLE_TYPES = (str, int, float, bool, NONE_TYPE)
+NUMERIC_TYPES = (int, float, np.number)
+
+# metric score columns of xnat_instance_quality (piqe_score, snr_score, ...)
+SCORE_COLUMNS = [column.name for column in XnatInstanceQuality.__table__.columns if column.name.endswith('_score')]
+
+# ----------------------------
+# quality rows (instance keys are the SOP Instance UID, with -<frame> for multi-frame instances)
+# ----------------------------
+
+def get_quality_rows(xnat_scan_id, scan_quality):
+
+    if not scan_quality:
+        return []
+
+    rows = []
+    for instance_key, instance in json.loads(scan_quality).get('instances', {}).items():
+        sop_instance_uid, _, frame = instance_key.partition('-')
+        rows.append({
+            'xnat_scan_id': xnat_scan_id,
+            'sop_instance_uid': sop_instance_uid,
+            'frame': int(frame) if frame else None,
+            **{column: instance.get(column) for column in SCORE_COLUMNS},
+        })
+
+    return rows
+
+# summary of the scan_quality of a scan (average scores and scored instances, returned with the job results of the daemon)
+def get_quality_summary(scan_quality):
+
+    if not scan_quality:
+        return {}
+
+    quality = json.loads(scan_quality)
+    summary = {key: value for key, value in quality.items() if key.startswith('average_')}
+    summary['scored_instances'] = len(quality.get('instances', {}))
+
+    return summary
+
+# ----------------------------
+# acquisition summary (scan_acquisition)
+# ----------------------------
+# one column per tag across the instances (in sort order): the value of each tag
+# is its most common value (the first of the instances on a tie), and the
+# consistency entry holds per tag the distinct values, the instances with the
+# most common value and, for numeric tags, the min and max; missing values are
+# not counted. Numeric columns (numbers, DS and IS values) are summarized with
+# numpy, text and multi-valued columns are counted
+# ----------------------------
+
+def get_acquisition_summary(headers):
+
+    tags = list(dict.fromkeys(tag for header in headers for tag in header.acquisition))
+
+    acquisition = {}
+    consistency = {}
+    for tag in tags:
+        values = [header.acquisition.get(tag) for header in headers]
+        numbers = get_numeric_column(values)
+        if numbers is not None:
+            acquisition[tag], consistency[tag] = get_numeric_summary(values, numbers)
+        else:
+            acquisition[tag], consistency[tag] = get_counted_summary(values)
+
+    acquisition['consistency'] = {
+        'instances': len(headers),
+        'varying': [tag for tag in tags if consistency[tag]['distinct'] > 1 and tag not in PER_INSTANCE_TAGS],
+        'tags': consistency,
+    }
+
+    return acquisition
+
+# numeric tags (numbers, DS and IS values) as a float column with NaN for missing
+# values, None for text, multi-valued and other tags
+def get_numeric_column(values):
+
+    types = set(map(type, values))
+    types.discard(NONE_TYPE)
+    if not types or not all(issubclass(value_type, NUMERIC_TYPES) and not issubclass(value_type, bool) for value_type in types):
+        return None
+
+    return np.array(values, dtype=float)
+
+def get_numeric_summary(values, numbers):
+
+    # missing values (NaN) are not counted
+    indices = np.flatnonzero(~np.isnan(numbers))
+    if not len(indices):
+        return None, {'distinct': 0, 'mode_count': 0}
+
+    # first instance of each distinct value, the mode is the first of tied values
+    uniques, first_indices, counts = np.unique(numbers[indices], return_index=True, return_counts=True)
+    tied = np.flatnonzero(counts == counts.max())
+    mode = tied[np.argmin(first_indices[tied])]
+
+    summary = {'distinct': len(uniques), 'mode_count': int(counts[mode]), 'min': float(uniques[0]), 'max': float(uniques[-1])}
+
+    return get_hashable(values[indices[first_indices[mode]]]), summary
+
+def get_counted_summary(values):
+
+    # counts in order of first appearance, so max takes the first of tied values
+    counts = Counter(get_hashable_values(values))
+    counts.pop(None, None)
+    for value in [value for value in counts if value != value]:
+        del counts[value]
+
+    mode = max(counts, key=counts.get) if counts else None
+    summary = {'distinct': len(counts), 'mode_count': counts[mode] if counts else 0}
+    numbers = [number for number in map(get_number, counts) if number is not None]
+    if numbers:
+        summary.update(min=min(numbers), max=max(numbers))
+
+    return get_json_value(mode), summary
+
+# numeric value of a tag (numbers, booleans and decimal text; None otherwise)
+def get_number(value):
+
+    if isinstance(value, (str, bytes)):
+        if not value.isascii() or (b'_' if isinstance(value, bytes) else '_') in value:
+            return None
+    elif not isinstance(value, (int, float, np.number)):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+
+    return number if number == number else None
+
+# values of a text or multi-valued tag across the instances (plain values as they are, DS values as floats)
+def get_hashable_values(values):
+
+    types = set(map(type, values))
+    if all(value_type in HASHABLE_TYPES or issubclass(value_type, str) for value_type in types):
+        return values
+    if all(issubclass(value_type, float) or value_type is NONE_TYPE for value_type in types):
+        return [float(value) if value is not None else None for value in values]
+
+    return [get_hashable(value) for value in values]
+
+# multi-values (lists) as tuples, values that cannot be hashed (sequences) as text,
+# DS and IS values as plain numbers (their comparisons are slow)
+def get_hashable(value):
+
+    if isinstance(value, list):
+        return tuple(get_hashable_values(value))
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return int(value)
+    try:
+        hash(value)
+    except TypeError:
+        return str(value)
+
+    return value
+
+def get_json_value(value):
+    return [get_json_value(item) for item in value] if isinstance(value, tuple) else value
+
+# ----------------------------
+# acquisition row (numeric columns take the first value, text columns join multiple values with \)
+# ----------------------------
+
+def get_acquisition_row(xnat_scan_id, scan_acquisition):
+
+    if not scan_acquisition:
+        return None
+
+    acquisition = json.loads(scan_acquisition)
+
+    row = {'xnat_scan_id': xnat_scan_id}
+    for tag, value in acquisition.items():
+        if tag in ACQUISITION_COLUMNS:
+            column = ACQUISITION_COLUMNS[tag]
+            row[column] = get_column_value(XnatScanAcquisition.__table__.columns[column].type, value)
+
+    # results of earlier versions (tags of one instance) have no consistency entry
+    consistency = acquisition.get('consistency')
+    if consistency:
+        row['instance_count'] = consistency['instances']
+        row['varying_tags'] = '\\'.join(consistency['varying'])
+
+    return row
+
+def get_column_value(column_type, value):
+
+    if value is None or value == '' or value == []:
+        return None
+
+    if isinstance(column_type, (REAL, INTEGER)):
+        if isinstance(value, list):
+            value = value[0]
+        try:
+            return int(float(value)) if isinstance(column_type, INTEGER) else float(value)
+        except (TypeError, ValueError):
+            return None
+
+    if isinstance(value, list):
+        if any(isinstance(item, (dict, list)) for item in value):
+            return json.dumps(value)
+        return '\\'.join(str(item) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value)
+
+    return str(value)
@@ -0,0 +1,206 @@
+import os
+import re
+import json
+import numpy as np
+from collections import Counter
+
+from models.staged_volume import StagedVolume
+from modules.decode_helper import decode_pixels
+from modules.concurrency_helper import get_download_threads
+
+import concurrent.futures as futures
+
+# ----------------------------
+# stage tools
+# ----------------------------
+# decodes the sorted, filtered instances of a scan once into a memory-mapped
+# <stage_path>/<project>/<subject>/<experiment>/<scan>/volume.npy with the header
+# records and geometry in volume.json; quality and normalization read the volume
+# zero-copy and reruns skip the DICOM download (delete the folder to restage)
+# ----------------------------
+
+class stage_tools(object):
+
+    def get_volume_path(self, args, scan):
+        keys = [scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id]
+        return os.path.join(args['stage_path'], *[re.sub(r'[^A-Za-z0-9_.-]', '_', str(key)) for key in keys])
+
+    # ----------------------------
+    # load staged volume (None if the scan has not been staged)
+    # ----------------------------
+    def load_volume(self, args, scan):
+
+        volume_path = self.get_volume_path(args, scan)
+        metadata_path = os.path.join(volume_path, 'volume.json')
+
+        # volume.json is written last, so its presence marks a complete volume
+        if not os.path.exists(metadata_path):
+            return None
+
+        with open(metadata_path) as json_file:
+            metadata = json.load(json_file)
+
+        return StagedVolume(volume_path, metadata)
+
+    # ----------------------------
+    # stage volume
+    # ----------------------------
+    def stage_volume(self, args, log, scan, dicom_files, read_dicom):
+
+        volume_path = self.get_volume_path(args, scan)
+
+        # instances must share the in-plane size (the most common one is kept)
+        dimensions = Counter((header.rows, header.columns) for header in dicom_files)
+        rows, columns = dimensions.most_common(1)[0][0]
+        stage_files = [header for header in dicom_files if (header.rows, header.columns) == (rows, columns)]
+        if len(stage_files) < len(dicom_files):
+            log.warning(f'Staging skips {len(dicom_files) - len(stage_files)} instances not matching {rows}x{columns}')
+
+        frame_starts = np.cumsum([0] + [header.number_of_frames for header in stage_files])
+        shape = (int(frame_starts[-1]), rows, columns)
+
+        # a volume staged earlier is replaced (volume.json first, so it is not loaded meanwhile); the
+        # temporary files are per process, a speculative run of the scan may stage it at the same time
+        metadata_path = os.path.join(volume_path, 'volume.json')
+        temp_path = os.path.join(volume_path, f'volume.{os.getpid()}.tmp.npy')
+        os.makedirs(volume_path, exist_ok=True)
+        try:
+            os.remove(metadata_path)
+        except FileNotFoundError:
+            pass
+
+        # the stored dtype of the volume holds the pixel types of all instances (from the header pass)
+        first_instance = self.read_instance(args, stage_files[0], read_dicom)
+        pixel_types = {header.pixel_type for header in stage_files if header.pixel_type} | {first_instance[0].dtype.name}
+        dtype = np.result_type(*sorted(pixel_types))
+        if len(pixel_types) > 1:
+            log.info(f'Staging instances with pixel types {", ".join(sorted(pixel_types))} as {dtype}')
+        array = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=shape)
+
+        def stage_instance(index):
+            pixel_array, geometry = first_instance if index == 0 else self.read_instance(args, stage_files[index], read_dicom)
+            array[frame_starts[index]:frame_starts[index + 1]] = pixel_array.reshape(-1, rows, columns)
+            return geometry
+
+        # ----------------------------
+        # Multi-threaded
+        # ----------------------------
+
+        try:
+            if args['multi_thread'] == True:
+                with futures.ThreadPoolExecutor(max_workers=get_download_threads(args)) as executor:
+                    geometries = list(executor.map(stage_instance, range(len(stage_files))))
+
+            # ----------------------------
+            # Single-threaded
+            # ----------------------------
+
+            else:
+                geometries = [stage_instance(index) for index in range(len(stage_files))]
+
+            array.flush()
+        except BaseException:
+            # a cancelled run leaves no partial file
+            del array
+            os.remove(temp_path)
+            raise
+        del array
+
+        instances = []
+        for index, header in enumerate(stage_files):
+            instances.append({
+                'header': header.to_dict(),
+                'frame_start': int(frame_starts[index]),
+                'frame_count': header.number_of_frames,
+                **geometries[index],
+            })
+
+        metadata = {
+            'modality': stage_files[0].modality,
+            'shape': list(shape),
+            'dtype': str(dtype),
+            **self.get_volume_geometry(instances),
+            'instances': instances,
+        }
+
+        os.replace(temp_path, os.path.join(volume_path, 'volume.npy'))
+        with open(f'{metadata_path}.{os.getpid()}.tmp', 'w') as json_file:
+            json.dump(metadata, json_file, default=str)
+        os.replace(f'{metadata_path}.{os.getpid()}.tmp', metadata_path)
+
+        log.info(f'Staged volume {shape} ({metadata["dtype"]}): {volume_path}')
+
+        return StagedVolume(volume_path, metadata)
+
+    # ----------------------------
+    # remove staged volume (volume.json first, so a partly removed volume is never loaded)
+    # ----------------------------
+    def remove_volume(self, volume):
+
+        volume.array = None
+        for file_name in ['volume.json', 'volume.npy']:
+            try:
+                os.remove(os.path.join(volume.volume_path, file_name))
+            except FileNotFoundError:
+                pass
+
+        return None
+
+    def read_instance(self, args, header, read_dicom):
+
+        dataset = read_dicom(header.scan_file, exclude_pixels=False)[1]
+
+        pixel_spacing = get_float_list(dataset, 'PixelSpacing') or get_float_list(dataset, 'ImagerPixelSpacing')
+        slice_thickness = get_float_list(dataset, 'SpacingBetweenSlices') or get_float_list(dataset, 'SliceThickness')
+
+        # enhanced multi-frame objects keep the pixel measures in the shared functional groups
+        if pixel_spacing is None and 'SharedFunctionalGroupsSequence' in dataset:
+            shared_groups = dataset.SharedFunctionalGroupsSequence[0]
+            if 'PixelMeasuresSequence' in shared_groups:
+                pixel_measures = shared_groups.PixelMeasuresSequence[0]
+                pixel_spacing = get_float_list(pixel_measures, 'PixelSpacing')
+                slice_thickness = slice_thickness or get_float_list(pixel_measures, 'SpacingBetweenSlices') or get_float_list(pixel_measures, 'SliceThickness')
+
+        geometry = {
+            'position': get_float_list(dataset, 'ImagePositionPatient'),
+            'orientation': get_float_list(dataset, 'ImageOrientationPatient'),
+            'pixel_spacing': pixel_spacing,
+            'slice_thickness': slice_thickness[0] if slice_thickness else None,
+            'rescale_slope': float(dataset.get('RescaleSlope', 1) or 1),
+            'rescale_intercept': float(dataset.get('RescaleIntercept', 0) or 0),
+        }
+
+        return decode_pixels(dataset, args), geometry
+
+    # ----------------------------
+    # volume geometry: spacing [slice, row, column], orientation, origin
+    # ----------------------------
+    def get_volume_geometry(self, instances):
+
+        first_instance = instances[0]
+        row_spacing, column_spacing = first_instance['pixel_spacing'] or [None, None]
+        slice_spacing = first_instance['slice_thickness']
+
+        # slice spacing from the positions along the slice normal
+        positions = [instance['position'] for instance in instances if instance['position']]
+        orientation = first_instance['orientation']
+        if orientation and len(positions) == len(instances) and len(positions) > 1:
+            normal = np.cross(orientation[:3], orientation[3:])
+            distances = np.diff(np.array(positions) @ normal)
+            if np.any(distances != 0):
+                slice_spacing = float(np.median(np.abs(distances[distances != 0])))
+
+        return {
+            'spacing': [slice_spacing, row_spacing, column_spacing],
+            'orientation': orientation,
+            'origin': first_instance['position'],
+        }
+
+def get_float_list(dataset, tag):
+    if tag not in dataset or dataset.get(tag) is None:
+        return None
+    value = dataset.get(tag)
+    try:
+        return [float(x) for x in value]
+    except TypeError:
+        return [float(value)]
@@ -0,0 +1,427 @@
+import os
+import time
+import uuid
+import shutil
+
+import concurrent.futures as futures
+from concurrent.futures.process import BrokenProcessPool
+
+# ----------------------------
+# straggler helper
+# ----------------------------
+# deadlines of the scan worker pool (multi_proc):
+#   scan_timeouts     - seconds a scan may run, per stage ('default' for the
+#                       others); a scan past its deadline is cancelled and run
+#                       again up to scan_retries times, then fails
+#   straggler_factor  - a scan running straggler_factor x its expected time is
+#                       cancelled and run again in the same way
+#   stage_timeouts    - seconds a stage of a batch run may take, per stage; at the
+#                       deadline the waiting scans are dropped and the running
+#                       ones cancelled (also between scans without multi_proc)
+#
+# the expected time of a scan is its DICOM file count times the seconds per
+# file of the scans of the same stage and modality completed in the run (after
+# MIN_SAMPLES of them), so stragglers are only recognized once a run is going
+#
+# with speculative_execution, once no scan is waiting for a worker, the scans
+# running SPECULATIVE_FACTOR x their expected time are started a second time on
+# the idle workers and the first result is kept
+#
+# each attempt of a scan has a claim file <data_path>/runs/<pool run>/<scan>-<sequence>-<attempt>:
+# the first of its runs to create it writes the results (database rows, QC
+# resources), and the other runs stop at their next check (between files,
+# instances and slabs) without side effects, which frees their worker; the pool
+# cancels an attempt by creating the file itself, unless a run has claimed it
+# (that run is writing its results and is left to finish)
+#
+# cancelled runs that have not stopped after CANCEL_GRACE seconds (stuck in a
+# call) are left to their pool, which is shut down without waiting for them, and
+# the scans go to a new pool
+# ----------------------------
+
+MIN_SAMPLES = 3
+SPECULATIVE_FACTOR = 1.5
+# no scan is a straggler before it has run this long
+MIN_STRAGGLER_SECONDS = 60
+# seconds between looks at the deadlines while scans run (and at the claim file in the runs)
+CHECK_INTERVAL = 1
+# seconds a cancelled run may take to stop before its pool is replaced
+CANCEL_GRACE = 60
+
+CANCELLED = 'cancelled'
+
+class RunCancelled(Exception):
+    pass
+
+class straggler_helper(object):
+
+    def __init__(self, args, log, stage=None):
+
+        self.log = log
+        self.scan_timeouts = args['scan_timeouts'] or {}
+        self.straggler_factor = args['straggler_factor'] or 0
+        self.retries = args['scan_retries']
+        self.speculative = args['speculative_execution'] == True
+
+        # the daemon queue has no end, so no stage deadline
+        stage_timeout = (args['stage_timeouts'] or {}).get(stage) if stage and args['daemon'] != True else None
+        self.stage_deadline = time.monotonic() + stage_timeout if stage_timeout else None
+
+        # folder of the claim files (start_runs)
+        self.run_path = None
+
+        # future -> [item, estimate, start time, speculative, run id]
+        self.running = {}
+        # scan id -> futures of the scan (the first run and its speculative copies)
+        self.scan_runs = {}
+        # scan id -> first error of its runs (other than a cancelled run)
+        self.scan_errors = {}
+        # cancelled runs (speculative runs that lost, runs past their deadline) until they stop -> [claim path, cancel time]
+        self.abandoned = {}
+
+        # (stage, modality) -> [seconds, files, scans]
+        self.samples = {}
+        self.attempts = {}
+        self.statistics = {'timeouts': 0, 'stragglers': 0, 'retries': 0, 'restarts': 0, 'speculative': 0, 'speculative_wins': 0, 'stage_timeout': False}
+
+    @property
+    def enabled(self):
+        return bool(self.scan_timeouts) or self.straggler_factor > 0 or self.speculative or self.stage_deadline is not None
+
+    # ----------------------------
+    # expected time
+    # ----------------------------
+
+    def observe(self, item, result):
+
+        files = (result.get('counters') or {}).get('files', 0)
+        if files:
+            sample = self.samples.setdefault((item.stages[0], item.scan.scan_modality), [0.0, 0, 0])
+            sample[0] += result.get('total_time') or 0.0
+            sample[1] += files
+            sample[2] += 1
+
+        return None
+
+    def expected(self, item):
+
+        sample = self.samples.get((item.stages[0], item.scan.scan_modality))
+        if sample is None or sample[2] < MIN_SAMPLES or not item.scan.scan_file_count:
+            return None
+
+        return item.scan.scan_file_count * sample[0] / sample[1]
+
+    # ----------------------------
+    # deadlines
+    # ----------------------------
+
+    # reason a running scan is past its deadline (None if it is not)
+    def get_expired(self, item, elapsed):
+
+        timeout = self.scan_timeouts.get(item.stages[0], self.scan_timeouts.get('default'))
+        if timeout and elapsed > timeout:
+            return f'timeout ({elapsed:.0f} s of {timeout} s)'
+
+        expected = self.expected(item) if self.straggler_factor > 0 else None
+        if expected is not None and elapsed > max(MIN_STRAGGLER_SECONDS, self.straggler_factor * expected):
+            return f'straggler ({elapsed:.0f} s, expected {expected:.0f} s)'
+
+        return None
+
+    # True if the scan is run again, False if it has used its retries
+    def retry(self, item, reason):
+
+        self.statistics['stragglers' if reason.startswith('straggler') else 'timeouts'] += 1
+        attempts = self.attempts.get(item.scan.xnat_scan_id, 1)
+        if attempts > self.retries:
+            return False
+        self.attempts[item.scan.xnat_scan_id] = attempts + 1
+        self.statistics['retries'] += 1
+
+        return True
+
+    def stage_expired(self):
+
+        if self.stage_deadline is not None and time.monotonic() > self.stage_deadline and not self.statistics['stage_timeout']:
+            self.statistics['stage_timeout'] = True
+            return True
+
+        return False
+
+    # ----------------------------
+    # deadline sweep (scans past their deadline, or all running scans at the stage deadline)
+    # ----------------------------
+    # cancels the attempts of the expired scans and returns [item, reason, retried]
+    # per cancelled scan (run again if retried, failed otherwise); a scan claimed by
+    # one of its runs is writing its results and is left to finish
+    # ----------------------------
+
+    def sweep(self, stage_expired, broken=False):
+
+        expired = {}
+        if stage_expired:
+            expired = {scan_id: 'stage timeout' for scan_id in self.scan_runs}
+        elif self.enabled and not broken:
+            now = time.monotonic()
+            for item, _, started, speculative, _ in self.running.values():
+                reason = self.get_expired(item, now - started) if not speculative else None
+                if reason:
+                    expired[item.scan.xnat_scan_id] = reason
+
+        cancelled = []
+        for scan_id, reason in expired.items():
+            item = self.running[self.scan_runs[scan_id][0]][0]
+            if not self.cancel_attempt(item):
+                continue
+            self.abandon(item, self.scan_runs.pop(scan_id))
+            self.scan_errors.pop(scan_id, None)
+            cancelled.append([item, reason, reason != 'stage timeout' and self.retry(item, reason)])
+
+        return cancelled
+
+    # ----------------------------
+    # speculative execution (running scans to start again, slowest relative to their expected time first)
+    # ----------------------------
+
+    # scans in flight to start again on the free slots (scans without a copy running)
+    def get_speculative_runs(self, slots):
+
+        now = time.monotonic()
+        running = [(item, now - started) for item, _, started, speculative, _ in self.running.values()
+                   if not speculative and len(self.scan_runs[item.scan.xnat_scan_id]) == 1]
+        items = self.get_speculative(running, slots)
+        self.statistics['speculative'] += len(items)
+
+        return items
+
+    def get_speculative(self, running, slots):
+
+        if not self.speculative or slots <= 0:
+            return []
+
+        candidates = []
+        for item, elapsed in running:
+            expected = self.expected(item)
+            if expected is not None and elapsed > max(1.0, SPECULATIVE_FACTOR * expected):
+                candidates.append((elapsed / expected, item))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        return [item for _, item in candidates[:slots]]
+
+    # ----------------------------
+    # runs (claim files of the scans in flight)
+    # ----------------------------
+
+    def start_runs(self, args):
+
+        if self.enabled:
+            self.run_path = os.path.join(args['data_path'], 'runs', uuid.uuid4().hex)
+            os.makedirs(self.run_path)
+
+        return None
+
+    def end_runs(self):
+
+        if self.run_path is not None:
+            shutil.rmtree(self.run_path, ignore_errors=True)
+
+        return None
+
+    def get_claim_path(self, item):
+        return os.path.join(self.run_path, f'{item.scan.xnat_scan_id}-{item.sequence}-{self.get_attempts(item)}')
+
+    # worker args of a new run of the scan (the args unchanged without deadlines) and its id
+    def get_run_args(self, args, item):
+
+        if self.run_path is None:
+            return args, None
+
+        run_id = uuid.uuid4().hex
+        return {**args, 'run_path': self.run_path, 'run_id': run_id, 'run_claim': self.get_claim_path(item)}, run_id
+
+    # True if the attempt is cancelled, False if one of its runs has claimed it
+    def cancel_attempt(self, item):
+        return create_claim(self.get_claim_path(item), CANCELLED)
+
+    # the claim of a run that failed (the other runs of the attempt may claim it), or of the attempt (run_id None)
+    def release_claim(self, item, run_id=None):
+
+        if self.run_path is None:
+            return None
+
+        claim_path = self.get_claim_path(item)
+        try:
+            if run_id is not None:
+                with open(claim_path) as claim_file:
+                    if claim_file.read() != run_id:
+                        return None
+            os.remove(claim_path)
+        except OSError:
+            pass
+
+        return None
+
+    # ----------------------------
+    # runs in flight (futures of the scan worker pool)
+    # ----------------------------
+
+    def add_run(self, future, item, estimate, speculative, run_id):
+
+        self.running[future] = [item, estimate, time.monotonic(), speculative, run_id]
+        self.scan_runs.setdefault(item.scan.xnat_scan_id, []).append(future)
+
+        return None
+
+    # futures to wait for and workers they take (cancelled runs included until they stop)
+    def get_futures(self):
+        return list(self.running) + list(self.abandoned)
+
+    @property
+    def busy(self):
+        return len(self.running) + len(self.abandoned)
+
+    # the runs of a scan stop (they find the claim of the attempt taken)
+    def abandon(self, item, runs):
+
+        claim_path = self.get_claim_path(item) if self.run_path else None
+        for future in runs:
+            self.running.pop(future, None)
+            if not future.cancel():
+                self.abandoned[future] = [claim_path, time.monotonic()]
+
+        return None
+
+    # a finished future: [item, estimate, speculative, result, error] once its scan is
+    # done, None while another run of the scan may still succeed (or for a cancelled run)
+    def end_run(self, future):
+
+        if future in self.abandoned:
+            claim_path, _ = self.abandoned.pop(future)
+            # the last run of a cancelled attempt has stopped
+            if claim_path and not any(other[0] == claim_path for other in self.abandoned.values()) and os.path.exists(claim_path):
+                os.remove(claim_path)
+            return None
+
+        item, estimate, _, speculative, run_id = self.running.pop(future)
+        scan_id = item.scan.xnat_scan_id
+        runs = self.scan_runs[scan_id]
+        runs.remove(future)
+        result = None
+        try:
+            result = future.result()
+        except Exception as e:
+            # a run that failed after its claim leaves the results to the other runs
+            self.release_claim(item, run_id)
+            if not isinstance(e, (RunCancelled, futures.CancelledError)):
+                self.scan_errors.setdefault(scan_id, e)
+            if runs and not isinstance(e, BrokenProcessPool):
+                return None
+            error = self.scan_errors.pop(scan_id, e)
+        else:
+            self.scan_errors.pop(scan_id, None)
+            error = None
+
+        # the first result of the scan is kept, its other runs stop at their next check
+        self.abandon(item, runs)
+        if not runs:
+            self.release_claim(item)
+        del self.scan_runs[scan_id]
+
+        if error is None:
+            self.observe(item, result)
+            self.statistics['speculative_wins'] += 1 if speculative else 0
+
+        return [item, estimate, speculative, result, error]
+
+    # cancelled runs not stopped after CANCEL_GRACE seconds (stuck in a call), left to their pool
+    def drop_stuck_runs(self):
+
+        now = time.monotonic()
+        stuck = [future for future, (_, cancelled) in self.abandoned.items() if now - cancelled > CANCEL_GRACE]
+        for future in stuck:
+            del self.abandoned[future]
+        if stuck:
+            self.statistics['restarts'] += 1
+
+        return len(stuck)
+
+    # ----------------------------
+    # metrics
+    # ----------------------------
+
+    def get_attempts(self, item):
+        return self.attempts.get(item.scan.xnat_scan_id, 1)
+
+    def log_statistics(self):
+
+        if any(self.statistics.values()):
+            self.log.info(f'Stragglers - timeouts: {self.statistics["timeouts"]} | stragglers: {self.statistics["stragglers"]} | '
+                          f'retries: {self.statistics["retries"]} | pool restarts: {self.statistics["restarts"]} | '
+                          f'speculative: {self.statistics["speculative"]} (first: {self.statistics["speculative_wins"]}) | '
+                          f'stage timeout: {self.statistics["stage_timeout"]}')
+
+        return None
+
+# ----------------------------
+# run of a scan worker (args of get_run_args; no run without deadlines)
+# ----------------------------
+
+_worker_run = {}
+
+def start_worker_run(args):
+
+    _worker_run.clear()
+    if args.get('run_id'):
+        _worker_run.update(run_id=args['run_id'], run_path=args['run_path'], claim_path=args['run_claim'], claimed=False, checked=0.0)
+
+    return None
+
+def end_worker_run():
+    _worker_run.clear()
+    return None
+
+# raises RunCancelled once another run claimed the scan, the pool cancelled it or the pool has ended
+def check_worker_run():
+
+    if not _worker_run or _worker_run['claimed']:
+        return None
+
+    now = time.monotonic()
+    if now - _worker_run['checked'] < CHECK_INTERVAL:
+        return None
+    _worker_run['checked'] = now
+
+    if os.path.exists(_worker_run['claim_path']) or not os.path.isdir(_worker_run['run_path']):
+        raise RunCancelled('Scan run cancelled (another run has the results, or the run was cancelled)')
+
+    return None
+
+# called before the results are written; raises RunCancelled if the scan is not this run's to write
+def claim_worker_run():
+
+    if not _worker_run or _worker_run['claimed']:
+        return None
+
+    try:
+        claimed = create_claim(_worker_run['claim_path'], _worker_run['run_id'])
+    except FileNotFoundError:
+        claimed = False
+    if not claimed:
+        raise RunCancelled('Scan run cancelled (another run has the results, or the run was cancelled)')
+    _worker_run['claimed'] = True
+
+    return None
+
+# False if the claim file exists
+def create_claim(claim_path, owner):
+
+    try:
+        claim_file = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    try:
+        os.write(claim_file, owner.encode('utf-8'))
+    finally:
+        os.close(claim_file)
+
+    return True
@@ -0,0 +1,63 @@
+import importlib
+import multiprocessing
+
+from modules.straggler_helper import start_worker_run, end_worker_run
+
+# ----------------------------
+# worker helper
+# ----------------------------
+# entry point of the scan worker processes; only this module is pickled with a
+# task, the stage module (and its xnat, pydicom, cv2 imports) is imported on the
+# first scan of the stage in each worker
+#
+# multi_proc_start_method selects how the scan workers are started:
+#   spawn      - every worker imports its stage modules itself (default)
+#   forkserver - the stage modules are imported once by the fork server and
+#                the workers are forked from it
+# ----------------------------
+
+# preprocess function -> stage module, tools class, scan method
+WORKER_STAGES = {
+    'quality_functions': ('modules.quality_tools', 'quality_tools', 'preprocess_scan'),
+    'normalization_functions': ('modules.normalization_tools', 'normalization_tools', 'normalize_scan'),
+}
+
+START_METHODS = ['spawn', 'forkserver']
+
+_stage_tools = {}
+
+def get_stage_tools(stage):
+
+    if stage not in _stage_tools:
+        module_name, class_name, method_name = WORKER_STAGES[stage]
+        _stage_tools[stage] = getattr(importlib.import_module(module_name), class_name)()
+
+    return _stage_tools[stage]
+
+def run_worker_scan(stage, scan, args, log, xtools=None, dbtools=None):
+
+    method_name = WORKER_STAGES[stage][2]
+
+    # the claim of the run (with deadlines), see straggler_helper
+    start_worker_run(args)
+    try:
+        return getattr(get_stage_tools(stage), method_name)(scan, args, log, xtools, dbtools)
+    finally:
+        end_worker_run()
+
+# ----------------------------
+# worker start method (forkserver preloads the stage modules of the run)
+# ----------------------------
+
+def get_worker_context(args):
+
+    start_method = args['multi_proc_start_method']
+    if start_method not in START_METHODS:
+        raise Exception(f'Unsupported multi_proc_start_method {start_method} (use one of {START_METHODS})')
+
+    context = multiprocessing.get_context(start_method)
+    if start_method == 'forkserver':
+        # only applies before the fork server is started (first pool of the run)
+        context.set_forkserver_preload([WORKER_STAGES[stage][0] for stage in args['preprocess_functions'] if stage in WORKER_STAGES])
+
+    return context
@@ -1,20 +1,39 @@
 import os
 import io
+import re
 import xnat
 import random
 import string
 import pandas as pd
+import time
 import shutil
+import queue
+import threading
+from urllib.parse import quote
+from xnat.exceptions import XNATResponseError
 
 
-from models.db import XnatScan
+
+# seconds a resolved project, subject or experiment is kept by get_xnat_element
+ELEMENT_TTL = 300
+ELEMENT_LEVELS = ['projects', 'subjects', 'experiments', 'scans']
+
+# archive chunks downloaded ahead of the reader
+ARCHIVE_QUEUE_CHUNKS = 8
+
+# session of each scan worker process, kept across its scans
+_worker_xnat_tools = {}
+_worker_xnat_tools_lock = threading.Lock()
 
 class xnat_tools(object):
 
-    def __init__(self, xnat_server, xnat_user, xnat_password):
+    # request_timeout - seconds a request may wait for the server (to connect, or between bytes)
+    def __init__(self, xnat_server, xnat_user, xnat_password, request_timeout=3600):
         
         self.xnat_session = xnat.connect(server=xnat_server, user=xnat_user, password=xnat_password,
-                                         default_timeout=3600)
+                                         default_timeout=request_timeout)
+        # uri -> (expiry, element)
+        self.element_cache = {}
 
     # ----------------------------
     # xnat server functions
@@ -22,15 +41,38 @@ class xnat_tools(object):
     
     #https://xnat.readthedocs.io/en/latest/static/tutorial.html#low-level-rest-directives
 
+    # listings cached by the session, and by the resolved elements (resolved again on next use)
+    def clear_cache(self):
+        self.xnat_session.clearcache()
+        self.element_cache.clear()
+        return None
+
+    # addressed by URI (one request) instead of through the listings of each level; projects, subjects
+    # and experiments are kept for ELEMENT_TTL seconds, scans are resolved on every call
+    # (a missing element raises KeyError, like a key missing from a listing)
     def get_xnat_element(self, project_id=None, subject_id=None, experiment_id=None, scan_id=None):
-        if project_id is not None:
-            if subject_id is not None:
-                if experiment_id is not None:
-                    if scan_id is not None:
-                        return self.xnat_session.projects[project_id].subjects[subject_id].experiments[experiment_id].scans[scan_id]
-                    return self.xnat_session.projects[project_id].subjects[subject_id].experiments[experiment_id]
-                return self.xnat_session.projects[project_id].subjects[subject_id]
-            return self.xnat_session.projects[project_id]
+        keys = [project_id, subject_id, experiment_id, scan_id]
+        keys = keys[:keys.index(None)] if None in keys else keys
+        if not keys:
+            return None
+
+        uri = '/data/' + '/'.join(f'{level}/{quote(str(key), safe="")}' for level, key in zip(ELEMENT_LEVELS, keys))
+
+        cached = self.element_cache.get(uri)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        try:
+            element = self.xnat_session.create_object(uri)
+        except XNATResponseError as e:
+            if '(status 404' in str(e):
+                raise KeyError(f'Could not find {uri}') from e
+            raise
+
+        if scan_id is None:
+            self.element_cache[uri] = (time.monotonic() + ELEMENT_TTL, element)
+
+        return element
 
     def get_xnat_scan_list(self, project_id, subject_id=None, experiment_id=None):
         xnat_list = []
@@ -54,6 +96,72 @@ class xnat_tools(object):
                             xnat_list.append(info)
         return xnat_list
 
+    # experiments of a project with their last modified time (one listing request)
+    def get_xnat_experiment_list(self, project_id):
+        uri = f'/data/projects/{project_id}/experiments'
+        experiments = self.xnat_session.get_json(uri, query={'columns': 'ID,label,subject_ID,last_modified'})['ResultSet']['Result']
+        return [{'experiment_id': experiment['ID'], 'label': experiment.get('label'), 'subject_id': experiment.get('subject_ID'), 'last_modified': experiment.get('last_modified')}
+                for experiment in experiments]
+
+    def get_xnat_scan_size(self, project_id, subject_id, experiment_id, scan_id):
+        uri = f'/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}/scans/{scan_id}/resources'
+        for resource in self.xnat_session.get_json(uri)['ResultSet']['Result']:
+            if resource.get('label') == 'DICOM':
+                return int(resource.get('file_count') or 0), int(resource.get('file_size') or 0)
+        return 0, 0
+
+    # file listing of a scan resource as xnat_file catalog records
+    def get_xnat_scan_files(self, project_id, subject_id, experiment_id, scan_id, resource='DICOM'):
+        uri = f'/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}/scans/{scan_id}/resources/{resource}/files'
+        scan_files = []
+        for scan_file in self.xnat_session.get_json(uri)['ResultSet']['Result']:
+            scan_files.append({
+                'resource_label': resource,
+                'file_name': scan_file.get('Name'),
+                'file_path': re.sub(r'^.*/resources/[^/]+/files/', '', scan_file['URI'], 1),
+                'file_uri': scan_file['URI'],
+                'file_size': int(scan_file.get('Size') or 0),
+                'file_digest': scan_file.get('digest') or None,
+                'file_format': scan_file.get('file_format') or None,
+                'file_content': scan_file.get('file_content') or None,
+            })
+        return scan_files
+
+    # resource of several scans of an experiment as one zip, streamed as chunks (the generator is closed by the caller);
+    # the session writes the download to a queue from a thread, so the chunks are read while the archive arrives
+    def get_xnat_scan_archive(self, project_id, subject_id, experiment_id, scan_ids, resource='DICOM', chunk_size=1024 * 1024):
+        scans = ','.join(quote(str(scan_id), safe='') for scan_id in scan_ids)
+        path = f'/data/projects/{project_id}/subjects/{subject_id}/experiments/{experiment_id}/scans/{scans}/resources/{resource}/files'
+
+        stream = queue_stream(ARCHIVE_QUEUE_CHUNKS)
+
+        def download():
+            try:
+                self.xnat_session.download_stream(path, stream, format='zip', chunk_size=chunk_size, timeout=self.xnat_session.request_timeout)
+                stream.put(None)
+            except Exception as e:
+                stream.put(e)
+
+        threading.Thread(target=download, name='xnat_archive', daemon=True).start()
+        try:
+            while True:
+                chunk = stream.queue.get()
+                if chunk is None:
+                    return None
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stream.cancel()
+
+    # DICOM files of a scan: from the file catalog records if given (no listing request), listed live otherwise
+    def get_scan_files(self, xnat_scan, file_records=None):
+        if file_records:
+            return {record.file_name: self.xnat_session.create_object(record.file_uri, type_='xnat:fileData', id_=record.file_path,
+                                                                       fieldname='ResourceCatalog', name=record.file_name)
+                    for record in file_records}
+        return xnat_scan.resources['DICOM'].files if 'DICOM' in xnat_scan.resources else None
+
     def set_scan_json_resource(self, args, log, scan, json_text, json_name):
         
         random_string = ''.join(random.choices(string.ascii_letters, k=10))
@@ -95,7 +203,13 @@ class xnat_tools(object):
         for project in args.xnat_projects:
             log.info(f'Indexing {project}')        
 
-            xnat_df = pd.DataFrame(self.get_xnat_scan_list(project))
+            self.index_scan_list(log, dbtools, project, self.get_xnat_scan_list(project))
+
+    def index_scan_list(self, log, dbtools, project, xnat_list, scan_files=None):
+
+        scan_files = scan_files if scan_files is not None else {}
+        if xnat_list:
+            xnat_df = pd.DataFrame(xnat_list)
 
             db_df = dbtools.get_db_scan_list(df=True, project=project)
             db_df.set_index('xnat_scan_id', drop=True, inplace=True)
@@ -105,21 +219,153 @@ class xnat_tools(object):
 
             scan_inserts = []
             for index, row in new_records.iterrows():
-                new_scan = XnatScan(
-                    project_id = row.project_id,
-                    project_name = row.project_name,
-                    subject_id = row.subject_id,
-                    subject_label = row.subject_label,
-                    experiment_id = row.experiment_id,
-                    experiment_label = row.experiment_label,
-                    scan_id = row.scan_id,
-                    scan_modality = row.scan_modality,
-                    scan_type = row.scan_type,
-                )
+                # DICOM resource size for the memory estimates of the worker pool and the file catalog
+                file_count, file_size, scan_files[(row.subject_id, row.experiment_id, row.scan_id)] = self.get_xnat_scan_catalog(log, row)
+
+                new_scan = {
+                    'project_id': row.project_id,
+                    'project_name': row.project_name,
+                    'subject_id': row.subject_id,
+                    'subject_label': row.subject_label,
+                    'experiment_id': row.experiment_id,
+                    'experiment_label': row.experiment_label,
+                    'scan_id': row.scan_id,
+                    'scan_modality': row.scan_modality,
+                    'scan_type': row.scan_type,
+                    'scan_file_count': file_count,
+                    'scan_file_size': file_size,
+                }
                 scan_inserts.append(new_scan)
 
-            dbtools.insert_list(scan_inserts)
+            # rows (loaded with COPY on PostgreSQL), the scans are read back by the file catalog below
+            dbtools.insert_dicts('xnat_scan', scan_inserts)
+
+        self.index_scan_files(log, dbtools, project, scan_files)
+
+        return None
+
+    # ----------------------------
+    # index experiments (daemon)
+    # ----------------------------
+    # indexes the new scans of new or changed experiments of a project; scans of
+    # a changed experiment indexed before whose DICOM resource changed (files
+    # added or removed) are cataloged again and their results cleared, so they
+    # are processed again (QC uploads also change an experiment, not its DICOM)
+    # ----------------------------
 
+    def index_experiments(self, log, dbtools, project, experiments):
 
+        # listings cached by the session since the last poll are stale
+        self.clear_cache()
 
+        scan_files = {}
+        for subject_id, experiment_id in experiments:
+            for scan in dbtools.get_db_scan_list(df=False, project=project, experiment=experiment_id):
+                file_count, file_size, files = self.get_xnat_scan_catalog(log, scan)
+                if files is None or (file_count == scan.scan_file_count and file_size == scan.scan_file_size):
+                    continue
+                log.info(f'Scan changed - experiment: {experiment_id} | scan: {scan.scan_id} | files: {scan.scan_file_count} -> {file_count}')
+                dbtools.delete_db_file_list(scan.xnat_scan_id)
+                scan.scan_file_count, scan.scan_file_size = file_count, file_size
+                scan.scan_quality, scan.scan_acquisition, scan.scan_normalization = None, None, None
+                scan_files[(scan.subject_id, scan.experiment_id, scan.scan_id)] = files
+            dbtools.flush_database()
+
+        xnat_list = []
+        for subject_id, experiment_id in experiments:
+            xnat_list.extend(self.get_xnat_scan_list(project, subject_id, experiment_id))
+
+        # changed scans are cataloged with the new scans (their old catalog was removed)
+        self.index_scan_list(log, dbtools, project, xnat_list, scan_files)
+
+        return None
+
+    # ----------------------------
+    # index scan files
+    # ----------------------------
+    # inserts the file catalog of the new scans in bulk (listed above) and of
+    # scans indexed before the catalog existed (listed here); scans whose listing
+    # failed are retried on the next index
+    # ----------------------------
+
+    def index_scan_files(self, log, dbtools, project, scan_files):
+
+        file_inserts = []
+        for scan in dbtools.get_db_uncataloged_scan_list(df=False, project=project):
+            key = (scan.subject_id, scan.experiment_id, scan.scan_id)
+            if key not in scan_files:
+                file_count, file_size, scan_files[key] = self.get_xnat_scan_catalog(log, scan)
+                if scan_files[key] is not None:
+                    scan.scan_file_count, scan.scan_file_size = file_count, file_size
+            if scan_files[key] is None:
+                continue
+
+            file_inserts.extend({'xnat_scan_id': scan.xnat_scan_id, **scan_file} for scan_file in scan_files[key])
+
+        if file_inserts:
+            dbtools.insert_dicts('xnat_file', file_inserts)
+        dbtools.flush_database()
+
+        log.info(f'Indexed {len(file_inserts)} files of {project}')
+
+        return None
+
+    # DICOM resource size and file listing of a scan (None if it cannot be retrieved)
+    def get_xnat_scan_catalog(self, log, scan):
+        try:
+            file_count, file_size = self.get_xnat_scan_size(scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id)
+            files = self.get_xnat_scan_files(scan.project_id, scan.subject_id, scan.experiment_id, scan.scan_id) if file_count else []
+        except Exception as e:
+            log.warning(f'Cannot retrieve resource files - experiment: {scan.experiment_id} | scan: {scan.scan_id} | error: {str(e)}')
+            return None, None, None
+        return file_count, file_size, files
+
+# ----------------------------
+# session of a scan worker process
+# ----------------------------
+# kept across the scans of the process (connecting takes several requests); its
+# cache is cleared for each scan, so a scan sees the listings as of its start
+# ----------------------------
+
+def get_worker_xnat_tools(args):
+
+    key = (args['xnat_server'], args['xnat_user'])
+    with _worker_xnat_tools_lock:
+        xtools = _worker_xnat_tools.get(key)
+        if xtools is None:
+            xtools = _worker_xnat_tools[key] = xnat_tools(args['xnat_server'], args['xnat_user'], args['xnat_password'],
+                                                                    request_timeout=args['xnat_request_timeout'])
+        else:
+            xtools.clear_cache()
+
+    return xtools
+
+# ----------------------------
+# queue stream (written by a download, read as chunks from the queue)
+# ----------------------------
+
+class queue_stream(object):
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        if not self.put(data):
+            raise IOError('Archive download cancelled by the reader')
+        return len(data)
+
+    # False if the reader stopped before the item was queued
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
+    # the reader stops: the download fails on its next write
+    def cancel(self):
+        self.cancelled.set()
+        return None
@@ -4,11 +4,8 @@ import json
 from datetime import datetime
 import multiprocessing
 
-from modules.xnat_tools import xnat_tools
-from modules.db_tools import db_tools
-
-from modules.quality_tools import quality_tools
-from modules.normalization_tools import normalization_tools
+# xnat_tools, db_tools and the stage tools are imported where they are used; spawned
+# processes re-import this module and should not pay for xnat, pandas, pydicom and cv2
 
 from modules.log_helper import log_helper
 from modules.arg_helper import arg_helper
@@ -17,11 +14,14 @@ def run_preprocessing(args, log):
     
     log.info(f'Running Preprocessing')
 
+    from modules.xnat_tools import xnat_tools
+    from modules.db_tools import db_tools
+
     # --------------------------------------
     # initialize tools
     # --------------------------------------
     log.info(f'Initializing XNAT')
-    xtools = xnat_tools(args.xnat_server, args.xnat_user, args.xnat_password)
+    xtools = xnat_tools(args.xnat_server, args.xnat_user, args.xnat_password, request_timeout=args.xnat_request_timeout)
     log.info(f'Initializing Database')
     dbtools = db_tools(args.db_connect_string)
 
@@ -42,9 +42,20 @@ def run_preprocessing(args, log):
     # normalization functions
     if "normalization_functions" in args.preprocess_functions:
         run_normalization_functions(args, log, xtools, dbtools)
+
+    # export functions
+    if "export_functions" in args.preprocess_functions:
+        run_export_functions(args, log, xtools, dbtools)
     
     return None
 
+def run_daemon(args, log):
+    log.info('Running Daemon')
+    from modules.daemon_tools import daemon_tools
+    dtools = daemon_tools()
+    dtools.run_daemon(args, log)
+    return None
+
 def index_xnat(args, log, xtools, dbtools):
     log.info(f'Indexing')
     xtools.index_scans(args, log, dbtools)        
@@ -52,43 +63,38 @@ def index_xnat(args, log, xtools, dbtools):
 
 def run_quality_functions(args, log, xtools, dbtools):
     log.info('Running Quality Functions')
+    from modules.quality_tools import quality_tools
     qtools = quality_tools()
     qtools.run_quality_functions(args, log, xtools, dbtools)  
     return None
 
 def run_normalization_functions(args, log, xtools, dbtools):
     log.info('Running Normalization Functions')
+    from modules.normalization_tools import normalization_tools
     ntools = normalization_tools()
     ntools.run_normalization_functions(args, log, xtools, dbtools)
     return None
 
+def run_export_functions(args, log, xtools, dbtools):
+    log.info('Running Export Functions')
+    from modules.export_tools import export_tools
+    etools = export_tools()
+    etools.run_export_functions(args, log, xtools, dbtools)
+    return None
 
-def main(argv):
-
-    # --------------------------------------
-    # parse arguments
-    # --------------------------------------
-    
-    args = arg_helper(argv)
 
-    # if no arguments, use default values for dev testing
-    if len(argv) == 0:
-        set_args = {}
-        set_args['config_path'] = r"D:\data\XNAT\prod\config\xnat_remote.json"
-        #set_args['config_path'] = r"D:\data\XNAT\sandbox\config\xnat_sandbox.json"
-        args.setArgs(set_args)
-        
-    # --------------------------------------
-    # parse config file
-    # --------------------------------------
+def load_config(args):
 
     with open(args.config_path) as json_file:
         data = json.load(json_file)
 
         args.setArg("data_path", data['data_path'])
         args.setArg("db_path", os.path.join(args.data_path, "db.db"))
-        args.setArg("db_connect_string", f'sqlite+pysqlite:///{args.db_path}')
+        args.setArg("db_connect_string", data['db_connect_string'] if 'db_connect_string' in data else f'sqlite+pysqlite:///{args.db_path}')
         args.setArg("stage_path", os.path.join(args.data_path, "stage"))
+        args.setArg("archive_path", os.path.join(args.data_path, "archive"))
+        args.setArg("header_path", os.path.join(args.data_path, "headers"))
+        args.setArg("export_path", os.path.join(args.data_path, "export"))
         args.setArg("log_path", os.path.join(args.data_path, "logs"))
         args.setArg("log_level", data['log_level'])
 
@@ -96,18 +102,85 @@ def main(argv):
         args.setArg("xnat_user", data['xnat_user'])
         args.setArg("xnat_password", data['xnat_password'])
         args.setArg("xnat_projects", data['xnat_projects'])
-        args.setArg("xnat_subjects", data['xnat_subjects']) if 'xnat_subjects' in data else None
-        args.setArg("xnat_experiments", data['xnat_experiments']) if 'xnat_experiments' in data else None
-        args.setArg("xnat_scans", data['xnat_scans']) if 'xnat_scans' in data else None
+        args.setArg("xnat_subjects", data['xnat_subjects'] if 'xnat_subjects' in data else None)
+        args.setArg("xnat_experiments", data['xnat_experiments'] if 'xnat_experiments' in data else None)
+        args.setArg("xnat_scans", data['xnat_scans'] if 'xnat_scans' in data else None)
+        args.setArg("xnat_request_timeout", data['xnat_request_timeout'] if 'xnat_request_timeout' in data else 300)
 
         args.setArg("preprocess_functions", data['preprocess_functions'])
         args.setArg("index", data['index'])
         args.setArg("reset", data['reset'])
+        args.setArg("file_catalog", data['file_catalog'] if 'file_catalog' in data else True)
+        args.setArg("header_index", data['header_index'] if 'header_index' in data else True)
+        args.setArg("experiment_archive", data['experiment_archive'] if 'experiment_archive' in data else False)
+        args.setArg("experiment_archive_min_scans", data['experiment_archive_min_scans'] if 'experiment_archive_min_scans' in data else 2)
+
+        args.setArg("daemon", data['daemon'] if 'daemon' in data else False)
+        args.setArg("daemon_interval", data['daemon_interval'] if 'daemon_interval' in data else 300)
+        args.setArg("daemon_host", data['daemon_host'] if 'daemon_host' in data else '0.0.0.0')
+        args.setArg("daemon_port", data['daemon_port'] if 'daemon_port' in data else 9000)
 
         args.setArg("multi_proc", data['multi_proc'])
         args.setArg("multi_proc_cpu", data['multi_proc_cpu'])
+        args.setArg("multi_proc_start_method", data['multi_proc_start_method'] if 'multi_proc_start_method' in data else 'spawn')
         args.setArg("multi_thread", data['multi_thread'])
         args.setArg("multi_thread_workers", data['multi_thread_workers'])
+        args.setArg("adaptive_concurrency", data['adaptive_concurrency'] if 'adaptive_concurrency' in data else False)
+        args.setArg("adaptive_download_bounds", data['adaptive_download_bounds'] if 'adaptive_download_bounds' in data else [1, 16])
+        args.setArg("adaptive_worker_bounds", data['adaptive_worker_bounds'] if 'adaptive_worker_bounds' in data else [1, data['multi_proc_cpu']])
+        args.setArg("adaptive_interval", data['adaptive_interval'] if 'adaptive_interval' in data else 5)
+        args.setArg("piqe_processes", data['piqe_processes'] if 'piqe_processes' in data else 0)
+        args.setArg("quality_metrics", data['quality_metrics'] if 'quality_metrics' in data else {"default": ["piqe"]})
+        args.setArg("quality_downsample", data['quality_downsample'] if 'quality_downsample' in data else {})
+        args.setArg("piqe_tile_processes", data['piqe_tile_processes'] if 'piqe_tile_processes' in data else 0)
+        args.setArg("decoder_handlers", data['decoder_handlers'] if 'decoder_handlers' in data else {})
+        args.setArg("decode_processes", data['decode_processes'] if 'decode_processes' in data else 0)
+        args.setArg("stage_volumes", data['stage_volumes'] if 'stage_volumes' in data else False)
+        args.setArg("normalization_method", data['normalization_method'] if 'normalization_method' in data else 'zscore')
+        args.setArg("normalization_percentiles", data['normalization_percentiles'] if 'normalization_percentiles' in data else [0.5, 99.5])
+        args.setArg("normalization_ct_window", data['normalization_ct_window'] if 'normalization_ct_window' in data else None)
+        args.setArg("normalization_spacing", data['normalization_spacing'] if 'normalization_spacing' in data else None)
+        args.setArg("normalization_chunk_slices", data['normalization_chunk_slices'] if 'normalization_chunk_slices' in data else 32)
+        args.setArg("scan_timeouts", data['scan_timeouts'] if 'scan_timeouts' in data else {})
+        args.setArg("stage_timeouts", data['stage_timeouts'] if 'stage_timeouts' in data else {})
+        args.setArg("straggler_factor", data['straggler_factor'] if 'straggler_factor' in data else 0)
+        args.setArg("scan_retries", data['scan_retries'] if 'scan_retries' in data else 1)
+        args.setArg("speculative_execution", data['speculative_execution'] if 'speculative_execution' in data else False)
+        args.setArg("memory_budget_mb", data['memory_budget_mb'] if 'memory_budget_mb' in data else 0)
+        args.setArg("memory_worker_base_mb", data['memory_worker_base_mb'] if 'memory_worker_base_mb' in data else 200)
+        args.setArg("export_format", data['export_format'] if 'export_format' in data else 'parquet')
+        args.setArg("export_chunk_rows", data['export_chunk_rows'] if 'export_chunk_rows' in data else 100000)
+
+        args.setArg("profile", data['profile'] if 'profile' in data else False)
+        args.setArg("profile_mode", data['profile_mode'] if 'profile_mode' in data else 'cprofile')
+        args.setArg("profile_sample_rate", data['profile_sample_rate'] if 'profile_sample_rate' in data else 0.1)
+        args.setArg("profile_interval", data['profile_interval'] if 'profile_interval' in data else 0.005)
+        args.setArg("profile_merge", data['profile_merge'] if 'profile_merge' in data else True)
+        args.setArg("profile_memory", data['profile_memory'] if 'profile_memory' in data else False)
+
+    return None
+
+
+def main(argv):
+
+    # --------------------------------------
+    # parse arguments
+    # --------------------------------------
+    
+    args = arg_helper(argv)
+
+    # if no arguments, use default values for dev testing
+    if len(argv) == 0:
+        set_args = {}
+        set_args['config_path'] = r"D:\data\XNAT\prod\config\xnat_remote.json"
+        #set_args['config_path'] = r"D:\data\XNAT\sandbox\config\xnat_sandbox.json"
+        args.setArgs(set_args)
+        
+    # --------------------------------------
+    # parse config file
+    # --------------------------------------
+
+    load_config(args)
 
     # --------------------------------------
     # initialize logging
@@ -119,7 +192,11 @@ def main(argv):
 
     log.info(f'Executing {prog_name}')
 
-    run_preprocessing(args, log)
+    # daemon runs until stopped, polling XNAT for new and changed experiments
+    if args.daemon == True:
+        run_daemon(args, log)
+    else:
+        run_preprocessing(args, log)
 
     #------------------------------------------
     # calculate duration
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# ----------------------------
+# test configuration
+# ----------------------------
+# tests import the modules as run.py does (from the repository root)
+# ----------------------------
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def series_path(tmp_path):
+    return str(tmp_path / 'series')
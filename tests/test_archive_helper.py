@@ -0,0 +1,143 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from modules.archive_helper import unpack_zip_stream, ARCHIVE_ENTRY
+
+# ----------------------------
+# helpers
+# ----------------------------
+
+class unseekable_stream(io.RawIOBase):
+
+    # like a server writing the zip on the fly: zipfile adds a data descriptor to every entry
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+def create_archive(entries, seekable=False, force_zip64=False):
+
+    stream = io.BytesIO() if seekable else unseekable_stream()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        for name, content, compress_type in entries:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = compress_type
+            with archive.open(info, 'w', force_zip64=force_zip64) as target:
+                target.write(content)
+
+    return bytes(stream.getvalue() if seekable else stream.data)
+
+def get_chunks(data, chunk_size):
+    return [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+# targets of the DICOM entries of the XNAT scan paths (<experiment>/scans/<id>-<type>/resources/DICOM/files/<name>)
+def unpack(tmp_path, data, chunk_size=1000):
+
+    names = []
+
+    def get_target(name):
+        match = ARCHIVE_ENTRY.search(name)
+        if match is None or match.group(2) != 'DICOM':
+            return None
+        names.append(name)
+        return os.path.join(tmp_path, f'{len(names):06d}')
+
+    entries, size = unpack_zip_stream(get_chunks(data, chunk_size), get_target, spool_path=str(tmp_path))
+    files = {name: open(os.path.join(tmp_path, f'{index + 1:06d}'), 'rb').read() for index, name in enumerate(names)}
+
+    return entries, size, files
+
+def xnat_entries(compress_types):
+
+    entries = []
+    for index, compress_type in enumerate(compress_types):
+        content = os.urandom(500) + bytes(3000 + 700 * index)
+        entries.append((f'E1/scans/{index + 1}-T1/resources/DICOM/files/{index:05d}.dcm', content, compress_type))
+    entries.append(('E1/scans/1-T1/resources/SNAPSHOTS/files/1_t.gif', b'gif', zipfile.ZIP_DEFLATED))
+
+    return entries
+
+def assert_unpacked(entries, unpacked):
+
+    dicom = {name: content for name, content, _ in entries if '/DICOM/' in name}
+    count, size, files = unpacked
+
+    assert count == len(dicom)
+    assert size == sum(len(content) for content in dicom.values())
+    assert files == dicom
+
+# ----------------------------
+# streamed entries
+# ----------------------------
+
+@pytest.mark.parametrize('chunk_size', [7, 1000, 1 << 20])
+def test_unpack_xnat_archive(tmp_path, chunk_size):
+
+    entries = xnat_entries([zipfile.ZIP_DEFLATED] * 4)
+    assert_unpacked(entries, unpack(tmp_path, create_archive(entries), chunk_size))
+
+def test_unpack_zip64_archive(tmp_path):
+
+    entries = xnat_entries([zipfile.ZIP_DEFLATED] * 3)
+    assert_unpacked(entries, unpack(tmp_path, create_archive(entries, force_zip64=True)))
+
+def test_unpack_stored_entries_with_sizes(tmp_path):
+
+    entries = xnat_entries([zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+    assert_unpacked(entries, unpack(tmp_path, create_archive(entries, seekable=True)))
+
+# ----------------------------
+# entries read with zipfile
+# ----------------------------
+
+def test_unpack_stored_entry_with_descriptor(tmp_path):
+
+    # deflated entries streamed, then the rest of the archive from the stored entry read with zipfile
+    entries = xnat_entries([zipfile.ZIP_DEFLATED, zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+    assert_unpacked(entries, unpack(tmp_path, create_archive(entries)))
+
+def test_unpack_zip64_stored_entry_with_descriptor(tmp_path):
+
+    entries = xnat_entries([zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED, zipfile.ZIP_STORED])
+    assert_unpacked(entries, unpack(tmp_path, create_archive(entries, force_zip64=True), chunk_size=333))
+
+def test_unpack_other_compression(tmp_path):
+
+    entries = xnat_entries([zipfile.ZIP_BZIP2, zipfile.ZIP_DEFLATED])
+    assert_unpacked(entries, unpack(tmp_path, create_archive(entries)))
+
+# ----------------------------
+# damaged archives
+# ----------------------------
+
+def test_crc_mismatch(tmp_path):
+
+    entries = [('E1/scans/1-T1/resources/DICOM/files/1.dcm', bytes(5000), zipfile.ZIP_STORED)]
+    data = bytearray(create_archive(entries, seekable=True))
+    data[100] ^= 0xFF
+
+    with pytest.raises(ValueError, match='CRC mismatch'):
+        unpack(tmp_path, bytes(data))
+
+@pytest.mark.parametrize('within_entry', [True, False])
+def test_truncated_archive(tmp_path, within_entry):
+
+    # within an entry, or after the last entry (before the central directory)
+    entries = xnat_entries([zipfile.ZIP_DEFLATED, zipfile.ZIP_DEFLATED])
+    data = create_archive(entries)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        end = 300 if within_entry else archive.start_dir
+
+    with pytest.raises(EOFError):
+        unpack(tmp_path, data[:end])
+
+def test_empty_archive(tmp_path):
+    assert unpack(tmp_path, create_archive([])) == (0, 0, {})
@@ -0,0 +1,126 @@
+import socket
+
+from modules.concurrency_helper import aimd_controller, is_timeout, DECREASE_FACTOR, MIN_WINDOW_REQUESTS
+
+# ----------------------------
+# helpers (interval 0, so every adjust closes a window)
+# ----------------------------
+
+def create_controller(bounds=(1, 10), initial=4):
+    return aimd_controller('test', bounds, initial, interval=0)
+
+# ----------------------------
+# additive increase
+# ----------------------------
+
+def test_increase_when_work_waits_and_slots_are_full():
+
+    controller = create_controller()
+
+    assert controller.adjust(queue_depth=3, in_use=4) == 5
+    assert controller.changes[-1][1:] == [4, 5, 'queue depth 3']
+
+def test_no_increase_without_waiting_work_or_free_slots():
+
+    controller = create_controller()
+
+    assert controller.adjust(queue_depth=0, in_use=4) == 4
+    assert controller.adjust(queue_depth=3, in_use=2) == 4
+    assert controller.changes == []
+
+def test_increase_stops_at_upper_bound():
+
+    controller = create_controller(bounds=(1, 5), initial=5)
+
+    assert controller.adjust(queue_depth=1, in_use=5) == 5
+
+# ----------------------------
+# multiplicative decrease
+# ----------------------------
+
+def test_decrease_on_error_rate():
+
+    controller = create_controller(initial=10)
+    controller.observe(MIN_WINDOW_REQUESTS * 2, seconds=1.0, errors=2, timeouts=1)
+
+    assert controller.adjust(queue_depth=5, in_use=10) == int(10 * DECREASE_FACTOR)
+    assert controller.changes[-1][3].startswith('error rate 20%')
+
+def test_decrease_on_latency_once_per_step():
+
+    controller = create_controller(initial=10)
+
+    # best window 0.1 s per request
+    controller.observe(10, seconds=1.0)
+    assert controller.adjust() == 10
+
+    # latency step to 0.5 s: one decrease, then the new latency is the reference
+    controller.observe(10, seconds=5.0)
+    assert controller.adjust() == 7
+    controller.observe(10, seconds=5.0)
+    assert controller.adjust() == 7
+
+def test_few_requests_leave_latency_and_errors_out():
+
+    controller = create_controller()
+    controller.observe(MIN_WINDOW_REQUESTS - 1, seconds=100.0, errors=MIN_WINDOW_REQUESTS - 1)
+
+    assert controller.adjust() == 4
+
+def test_decrease_stops_at_lower_bound():
+
+    controller = create_controller(bounds=(2, 10), initial=2)
+    controller.observe(10, errors=10)
+
+    assert controller.adjust() == 2
+
+def test_window_is_reset_after_adjust():
+
+    controller = create_controller()
+    controller.observe(10, errors=10)
+    controller.adjust()
+
+    assert controller.window['requests'] == 0
+    assert controller.window['errors'] == 0
+
+def test_adjust_waits_for_interval():
+
+    controller = aimd_controller('test', (1, 10), 4, interval=3600)
+
+    assert controller.adjust(queue_depth=3, in_use=4) == 4
+    assert controller.window['queue_depth'] == 3
+
+# ----------------------------
+# scan worker pool (no acquire)
+# ----------------------------
+
+def test_observe_scan_downloads_and_failures():
+
+    controller = create_controller()
+    controller.observe_scan({'downloads': {'requests': 20, 'seconds': 2.0, 'errors': 1, 'timeouts': 1}})
+    controller.observe_scan()
+
+    assert controller.window['requests'] == 21
+    assert controller.window['seconds'] == 2.0
+    assert controller.window['errors'] == 2
+    assert controller.window['timeouts'] == 1
+
+def test_slots_left_below_limit():
+
+    controller = create_controller(initial=4)
+
+    assert controller.get_slots(1) == 3
+    assert controller.get_slots(6) == 0
+
+# ----------------------------
+# timeouts
+# ----------------------------
+
+def test_is_timeout():
+
+    class ReadTimeout(Exception):
+        pass
+
+    assert is_timeout(socket.timeout())
+    assert is_timeout(ReadTimeout())
+    assert not is_timeout(ValueError())
@@ -0,0 +1,114 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from modules.daemon_tools import daemon_tools, get_job_request
+
+# ----------------------------
+# job request
+# ----------------------------
+
+def test_job_request_keys():
+
+    request = get_job_request({'project': 'P1', 'experiment': 'E1', 'scans': ['1', 2], 'stages': ['quality_functions'], 'reset': True})
+
+    assert request == {'project': 'P1', 'subject': None, 'experiment': 'E1', 'scans': ['1', '2'], 'stages': ['quality_functions'], 'reset': True}
+
+def test_job_request_from_event_payload():
+
+    request = get_job_request({'event': 'scan created', 'payload': {'projectId': 'P1', 'sessionId': 'E1', 'scans': [{'ID': '3'}, {'id': 4}]}})
+
+    assert (request['project'], request['experiment'], request['scans']) == ('P1', 'E1', ['3', '4'])
+    assert request['stages'] is None
+    assert request['reset'] is False
+
+def test_job_request_from_event_uri():
+
+    request = get_job_request({'eventData': {'uri': '/data/projects/P1/subjects/S1/experiments/E1/scans/5'}})
+
+    assert (request['project'], request['subject'], request['experiment'], request['scans']) == ('P1', 'S1', 'E1', ['5'])
+
+def test_job_request_keys_take_precedence_over_uri():
+
+    request = get_job_request({'experiment': 'E2', 'uri': '/data/experiments/E1'})
+
+    assert request['experiment'] == 'E2'
+
+@pytest.mark.parametrize('body, error', [
+    (['E1'], 'must be a JSON object'),
+    ({'project': 'P1'}, 'needs an experiment or a subject'),
+    ({'experiment': ''}, 'needs an experiment or a subject'),
+    ({'experiment': 'E1', 'stages': 'quality_functions'}, 'stages must be a list'),
+    ({'experiment': 'E1', 'stages': ['export_functions']}, 'stages must be a list'),
+])
+def test_job_request_errors(body, error):
+
+    with pytest.raises(ValueError, match=error):
+        get_job_request(body)
+
+# ----------------------------
+# job endpoint
+# ----------------------------
+
+class daemon_args(object):
+    daemon_host = '127.0.0.1'
+    daemon_port = 0
+
+class quiet_log(object):
+    def info(self, message):
+        return None
+
+@pytest.fixture
+def daemon_url():
+
+    daemon = daemon_tools()
+    server = daemon.start_status_server(daemon_args(), quiet_log())
+    yield f'http://127.0.0.1:{server.server_port}', daemon
+    server.shutdown()
+    server.server_close()
+
+def post(url, data):
+
+    request = urllib.request.Request(f'{url}/jobs', data=data, method='POST', headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def test_post_job(daemon_url):
+
+    url, daemon = daemon_url
+    status, body = post(url, json.dumps({'experiment': 'E1'}).encode('utf-8'))
+
+    assert status == 202
+    assert body['state'] == 'submitted'
+    assert daemon.wakeup.is_set()
+
+    with urllib.request.urlopen(f'{url}{body["url"]}') as response:
+        assert json.load(response)['request']['experiment'] == 'E1'
+
+@pytest.mark.parametrize('data, error', [
+    (b'{"experiment": ', 'Expecting value'),
+    (b'[]', 'must be a JSON object'),
+    (b'{}', 'needs an experiment or a subject'),
+    (b'{"experiment": "E1", "stages": ["unknown"]}', 'stages must be a list'),
+])
+def test_post_job_bad_request(daemon_url, data, error):
+
+    url, daemon = daemon_url
+    status, body = post(url, data)
+
+    assert status == 400
+    assert error in body['error']
+    assert daemon.queue.get_jobs() == []
+
+def test_unknown_job(daemon_url):
+
+    url, daemon = daemon_url
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(f'{url}/jobs/unknown')
+
+    assert e.value.code == 404
@@ -0,0 +1,82 @@
+import pytest
+
+from models.db import XnatScan, COPY_MIN_ROWS
+from modules.db_tools import db_tools
+
+# ----------------------------
+# db tools (SQLite; tests/test_db_postgres.py covers PostgreSQL)
+# ----------------------------
+
+@pytest.fixture
+def dbtools(tmp_path):
+
+    dbtools = db_tools(f'sqlite:///{tmp_path}/test.db')
+    try:
+        yield dbtools
+    finally:
+        dbtools.db_session.close()
+
+def create_scan(index, project_id='P1', subject_id='S1', file_count=None):
+    return XnatScan(project_id=project_id, subject_id=subject_id, experiment_id=f'E{index}', scan_id=str(index),
+                    scan_modality='CT', scan_file_count=file_count)
+
+# ----------------------------
+# inserts
+# ----------------------------
+
+def test_insert_list_objects_are_persistent(dbtools):
+
+    for count in [3, COPY_MIN_ROWS + 20]:
+        scans = [create_scan(index) for index in range(count)]
+        dbtools.insert_list(scans)
+
+        assert all(scan.xnat_scan_id is not None and scan in dbtools.db_session for scan in scans)
+        assert dbtools.db_session.get(XnatScan, scans[-1].xnat_scan_id) is scans[-1]
+
+    assert dbtools.db_session.query(XnatScan).count() == COPY_MIN_ROWS + 23
+
+# ----------------------------
+# file catalog
+# ----------------------------
+
+def test_file_list_of_scan_and_resource(dbtools):
+
+    dbtools.insert_list([create_scan(1), create_scan(2)])
+    scans = dbtools.db_session.query(XnatScan).order_by(XnatScan.xnat_scan_id).all()
+    dbtools.insert_dicts('xnat_file', [
+        {'xnat_scan_id': scans[0].xnat_scan_id, 'resource_label': 'DICOM', 'file_name': 'b.dcm'},
+        {'xnat_scan_id': scans[0].xnat_scan_id, 'resource_label': 'DICOM', 'file_name': 'a.dcm'},
+        {'xnat_scan_id': scans[0].xnat_scan_id, 'resource_label': "QC' or '1'='1", 'file_name': 'qc.json'},
+        {'xnat_scan_id': scans[1].xnat_scan_id, 'resource_label': 'DICOM', 'file_name': 'c.dcm'},
+    ])
+
+    assert [item.file_name for item in dbtools.get_db_file_list(scans[0].xnat_scan_id)] == ['a.dcm', 'b.dcm']
+    # values are bound parameters, not part of the SQL text
+    assert [item.file_name for item in dbtools.get_db_file_list(scans[0].xnat_scan_id, resource="QC' or '1'='1")] == ['qc.json']
+    assert dbtools.get_db_file_list(scans[1].xnat_scan_id, resource='QC') == []
+
+def test_uncataloged_scans(dbtools):
+
+    dbtools.insert_list([create_scan(1), create_scan(2, file_count=0), create_scan(3, file_count=4), create_scan(4, project_id="P'2")])
+    cataloged = dbtools.db_session.query(XnatScan).filter(XnatScan.scan_id == '3').one()
+    dbtools.insert_dicts('xnat_file', [{'xnat_scan_id': cataloged.xnat_scan_id, 'resource_label': 'DICOM', 'file_name': 'a.dcm'}])
+
+    # scans known to have no files are skipped
+    assert [scan.scan_id for scan in dbtools.get_db_uncataloged_scan_list(df=False, project='P1')] == ['1']
+    assert list(dbtools.get_db_uncataloged_scan_list(df=True, project="P'2")['scan_id']) == ['4']
+    assert sorted(scan.scan_id for scan in dbtools.get_db_uncataloged_scan_list(df=False)) == ['1', '4']
+
+# ----------------------------
+# scan selection
+# ----------------------------
+
+def test_scan_keys_of_projects(dbtools):
+
+    dbtools.insert_list([create_scan(1), create_scan(2, subject_id='S2'), create_scan(3, project_id='P2')])
+
+    assert [key.scan_id for key in dbtools.get_db_scan_keys(['P1'])] == ['1', '2']
+    assert [key.scan_id for key in dbtools.get_db_scan_keys(['P1', 'P2'], subjects=['S1'])] == ['1', '3']
+    assert [key.scan_id for key in dbtools.get_db_scan_keys()] == ['1', '2', '3']
+    # an empty project list (xnat_projects: []) selects nothing, as the per-project loop did
+    assert dbtools.get_db_scan_keys([]) == []
+    assert dbtools.get_db_scan_keys([], subjects=['S1']) == []
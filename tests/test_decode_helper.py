@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, DeflatedExplicitVRLittleEndian
+
+from modules import decode_helper
+from modules.decode_helper import decode_pixels, get_handler, load_handler_cache, save_handler_cache
+
+# ----------------------------
+# helpers
+# ----------------------------
+
+def create_args(tmp_path, decode_processes=0):
+    return {'decoder_handlers': {}, 'decode_processes': decode_processes, 'data_path': str(tmp_path)}
+
+def create_dataset(pixels, transfer_syntax=RLELossless):
+
+    frames, rows, columns = pixels.shape[:3]
+    color = pixels.ndim == 4
+
+    dataset = Dataset()
+    dataset.file_meta = FileMetaDataset()
+    dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.Rows, dataset.Columns = rows, columns
+    dataset.NumberOfFrames = frames
+    dataset.SamplesPerPixel = 3 if color else 1
+    dataset.PhotometricInterpretation = 'RGB' if color else 'MONOCHROME2'
+    if color:
+        dataset.PlanarConfiguration = 0
+    dataset.BitsAllocated = dataset.BitsStored = 8
+    dataset.HighBit = 7
+    dataset.PixelRepresentation = 0
+    dataset.PixelData = pixels.tobytes()
+    if transfer_syntax != ExplicitVRLittleEndian:
+        dataset.compress(transfer_syntax)
+
+    return dataset
+
+# ----------------------------
+# parallel frame decoding
+# ----------------------------
+
+@pytest.mark.parametrize('color', [False, True])
+def test_parallel_frames_match_pixel_array(tmp_path, color):
+
+    shape = (5, 6, 7, 3) if color else (5, 6, 7)
+    pixels = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+
+    # one process decodes the frames (RGB ultrasound cine, for example, has a samples axis)
+    decoded = decode_pixels(create_dataset(pixels), create_args(tmp_path, decode_processes=1))
+
+    assert decoded.shape == shape
+    assert np.array_equal(decoded, pixels)
+    assert np.array_equal(decoded, create_dataset(pixels).pixel_array)
+
+# ----------------------------
+# handler cache (a file per transfer syntax)
+# ----------------------------
+
+def test_handler_cache_per_transfer_syntax(tmp_path):
+
+    args = create_args(tmp_path)
+    # workers timing different transfer syntaxes
+    save_handler_cache(args, RLELossless, {'handler': 'rle', 'timings': {'rle': 0.1, 'gdcm': 0.2}})
+    save_handler_cache(args, ExplicitVRLittleEndian, {'handler': 'numpy', 'timings': {'numpy': None}})
+
+    assert load_handler_cache(args, RLELossless)['handler'] == 'rle'
+    assert load_handler_cache(args, ExplicitVRLittleEndian)['handler'] == 'numpy'
+    assert load_handler_cache(args, DeflatedExplicitVRLittleEndian) is None
+
+def test_cached_handler_is_not_timed_again(tmp_path, monkeypatch):
+
+    args = create_args(tmp_path)
+    dataset = create_dataset(np.zeros((1, 2, 2), dtype=np.uint8), transfer_syntax=ExplicitVRLittleEndian)
+    dataset.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+
+    # timed by another worker
+    save_handler_cache(args, DeflatedExplicitVRLittleEndian, {'handler': 'numpy', 'timings': {'numpy': None}})
+
+    def benchmark_handlers(dataset):
+        raise AssertionError('timed again')
+
+    monkeypatch.setattr(decode_helper, 'benchmark_handlers', benchmark_handlers)
+
+    assert get_handler(dataset, args) == 'numpy'
+    assert get_handler(dataset, {**args, 'decoder_handlers': {'deflated': 'gdcm'}}) == 'gdcm'
@@ -0,0 +1,101 @@
+import logging
+
+import pytest
+from pydicom.dataset import Dataset
+
+from models.dicom_header import DicomHeader, FILTER_TERMS, get_sort_field
+from modules.quality_tools import quality_tools
+
+# ----------------------------
+# helpers
+# ----------------------------
+
+def create_header(**tags):
+
+    dataset = Dataset()
+    for tag, value in tags.items():
+        setattr(dataset, tag, value)
+
+    return DicomHeader(None, dataset, ['KVP'])
+
+# ----------------------------
+# sort key
+# ----------------------------
+
+def test_sort_values_have_one_type_per_field():
+
+    header = create_header(InstanceNumber='7', ImagePositionPatient=['1', '2', '3.5'], SliceLocation='3.5',
+                           AcquisitionTime='120000', SOPInstanceUID='1.2.3')
+
+    assert header.get_sort_key('InstanceNumber') == 7
+    assert header.get_sort_key('ImagePositionPatient') == (1.0, 2.0, 3.5)
+    assert header.get_sort_key('SliceLocation') == 3.5
+    assert header.get_sort_key('AcquisitionTime') == '120000'
+    assert header.get_sort_key('SOPInstanceUID') == '1.2.3'
+
+def test_missing_or_empty_sort_value():
+
+    header = create_header(InstanceNumber='', SOPInstanceUID='1.2.3')
+
+    assert header.get_sort_key('InstanceNumber') is None
+    assert header.get_sort_key('SliceLocation') is None
+
+def test_sort_field_is_first_field_on_every_instance():
+
+    headers = [create_header(InstanceNumber='2', SliceLocation='1', SOPInstanceUID='1.2'),
+               create_header(SliceLocation='0', SOPInstanceUID='1.1'),
+               create_header(InstanceNumber='1', SliceLocation='2', SOPInstanceUID='1.3')]
+
+    assert get_sort_field(headers) == 'SliceLocation'
+    assert get_sort_field(headers[::2]) == 'InstanceNumber'
+    assert get_sort_field(headers + [create_header()]) is None
+
+def test_serialized_header_keeps_sort_keys():
+
+    header = create_header(InstanceNumber='3', ImagePositionPatient=['0', '0', '1'], ImageType=['ORIGINAL', 'PRIMARY'])
+    restored = DicomHeader.from_dict(header.to_dict(), 'file')
+
+    assert restored.scan_file == 'file'
+    assert restored.get_sort_key('ImagePositionPatient') == (0.0, 0.0, 1.0)
+    assert restored.get_sort_key('InstanceNumber') == 3
+    assert restored.image_type == ('ORIGINAL', 'PRIMARY')
+
+# ----------------------------
+# filter reason
+# ----------------------------
+
+@pytest.mark.parametrize('tags, reason', [
+    ({'ImageType': ['ORIGINAL', 'PRIMARY', 'LOCALIZER']}, 'ImageType'),
+    ({'SeriesDescription': 'Scout 3 plane'}, 'SeriesDescription'),
+    ({'ProtocolName': 'DWI_b0'}, 'ProtocolName'),
+    ({'SequenceName': 'ep_b0'}, 'SequenceName'),
+    ({'ImageType': ['ORIGINAL', 'PRIMARY', 'AXIAL'], 'SeriesDescription': 'Thorax'}, None),
+])
+def test_filter_reason(tags, reason):
+    assert create_header(**tags).get_filter_reason(FILTER_TERMS) == reason
+
+# ----------------------------
+# sort and filter of a scan
+# ----------------------------
+
+def test_filter_sorts_mixed_instances_on_common_field():
+
+    # InstanceNumber is missing on one instance, so the scan is sorted on SliceLocation for all of them
+    headers = [create_header(InstanceNumber=str(10 - index), SliceLocation=str(index), SeriesDescription='Axial')
+               for index in range(6)]
+    headers.append(create_header(SliceLocation='-1', SeriesDescription='Axial'))
+
+    filtered = quality_tools().filter_dicom_files(logging.getLogger('test'), list(headers))
+
+    assert [header.get_sort_key('SliceLocation') for header in filtered] == [2.0, 3.0, 4.0, 5.0]
+
+def test_filter_skips_scan_without_common_sort_field(caplog):
+
+    headers = [create_header(InstanceNumber='1'), create_header(SliceLocation='1')]
+
+    with caplog.at_level(logging.WARNING):
+        filtered = quality_tools().filter_dicom_files(logging.getLogger('test'), headers)
+
+    assert filtered == []
+    assert 'No sort field' in caplog.text
+    assert 'most likely no SOPInstanceUID' not in caplog.text
@@ -0,0 +1,142 @@
+import pytest
+from types import SimpleNamespace
+
+from models.scan_key import ScanKey
+from modules.memory_helper import memory_helper, MB, FEEDBACK_WEIGHT
+
+# ----------------------------
+# helpers
+# ----------------------------
+
+def create_helper(budget_mb=1000, workers=4):
+    args = {'memory_budget_mb': budget_mb, 'memory_worker_base_mb': 100, 'multi_thread': False}
+    return memory_helper(args, workers)
+
+def create_scan(modality='CT', file_count=100, file_size=100 * 512 * 512 * 2, rows=None, columns=None, frames=None, xnat_scan_id=1):
+    return ScanKey(xnat_scan_id, 'P1', 'S1', 'E1', str(xnat_scan_id), modality, file_count, file_size, rows, columns, frames)
+
+# waiting queue items, one per file count (the estimate grows with it)
+def create_items(*file_counts):
+    return [SimpleNamespace(scan=create_scan(file_count=file_count, file_size=file_count * 1000, xnat_scan_id=index))
+            for index, file_count in enumerate(file_counts)]
+
+# ----------------------------
+# admission
+# ----------------------------
+
+def test_admit_within_budget():
+
+    helper = create_helper(budget_mb=1000)
+
+    assert helper.admit('a', 400 * MB)
+    assert helper.admit('b', 500 * MB)
+    assert not helper.admit('c', 200 * MB)
+    assert helper.used == 900 * MB
+
+    assert helper.release('a') == 400 * MB
+    assert helper.admit('c', 200 * MB)
+
+def test_admit_scan_larger_than_budget_into_idle_pool():
+
+    helper = create_helper(budget_mb=100)
+
+    assert helper.admit('a', 1000 * MB)
+    assert not helper.admit('b', 1 * MB)
+    helper.release('a')
+    assert helper.admit('b', 1 * MB)
+
+def test_admit_limited_by_workers():
+
+    helper = create_helper(budget_mb=1000, workers=2)
+
+    assert helper.admit('a', MB)
+    assert helper.admit('b', MB)
+    assert not helper.admit('c', MB)
+
+def test_disabled_without_budget():
+    assert not create_helper(budget_mb=0).enabled
+
+def test_admit_items_first_fit():
+
+    helper = create_helper(budget_mb=1000)
+    large, small = create_items(200000, 10)
+    helper.admit('running', 500 * MB)
+
+    # the large scan does not fit next to the running one, the small one does
+    assert [item for item, _ in helper.admit_items([large, small], slots=3)] == [small]
+    assert helper.reserved[small.scan.xnat_scan_id] == helper.estimate(small.scan)
+    assert helper.head_skips == 1
+
+def test_admit_items_limited_by_slots():
+
+    helper = create_helper(budget_mb=1000)
+    items = create_items(10, 10, 10)
+
+    assert [item for item, _ in helper.admit_items(items, slots=2)] == items[:2]
+    assert helper.head_skips == 0
+
+def test_admit_items_stop_passing_the_first_scan():
+
+    helper = create_helper(budget_mb=1000, workers=2)
+    helper.admit('running', 500 * MB)
+    large, *smalls = create_items(200000, 10, 10, 10)
+
+    # passed over by as many scans as there are workers, then nothing until it fits
+    for small in smalls[:2]:
+        assert [item for item, _ in helper.admit_items([large, small], slots=1)] == [small]
+        helper.release(small.scan.xnat_scan_id)
+    assert helper.admit_items([large, smalls[2]], slots=1) == []
+
+    helper.release('running')
+    assert [item for item, _ in helper.admit_items([large], slots=1)] == [large]
+    assert helper.head_skips == 0
+
+def test_admit_items_without_budget():
+
+    helper = create_helper(budget_mb=0)
+    items = create_items(200000, 200000)
+
+    assert helper.admit_items(items, slots=5) == [(items[0], 0), (items[1], 0)]
+    assert helper.reserved == {}
+
+# ----------------------------
+# estimate
+# ----------------------------
+
+def test_estimate_uses_header_dimensions():
+
+    helper = create_helper()
+    small = helper.estimate(create_scan(rows=256, columns=256, frames=1))
+    large = helper.estimate(create_scan(rows=1024, columns=1024, frames=1))
+
+    assert small < large
+    assert small > helper.worker_base
+
+# ----------------------------
+# feedback
+# ----------------------------
+
+def test_observe_moves_correction_towards_measurement():
+
+    helper = create_helper()
+    scan = create_scan()
+    estimate = helper.estimate(scan)
+
+    # measured at twice the estimate
+    helper.observe(scan, estimate, 2 * estimate / MB)
+    assert helper.corrections['CT'] == pytest.approx(1 - FEEDBACK_WEIGHT + FEEDBACK_WEIGHT * 2)
+    assert helper.estimate(scan) == pytest.approx(estimate * helper.corrections['CT'], rel=1e-6)
+
+    # the ratio is taken against the uncorrected estimate, so repeated measurements converge on it
+    for _ in range(30):
+        helper.observe(scan, helper.estimate(scan), 2 * estimate / MB)
+    assert helper.corrections['CT'] == pytest.approx(2.0, rel=1e-3)
+    assert 'MR' not in helper.corrections
+
+def test_observe_ignores_missing_measurement():
+
+    helper = create_helper()
+    helper.observe(create_scan(), 100 * MB, None)
+    helper.observe(create_scan(), 0, 100)
+
+    assert helper.corrections == {}
@@ -0,0 +1,112 @@
+import logging
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+
+from models.dicom_header import DicomHeader
+from modules.normalization_tools import normalization_tools, HISTOGRAM_BINS, NORMALIZATION_METHODS
+from modules.stage_tools import stage_tools
+
+# ----------------------------
+# percentile
+# ----------------------------
+
+def test_histogram_percentile_matches_numpy():
+
+    values = np.random.default_rng(0).normal(100, 25, 200000)
+    value_min, value_max = values.min(), values.max()
+    histogram = np.histogram(values, bins=HISTOGRAM_BINS, range=(value_min, value_max))[0]
+
+    tools = normalization_tools()
+    bin_width = (value_max - value_min) / HISTOGRAM_BINS
+    for percentile in [0.5, 1, 50, 99, 99.5]:
+        assert tools.get_histogram_percentile(histogram, value_min, value_max, percentile) == pytest.approx(np.percentile(values, percentile), abs=2 * bin_width)
+
+def test_histogram_percentile_bounds():
+
+    # the first and last bins hold value_min and value_max
+    histogram = np.array([10, 0, 0, 10])
+    tools = normalization_tools()
+
+    assert tools.get_histogram_percentile(histogram, 0.0, 4.0, 0) == pytest.approx(0.0)
+    assert tools.get_histogram_percentile(histogram, 0.0, 4.0, 25) == pytest.approx(0.5)
+    assert tools.get_histogram_percentile(histogram, 0.0, 4.0, 50) == pytest.approx(1.0)
+    assert tools.get_histogram_percentile(histogram, 0.0, 4.0, 100) == pytest.approx(4.0)
+
+# ----------------------------
+# moments (Chan et al.)
+# ----------------------------
+
+def test_combined_moments_match_whole_array():
+
+    rng = np.random.default_rng(1)
+    slabs = [rng.normal(offset, scale, (size, 8, 8)).astype(np.float32) for offset, scale, size in [(0, 1, 3), (50, 5, 1), (-20, 10, 7)]]
+
+    tools = normalization_tools()
+    mean, std = tools.combine_moments([tools.get_slab_moments(slab) for slab in slabs])
+
+    values = np.concatenate([slab.ravel() for slab in slabs]).astype(np.float64)
+    assert mean == pytest.approx(values.mean(), rel=1e-6)
+    assert std == pytest.approx(values.std(), rel=1e-6)
+
+def test_combined_moments_empty():
+    assert normalization_tools().combine_moments([]) == (0.0, 0.0)
+
+# ----------------------------
+# method
+# ----------------------------
+
+def test_unknown_method_is_rejected():
+
+    tools = normalization_tools()
+    for method in NORMALIZATION_METHODS:
+        tools.check_normalization_method({'normalization_method': method})
+
+    # before the volume is read
+    with pytest.raises(ValueError, match='z-score'):
+        tools.normalize_volume({'normalization_method': 'z-score'}, logging.getLogger(), None)
+
+# ----------------------------
+# staging
+# ----------------------------
+
+def create_header(index, pixel_representation):
+
+    dataset = Dataset()
+    dataset.SOPInstanceUID = f'1.2.{index}'
+    dataset.InstanceNumber = index
+    dataset.Rows, dataset.Columns = 4, 4
+    dataset.BitsAllocated = 16
+    dataset.PixelRepresentation = pixel_representation
+
+    return DicomHeader(f'file{index}', dataset, [])
+
+def test_stage_volume_holds_mixed_pixel_types(tmp_path):
+
+    # unsigned instance first, signed one after it: both fit an int32 volume
+    pixels = {'file0': np.full((4, 4), 65000, dtype=np.uint16), 'file1': np.full((4, 4), -1000, dtype=np.int16)}
+    headers = [create_header(0, 0), create_header(1, 1)]
+
+    def read_dicom(scan_file, exclude_pixels):
+        dataset = Dataset()
+        dataset.RescaleSlope, dataset.RescaleIntercept = 1, 0
+        return None, dataset
+
+    class scan(object):
+        project_id, subject_id, experiment_id, scan_id = 'P1', 'S1', 'E1', '1'
+
+    tools = stage_tools()
+    tools.read_instance = lambda args, header, read_dicom: (pixels[header.scan_file], {
+        'position': None, 'orientation': None, 'pixel_spacing': None, 'slice_thickness': None, 'rescale_slope': 1.0, 'rescale_intercept': 0.0})
+
+    args = {'stage_path': str(tmp_path), 'multi_thread': False}
+    volume = tools.stage_volume(args, logging.getLogger('test'), scan, headers, read_dicom)
+
+    assert volume.array.dtype == np.int32
+    assert volume.metadata['dtype'] == 'int32'
+    assert volume.array[0, 0, 0] == 65000
+    assert volume.array[1, 0, 0] == -1000
+
+    tools.remove_volume(volume)
+    assert tools.load_volume(args, scan) is None
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from pypiqe import piqe
+
+from modules.piqe_tile_helper import piqe_tiled
+
+# ----------------------------
+# tiled piqe equals pypiqe.piqe on the whole image
+# ----------------------------
+
+def create_image(rows, columns, seed):
+
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[-1:1:rows * 1j, -1:1:columns * 1j]
+    radius = (x / 0.8) ** 2 + (y / 0.65) ** 2
+    image = np.where(radius < 1, 200 - 100 * radius, 10) + rng.normal(0, 12, (rows, columns))
+    # flat and noisy patches, so blocks are skipped, noisy and distorted
+    image[rows // 4:rows // 3, :] = 128
+    noisy = image[rows - rows // 5:, columns // 2:]
+    noisy += rng.normal(0, 40, noisy.shape)
+
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+# whole blocks, partial last block rows and columns, and a tile count that does not divide the block rows
+@pytest.mark.parametrize('rows, columns', [(1024, 1024), (1040, 1000), (523, 777)])
+@pytest.mark.parametrize('processes', [2, 3])
+def test_piqe_tiled_equals_piqe(rows, columns, processes):
+
+    image = create_image(rows, columns, seed=rows)
+
+    assert piqe_tiled(image, processes) == float(piqe(image)[0])
@@ -0,0 +1,140 @@
+from models.scan_key import ScanKey
+from modules.queue_helper import scan_queue, PRIORITY_JOB
+
+# ----------------------------
+# helpers
+# ----------------------------
+
+def create_scan(xnat_scan_id):
+    return ScanKey(xnat_scan_id, 'P1', 'S1', 'E1', str(xnat_scan_id), 'CT', 10, 1000, None, None, None)
+
+STAGES = ['quality_functions', 'normalization_functions']
+
+# ----------------------------
+# queue order
+# ----------------------------
+
+def test_jobs_are_taken_before_bulk_scans():
+
+    queue = scan_queue()
+    queue.put(create_scan(1), STAGES)
+    queue.put(create_scan(2), STAGES)
+    job_id = queue.create_job({'experiment': 'E1'})
+    queue.put(create_scan(3), STAGES, priority=PRIORITY_JOB, job_id=job_id)
+
+    assert [queue.next(0).scan.xnat_scan_id for _ in range(3)] == [3, 1, 2]
+
+def test_scan_is_not_queued_twice():
+
+    queue = scan_queue()
+
+    assert queue.put(create_scan(1), STAGES)
+    assert not queue.put(create_scan(1), STAGES)
+    assert len(queue.pending()) == 1
+
+def test_job_raises_priority_of_waiting_scan():
+
+    queue = scan_queue()
+    queue.put(create_scan(1), STAGES)
+    queue.put(create_scan(2), STAGES)
+    job_id = queue.create_job({'experiment': 'E1'})
+
+    assert queue.put(create_scan(2), STAGES, priority=PRIORITY_JOB, job_id=job_id, options={'reset': True})
+
+    item = queue.next(0)
+    assert item.scan.xnat_scan_id == 2
+    assert item.jobs == (job_id,)
+    assert item.options == {'reset': True}
+
+# ----------------------------
+# job state
+# ----------------------------
+
+def test_job_state_follows_its_scans():
+
+    queue = scan_queue()
+    job_id = queue.create_job({'experiment': 'E1'})
+    assert queue.get_job(job_id)['state'] == 'submitted'
+    assert queue.get_submitted_jobs() == [(job_id, {'experiment': 'E1'})]
+
+    queue.put(create_scan(1), STAGES, priority=PRIORITY_JOB, job_id=job_id)
+    queue.put(create_scan(2), STAGES[:1], priority=PRIORITY_JOB, job_id=job_id)
+    assert queue.get_job(job_id)['state'] == 'queued'
+
+    # first stage of scan 1: the scan is queued again for normalization
+    item = queue.next(0)
+    assert queue.get_job(job_id)['state'] == 'running'
+    queue.complete(item, {'total_time': 1.5, 'results': {'quality': {'average_piqe_score': 30.0}}})
+    scans = {scan['scan_id']: scan for scan in queue.get_job(job_id)['scans']}
+    assert scans['1']['state'] == 'running'
+    assert scans['1']['results'] == {'quality': {'average_piqe_score': 30.0}}
+
+    # scan 2 fails, scan 1 completes its second stage
+    item = queue.next(0)
+    assert item.scan.xnat_scan_id == 2
+    queue.complete(item, error='download failed')
+    item = queue.next(0)
+    assert item.stages == ('normalization_functions',)
+    queue.complete(item, {'total_time': 0.5, 'results': {'normalization': {'shape': [1, 2, 2]}}})
+
+    job = queue.get_job(job_id)
+    scans = {scan['scan_id']: scan for scan in job['scans']}
+    assert job['state'] == 'completed'
+    assert job['finished'] is not None
+    assert job['first_result_seconds'] is not None
+    assert scans['1']['state'] == 'completed'
+    assert scans['1']['seconds'] == 2.0
+    assert scans['2']['state'] == 'failed'
+    assert scans['2']['error'] == 'quality_functions - download failed'
+    assert queue.get_status()['failed'] == 1
+
+def test_job_for_running_scan_follows_it():
+
+    queue = scan_queue()
+    queue.put(create_scan(1), STAGES[:1])
+    item = queue.next(0)
+
+    job_id = queue.create_job({'experiment': 'E1'})
+    queue.put(create_scan(1), STAGES[:1], priority=PRIORITY_JOB, job_id=job_id)
+    assert queue.get_job(job_id)['state'] == 'running'
+    assert queue.pending() == []
+
+    queue.complete(item, {'total_time': 1.0})
+    assert queue.get_job(job_id)['state'] == 'completed'
+
+def test_retried_scan_is_queued_again():
+
+    queue = scan_queue()
+    job_id = queue.create_job({'experiment': 'E1'})
+    queue.put(create_scan(1), STAGES[:1], priority=PRIORITY_JOB, job_id=job_id)
+    item = queue.next(0)
+
+    queue.retry(item)
+
+    assert queue.running == 0
+    assert queue.get_job(job_id)['scans'][0]['state'] == 'queued'
+    assert queue.next(0) == item
+
+def test_cancel_fails_waiting_job_scans():
+
+    queue = scan_queue()
+    job_id = queue.create_job({'experiment': 'E1'})
+    queue.put(create_scan(1), STAGES, priority=PRIORITY_JOB, job_id=job_id)
+
+    queue.close(cancel=True)
+
+    job = queue.get_job(job_id)
+    assert job['state'] == 'failed'
+    assert job['scans'][0]['error'] == 'quality_functions - cancelled'
+    assert queue.finished()
+
+def test_failed_job():
+
+    queue = scan_queue()
+    job_id = queue.create_job({'experiment': 'E9'})
+    queue.fail_job(job_id, 'Unknown experiment E9')
+
+    job = queue.get_job(job_id)
+    assert (job['state'], job['error']) == ('failed', 'Unknown experiment E9')
+    assert queue.get_submitted_jobs() == []
+    assert queue.get_job('unknown') is None
@@ -0,0 +1,148 @@
+import json
+from types import SimpleNamespace
+
+from pydicom.valuerep import DSfloat, IS
+
+from modules.results_helper import get_quality_rows, get_quality_summary, get_acquisition_row, get_acquisition_summary
+
+# ----------------------------
+# quality rows
+# ----------------------------
+
+def test_quality_rows_per_instance_and_frame():
+
+    scan_quality = json.dumps({
+        'average_piqe_score': 30.0,
+        'instances': {
+            '1.2.3': {'piqe_score': 25.0, 'snr_score': 4.5},
+            '1.2.4-2': {'piqe_score': 35.0},
+        },
+    })
+
+    rows = get_quality_rows(7, scan_quality)
+
+    assert rows[0]['xnat_scan_id'] == 7
+    assert (rows[0]['sop_instance_uid'], rows[0]['frame'], rows[0]['piqe_score'], rows[0]['snr_score']) == ('1.2.3', None, 25.0, 4.5)
+    assert (rows[1]['sop_instance_uid'], rows[1]['frame'], rows[1]['snr_score']) == ('1.2.4', 2, None)
+    assert get_quality_rows(7, None) == []
+
+def test_quality_summary():
+
+    scan_quality = json.dumps({'average_piqe_score': 30.0, 'instances': {'1': {}, '2': {}}})
+
+    assert get_quality_summary(scan_quality) == {'average_piqe_score': 30.0, 'scored_instances': 2}
+    assert get_quality_summary('') == {}
+
+# ----------------------------
+# acquisition summary
+# ----------------------------
+
+def create_headers(*acquisitions):
+    return [SimpleNamespace(acquisition=acquisition) for acquisition in acquisitions]
+
+def test_acquisition_summary_mode_and_consistency():
+
+    headers = create_headers(
+        {'Modality': 'MR', 'EchoTime': DSfloat('15'), 'ImageType': ['ORIGINAL', 'PRIMARY'], 'ImagePositionPatient': [0.0, 0.0, 0.0]},
+        {'Modality': 'MR', 'EchoTime': DSfloat('20'), 'ImageType': ['ORIGINAL', 'PRIMARY'], 'ImagePositionPatient': [0.0, 0.0, 1.0]},
+        {'Modality': 'MR', 'EchoTime': DSfloat('20'), 'ImageType': ['DERIVED'], 'ImagePositionPatient': [0.0, 0.0, 2.0]},
+    )
+
+    summary = get_acquisition_summary(headers)
+
+    assert summary['Modality'] == 'MR'
+    assert summary['EchoTime'] == 20.0
+    assert summary['ImageType'] == ['ORIGINAL', 'PRIMARY']
+    assert summary['ImagePositionPatient'] == [0.0, 0.0, 0.0]
+    tags = summary['consistency']['tags']
+    assert summary['consistency']['instances'] == 3
+    assert summary['consistency']['varying'] == ['EchoTime', 'ImageType']
+    assert tags['Modality'] == {'distinct': 1, 'mode_count': 3}
+    assert tags['EchoTime'] == {'distinct': 2, 'mode_count': 2, 'min': 15.0, 'max': 20.0}
+    assert tags['ImagePositionPatient']['distinct'] == 3
+
+def test_acquisition_summary_first_value_on_tie():
+
+    summary = get_acquisition_summary(create_headers({'SequenceName': 'b'}, {'SequenceName': 'a'}, {'SequenceName': 'a'}, {'SequenceName': 'b'}))
+
+    assert summary['SequenceName'] == 'b'
+    assert summary['consistency']['tags']['SequenceName'] == {'distinct': 2, 'mode_count': 2}
+
+def test_acquisition_summary_missing_values():
+
+    summary = get_acquisition_summary(create_headers(
+        {'FlipAngle': None, 'EchoTrainLength': IS('4')},
+        {'FlipAngle': None},
+        {'FlipAngle': '90.0', 'EchoTrainLength': IS('8'), 'ContrastBolusAgent': ''},
+    ))
+    tags = summary['consistency']['tags']
+
+    assert summary['FlipAngle'] == '90.0'
+    assert tags['FlipAngle'] == {'distinct': 1, 'mode_count': 1, 'min': 90.0, 'max': 90.0}
+    assert tags['EchoTrainLength'] == {'distinct': 2, 'mode_count': 1, 'min': 4.0, 'max': 8.0}
+    assert summary['ContrastBolusAgent'] == ''
+    assert tags['ContrastBolusAgent'] == {'distinct': 1, 'mode_count': 1}
+    assert get_acquisition_summary(create_headers({'FlipAngle': None}))['FlipAngle'] is None
+
+def test_acquisition_summary_numeric_columns():
+
+    summary = get_acquisition_summary(create_headers(
+        {'SliceThickness': DSfloat('2.5'), 'EchoTrainLength': IS('8'), 'KVP': None},
+        {'SliceThickness': float('nan'), 'EchoTrainLength': 4, 'KVP': None},
+        {'SliceThickness': DSfloat('1.25'), 'EchoTrainLength': IS('4'), 'KVP': None},
+        {'SliceThickness': DSfloat('1.25'), 'EchoTrainLength': IS('8'), 'KVP': None},
+        {'SliceThickness': DSfloat('2.5'), 'EchoTrainLength': IS('12')},
+    ))
+    tags = summary['consistency']['tags']
+
+    # first of the tied values, as a plain number
+    assert summary['SliceThickness'] == 2.5 and type(summary['SliceThickness']) is float
+    assert summary['EchoTrainLength'] == 8 and type(summary['EchoTrainLength']) is int
+    assert tags['SliceThickness'] == {'distinct': 2, 'mode_count': 2, 'min': 1.25, 'max': 2.5}
+    assert tags['EchoTrainLength'] == {'distinct': 3, 'mode_count': 2, 'min': 4.0, 'max': 12.0}
+    assert summary['KVP'] is None
+    assert tags['KVP'] == {'distinct': 0, 'mode_count': 0}
+    assert json.dumps(summary)
+
+def test_acquisition_summary_unhashable_values():
+
+    sequence = [{'ContrastBolusAgentPhase': 'POST'}]
+    summary = get_acquisition_summary(create_headers({'ContrastBolusUsageSequence': sequence}, {'ContrastBolusUsageSequence': sequence}))
+
+    assert summary['ContrastBolusUsageSequence'] == [str(sequence[0])]
+    assert summary['consistency']['tags']['ContrastBolusUsageSequence'] == {'distinct': 1, 'mode_count': 2}
+    assert json.dumps(summary)
+
+# ----------------------------
+# acquisition row
+# ----------------------------
+
+def test_acquisition_row_typed_columns():
+
+    scan_acquisition = json.dumps({
+        'Modality': 'MR',
+        'ImageType': ['ORIGINAL', 'PRIMARY', 'M'],
+        'SliceThickness': '1.5',
+        'PixelSpacing': ['0.5', '0.5'],
+        'EchoTrainLength': '8',
+        'RepetitionTime': 'unknown',
+        'FlipAngle': [90, 180],
+        'ContrastBolusUsageSequence': [{'ContrastBolusAgentNumber': 1}],
+        'KVP': '',
+        'PatientName': 'ignored',
+    })
+
+    row = get_acquisition_row(3, scan_acquisition)
+
+    assert row['xnat_scan_id'] == 3
+    assert row['modality'] == 'MR'
+    assert row['image_type'] == 'ORIGINAL\\PRIMARY\\M'
+    assert row['slice_thickness'] == 1.5
+    assert row['pixel_spacing'] == '0.5\\0.5'
+    assert row['echo_train_length'] == 8
+    assert row['repetition_time'] is None
+    assert row['flip_angle'] == 90.0
+    assert json.loads(row['contrast_bolus_usage_sequence']) == [{'ContrastBolusAgentNumber': 1}]
+    assert row['kvp'] is None
+    assert 'PatientName' not in row
+    assert get_acquisition_row(3, None) is None
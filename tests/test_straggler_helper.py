@@ -0,0 +1,345 @@
+import os
+import time
+import pytest
+from concurrent import futures
+
+from models.scan_key import ScanKey
+from modules.queue_helper import QueueItem
+from modules import straggler_helper as straggler_module
+from modules.straggler_helper import straggler_helper, RunCancelled, MIN_SAMPLES, MIN_STRAGGLER_SECONDS, CANCELLED
+from modules.straggler_helper import start_worker_run, end_worker_run, check_worker_run, claim_worker_run
+
+# ----------------------------
+# helpers
+# ----------------------------
+
+class quiet_log(object):
+
+    def info(self, message):
+        return None
+
+def create_helper(tmp_path=None, scan_timeouts=None, straggler_factor=0, retries=1, speculative=False, stage_timeouts=None, stage='quality_functions'):
+    args = {
+        'scan_timeouts': scan_timeouts,
+        'straggler_factor': straggler_factor,
+        'scan_retries': retries,
+        'speculative_execution': speculative,
+        'stage_timeouts': stage_timeouts,
+        'daemon': False,
+        'data_path': str(tmp_path) if tmp_path else None,
+    }
+    return straggler_helper(args, quiet_log(), stage)
+
+def create_item(xnat_scan_id=1, file_count=100, stage='quality_functions', sequence=0):
+    scan = ScanKey(xnat_scan_id, 'P1', 'S1', 'E1', str(xnat_scan_id), 'CT', file_count, 0, None, None, None)
+    return QueueItem(10, sequence, (stage,), scan, (), {})
+
+# seconds per file of the completed scans of the stage
+def observe_scans(helper, seconds_per_file, count=MIN_SAMPLES):
+    for index in range(count):
+        helper.observe(create_item(100 + index), {'total_time': 100 * seconds_per_file, 'counters': {'files': 100}})
+    return None
+
+# a run that has started on a worker (not cancelled by the pool)
+def create_future():
+    future = futures.Future()
+    future.set_running_or_notify_cancel()
+    return future
+
+def add_run(helper, item, speculative=False):
+    future = create_future()
+    helper.add_run(future, item, 0, speculative, helper.get_run_args({}, item)[1])
+    return future
+
+# a run started the given seconds ago
+def age_run(helper, future, seconds):
+    helper.running[future][2] -= seconds
+    return None
+
+@pytest.fixture(autouse=True)
+def reset_worker_run():
+    yield
+    end_worker_run()
+
+# ----------------------------
+# deadlines
+# ----------------------------
+
+def test_scan_timeout_per_stage():
+
+    helper = create_helper(scan_timeouts={'quality_functions': 10, 'default': 100})
+
+    assert helper.get_expired(create_item(), 5) is None
+    assert helper.get_expired(create_item(), 11).startswith('timeout')
+    assert helper.get_expired(create_item(stage='normalization_functions'), 50) is None
+    assert helper.get_expired(create_item(stage='normalization_functions'), 101).startswith('timeout')
+
+def test_straggler_needs_samples():
+
+    helper = create_helper(straggler_factor=2)
+    observe_scans(helper, 1.0, count=MIN_SAMPLES - 1)
+
+    assert helper.expected(create_item()) is None
+    assert helper.get_expired(create_item(), 10000) is None
+
+    observe_scans(helper, 1.0, count=1)
+
+    assert helper.expected(create_item(file_count=50)) == pytest.approx(50.0)
+    assert helper.get_expired(create_item(), 150) is None
+    assert helper.get_expired(create_item(), 201).startswith('straggler')
+
+def test_straggler_minimum_seconds():
+
+    helper = create_helper(straggler_factor=2)
+    observe_scans(helper, 0.01)
+
+    assert helper.get_expired(create_item(), MIN_STRAGGLER_SECONDS - 1) is None
+    assert helper.get_expired(create_item(), MIN_STRAGGLER_SECONDS + 1).startswith('straggler')
+
+def test_retry_limit():
+
+    helper = create_helper(retries=2)
+    item = create_item()
+
+    assert helper.retry(item, 'timeout (11 s of 10 s)')
+    assert helper.retry(item, 'straggler (201 s, expected 100 s)')
+    assert not helper.retry(item, 'timeout (11 s of 10 s)')
+    assert helper.get_attempts(item) == 3
+    assert helper.statistics['retries'] == 2
+    assert helper.statistics['timeouts'] == 2
+    assert helper.statistics['stragglers'] == 1
+
+def test_stage_expired_once():
+
+    helper = create_helper(stage_timeouts={'quality_functions': 0.01})
+    time.sleep(0.02)
+
+    assert helper.stage_expired()
+    assert not helper.stage_expired()
+
+# ----------------------------
+# speculative execution
+# ----------------------------
+
+def test_speculative_slowest_first():
+
+    helper = create_helper(speculative=True)
+    observe_scans(helper, 1.0)
+    running = [(create_item(1, file_count=10), 12), (create_item(2, file_count=10), 30), (create_item(3, file_count=10), 20), (create_item(4, file_count=100), 120)]
+
+    selected = helper.get_speculative(running, 2)
+
+    assert [item.scan.xnat_scan_id for item in selected] == [2, 3]
+    assert helper.get_speculative(running, 0) == []
+    assert create_helper().get_speculative(running, 2) == []
+
+# ----------------------------
+# claims of the runs
+# ----------------------------
+
+def test_first_run_claims_the_attempt(tmp_path):
+
+    helper = create_helper(tmp_path, speculative=True)
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    first_args, first_id = helper.get_run_args({}, item)
+    second_args, second_id = helper.get_run_args({}, item)
+
+    start_worker_run(first_args)
+    claim_worker_run()
+    check_worker_run()
+
+    start_worker_run(second_args)
+    with pytest.raises(RunCancelled):
+        check_worker_run()
+    with pytest.raises(RunCancelled):
+        claim_worker_run()
+
+    # claimed attempts are not cancelled, a failed run leaves the claim to the others
+    assert not helper.cancel_attempt(item)
+    helper.release_claim(item, second_id)
+    assert os.path.exists(helper.get_claim_path(item))
+    helper.release_claim(item, first_id)
+    start_worker_run(second_args)
+    claim_worker_run()
+
+    helper.end_runs()
+    assert not os.path.exists(helper.run_path)
+
+def test_cancelled_attempt_stops_its_runs(tmp_path, monkeypatch):
+
+    helper = create_helper(tmp_path, scan_timeouts={'default': 10})
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    run_args, _ = helper.get_run_args({}, item)
+
+    start_worker_run(run_args)
+    check_worker_run()
+    assert helper.cancel_attempt(item)
+    with open(helper.get_claim_path(item)) as claim_file:
+        assert claim_file.read() == CANCELLED
+
+    # checked at most once per CHECK_INTERVAL
+    check_worker_run()
+    monkeypatch.setattr(straggler_module, 'CHECK_INTERVAL', 0)
+    with pytest.raises(RunCancelled):
+        check_worker_run()
+    with pytest.raises(RunCancelled):
+        claim_worker_run()
+
+    # the next attempt has its own claim
+    helper.retry(item, 'timeout (11 s of 10 s)')
+    start_worker_run(helper.get_run_args({}, item)[0])
+    claim_worker_run()
+
+def test_ended_pool_stops_its_runs(tmp_path, monkeypatch):
+
+    helper = create_helper(tmp_path, scan_timeouts={'default': 10})
+    helper.start_runs({'data_path': str(tmp_path)})
+    start_worker_run(helper.get_run_args({}, create_item())[0])
+    helper.end_runs()
+    monkeypatch.setattr(straggler_module, 'CHECK_INTERVAL', 0)
+
+    with pytest.raises(RunCancelled):
+        check_worker_run()
+    with pytest.raises(RunCancelled):
+        claim_worker_run()
+
+def test_no_runs_without_deadlines(tmp_path):
+
+    helper = create_helper(tmp_path)
+    helper.start_runs({'data_path': str(tmp_path)})
+    run_args, run_id = helper.get_run_args({'reset': True}, create_item())
+
+    assert run_args == {'reset': True} and run_id is None
+    start_worker_run(run_args)
+    check_worker_run()
+    claim_worker_run()
+    assert not os.path.exists(os.path.join(tmp_path, 'runs'))
+
+# ----------------------------
+# runs in flight
+# ----------------------------
+
+def test_first_result_is_kept(tmp_path):
+
+    helper = create_helper(tmp_path, speculative=True)
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    first, copy = add_run(helper, item), add_run(helper, item, speculative=True)
+
+    copy.set_result({'total_time': 1.0, 'counters': {'files': 100}})
+
+    assert helper.end_run(copy) == [item, 0, True, copy.result(), None]
+    assert helper.statistics['speculative_wins'] == 1
+    # the first run is left to stop, and holds its worker until then
+    assert helper.running == {} and helper.scan_runs == {}
+    assert list(helper.abandoned) == [first] and helper.busy == 1
+
+    first.set_exception(RunCancelled())
+    assert helper.end_run(first) is None
+    assert helper.busy == 0
+
+def test_failed_run_waits_for_the_other_runs(tmp_path):
+
+    helper = create_helper(tmp_path, speculative=True)
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    first, copy = add_run(helper, item), add_run(helper, item, speculative=True)
+
+    first.set_exception(ValueError('bad file'))
+    assert helper.end_run(first) is None
+
+    # the scan fails with the first error of its runs, not with a cancelled run
+    copy.set_exception(RunCancelled())
+    scan_item, _, speculative, result, error = helper.end_run(copy)
+
+    assert (scan_item, speculative, result) == (item, True, None)
+    assert str(error) == 'bad file'
+    assert helper.busy == 0
+
+def test_sweep_cancels_expired_scans(tmp_path):
+
+    helper = create_helper(tmp_path, scan_timeouts={'default': 10}, retries=1)
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    future = add_run(helper, item)
+
+    assert helper.sweep(False) == []
+    age_run(helper, future, 11)
+    # not while the pool is broken (its runs have failed)
+    assert helper.sweep(False, broken=True) == []
+
+    [[swept_item, reason, retried]] = helper.sweep(False)
+
+    assert swept_item is item and reason.startswith('timeout') and retried
+    assert list(helper.abandoned) == [future] and not helper.running and not helper.scan_runs
+    with open(os.path.join(helper.run_path, f'{item.scan.xnat_scan_id}-0-1')) as claim_file:
+        assert claim_file.read() == CANCELLED
+
+    # the next attempt fails once the retries are used
+    age_run(helper, add_run(helper, item), 11)
+    [[swept_item, reason, retried]] = helper.sweep(False)
+
+    assert swept_item is item and not retried
+    assert helper.get_attempts(item) == 2 and helper.statistics['timeouts'] == 2
+
+def test_sweep_leaves_claimed_scans(tmp_path):
+
+    helper = create_helper(tmp_path, scan_timeouts={'default': 10})
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    run_args, run_id = helper.get_run_args({}, item)
+    future = create_future()
+    helper.add_run(future, item, 0, False, run_id)
+
+    # the run is writing its results
+    start_worker_run(run_args)
+    claim_worker_run()
+    age_run(helper, future, 11)
+
+    assert helper.sweep(False) == []
+    assert helper.scan_runs and not helper.abandoned
+
+def test_stage_timeout_sweeps_all_scans(tmp_path):
+
+    helper = create_helper(tmp_path, stage_timeouts={'quality_functions': 3600})
+    helper.start_runs({'data_path': str(tmp_path)})
+    items = [create_item(1), create_item(2)]
+    for item in items:
+        add_run(helper, item)
+
+    # not retried
+    assert helper.sweep(True) == [[items[0], 'stage timeout', False], [items[1], 'stage timeout', False]]
+    assert helper.busy == 2 and not helper.scan_runs
+
+def test_stuck_runs_are_dropped(tmp_path, monkeypatch):
+
+    helper = create_helper(tmp_path, scan_timeouts={'default': 10})
+    helper.start_runs({'data_path': str(tmp_path)})
+    item = create_item()
+    future = add_run(helper, item)
+    helper.cancel_attempt(item)
+    helper.abandon(item, helper.scan_runs.pop(item.scan.xnat_scan_id))
+
+    assert helper.drop_stuck_runs() == 0
+    monkeypatch.setattr(straggler_module, 'CANCEL_GRACE', 0)
+    assert helper.drop_stuck_runs() == 1
+    assert helper.busy == 0 and helper.statistics['restarts'] == 1
+    assert not future.done()
+
+def test_speculative_runs_once_per_scan(tmp_path):
+
+    helper = create_helper(tmp_path, speculative=True)
+    helper.start_runs({'data_path': str(tmp_path)})
+    observe_scans(helper, 0.01)
+    items = [create_item(1), create_item(2), create_item(3)]
+    for item, elapsed in zip(items, [5, 10, 0]):
+        age_run(helper, add_run(helper, item), elapsed)
+
+    # slowest first, no copy of a scan expected to take longer
+    assert helper.get_speculative_runs(0) == []
+    assert helper.get_speculative_runs(1) == [items[1]]
+    add_run(helper, items[1], speculative=True)
+    assert helper.get_speculative_runs(2) == [items[0]]
+    assert helper.statistics['speculative'] == 2
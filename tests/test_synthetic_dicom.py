@@ -0,0 +1,65 @@
+import json
+import urllib.request
+
+import pydicom
+
+from benchmark.synthetic_dicom import synthetic_dicom
+from benchmark.mock_xnat import mock_xnat
+
+# ----------------------------
+# synthetic series
+# ----------------------------
+
+def test_create_series_writes_instances_and_scouts(series_path):
+
+    files = synthetic_dicom(seed=1).create_series(series_path, 'CT', 4, image_size=(32, 32), num_scouts=2)
+
+    assert len(files) == 6
+    datasets = [pydicom.dcmread(file) for file in files]
+    assert [int(dataset.InstanceNumber) for dataset in datasets] == [1, 2, 3, 4, 5, 6]
+    assert 'LOCALIZER' in datasets[0].ImageType
+    assert sum('LOCALIZER' in dataset.ImageType for dataset in datasets) == 2
+    assert len({dataset.SeriesInstanceUID for dataset in datasets}) == 1
+
+    slices = [dataset for dataset in datasets if 'LOCALIZER' not in dataset.ImageType]
+    assert [float(dataset.ImagePositionPatient[2]) for dataset in slices] == [0.0, 1.0, 2.0, 3.0]
+    assert slices[0].pixel_array.shape == (32, 32)
+
+def test_create_series_multiframe(series_path):
+
+    files = synthetic_dicom().create_series(series_path, 'MG', 1, num_frames=3, image_size=(16, 24))
+
+    dataset = pydicom.dcmread(files[0])
+    assert dataset.SOPClassUID == synthetic_dicom.sop_classes['MG_MULTI']
+    assert dataset.pixel_array.shape == (3, 16, 24)
+
+def test_create_series_rle(series_path):
+
+    files = synthetic_dicom().create_series(series_path, 'MR', 1, image_size=(16, 16), transfer_syntax='rle')
+
+    dataset = pydicom.dcmread(files[0])
+    assert dataset.file_meta.TransferSyntaxUID == synthetic_dicom.transfer_syntaxes['rle']
+    assert dataset.pixel_array.shape == (16, 16)
+
+# ----------------------------
+# mock xnat
+# ----------------------------
+
+def test_mock_xnat_serves_catalog_and_files(series_path):
+
+    files = synthetic_dicom().create_series(series_path, 'CT', 2, image_size=(16, 16))
+    server = mock_xnat().start()
+    try:
+        server.add_scan('P1', 'S1', 'E1', '1', 'CT', 'Axial', files)
+
+        with urllib.request.urlopen(f'{server.url}/data/projects?format=json') as response:
+            projects = json.load(response)['ResultSet']['Result']
+        assert [project['ID'] for project in projects] == ['P1']
+
+        with urllib.request.urlopen(f'{server.url}/data/projects/P1/subjects/S1/experiments/E1/scans/1/resources/DICOM/files/00001.dcm') as response:
+            content = response.read()
+        with open(files[0], 'rb') as dicom_file:
+            assert content == dicom_file.read()
+        assert server.request_count == 2
+    finally:
+        server.stop()